@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the Envialite server.
+
+Drives synthetic merges through the real HTTP handler and delivery engine
+against Demo Mode's local SMTP sink, and writes a JSON report so runs can be compared
+over time. Each case runs in its own process so its peak RSS is its own.
+
+    python benchmark.py                                   # full matrix
+    python benchmark.py --rows 100 1000 --attachment-mb 0 1 -o before.json
+    python benchmark.py --latency-ms 20 --failure-rate 0.01
+    python benchmark.py --rows 10000 --gzip                # merge requests posted gzipped
+    python benchmark.py --startup                         # import time against STARTUP_BUDGET_MS
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import subprocess
+import statistics
+import http.client
+import socketserver
+
+# --- Configuration ---
+DEFAULT_ROWS = [100, 1000, 10000, 100000]
+DEFAULT_ATTACHMENT_MB = [0, 1, 10]
+DEFAULT_BODIES = ['plain', 'personalized']
+DEFAULT_MAX_PAYLOAD_GB = 2.0  # Cases that would push more than this through SMTP are skipped
+STARTUP_BUDGET_MS = 150      # `import server` (cumulative, warm bytecode cache) must stay under this
+STARTUP_RUNS = 5
+# Modules `import server` must not load: each is imported by the path that needs it
+STARTUP_DEFERRED = ('smtplib', 'sqlite3', 'csv', 'uuid', 'platform', 'multiprocessing', 'concurrent.futures',
+                    'tkinter', 'webbrowser', 'subprocess')
+BODY_PARAGRAPH = ('Thank you for being part of our community. This message is a synthetic '
+                  'benchmark body that stands in for a typical newsletter paragraph. ') * 8
+
+
+# --- Workloads ---
+
+def build_merge_request(case, sink_port, attachment):
+    """The /send-emails body the web app would post for this case (server-side merge)."""
+    lines = ['email,name,city']
+    for row in range(case['rows']):
+        lines.append(f'user{row}@example.test,Person {row},City {row % 97}')
+    if case['body'] == 'personalized':
+        subject = 'Hello {{name}}, news for {{city}}'
+        template = 'Dear {{name}},\n\n' + BODY_PARAGRAPH + '\n\nSee you in {{city}}!'
+    else:
+        subject = 'Hello, news for everyone'
+        template = 'Dear customer,\n\n' + BODY_PARAGRAPH + '\n\nSee you soon!'
+    return {
+        'smtpServer': '127.0.0.1',
+        'smtpPort': sink_port,
+        'smtpUser': 'bench@example.test',
+        'smtpPassword': 'benchmark',
+        'smtpSecurity': 'none',
+        'fromName': 'Benchmark',
+        'fromEmail': 'bench@example.test',
+        'toEmail': '{{email}}',
+        'subject': subject,
+        'template': template,
+        'csvData': '\n'.join(lines) + '\n',
+        'commonAttachments': [attachment] if attachment else [],
+    }
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def time_messages(server, samples):
+    """Record, per message, the time from building it to the SMTP server's reply."""
+    build, send = server.MessageBuilder.build, server.DeliveryEngine.send
+    started = threading.local()
+
+    def timed_build(builder, email_data):
+        started.at = time.perf_counter()
+        return build(builder, email_data)
+
+    def timed_send(engine, message, recipients=None):
+        # Messages from render processes were built elsewhere; only their send is timed
+        at = started.__dict__.pop('at', None) or time.perf_counter()
+        try:
+            return send(engine, message, recipients)
+        finally:
+            samples.append(time.perf_counter() - at)
+
+    server.MessageBuilder.build = timed_build
+    server.DeliveryEngine.send = timed_send
+
+
+def post(conn, path, body, content_type, encoding=None):
+    headers = {'Content-Type': content_type}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    conn.request('POST', path, body=body, headers=headers)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def run_case(case, sink_port, options):
+    """Run one case in this process and return its measurements."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import tempfile
+    import server
+
+    server.SMTP_POOL_SIZE = options['connections']
+    if not options['paced']:
+        # Measure the pipeline, not the rate limiter's slow start
+        server.SMTP_INITIAL_RATE = server.SMTP_MAX_RATE = 1e9
+    server.attachment_store = server.AttachmentStore(tempfile.mkdtemp(prefix='envialite-bench-'))
+    if options.get('renderProcesses'):
+        server.render_pool = server.RenderPool(options['renderProcesses'])
+    samples = []
+    time_messages(server, samples)
+
+    httpd = server.create_http_server(0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=None)
+    request_bytes = response_bytes = 0
+
+    started = time.perf_counter()
+    attachment = None
+    if case['attachmentBytes']:
+        data = os.urandom(case['attachmentBytes'])
+        status, reply = post(conn, '/api/attachments', data, 'application/octet-stream')
+        request_bytes += len(data)
+        response_bytes += len(reply)
+        upload = json.loads(reply)
+        attachment = {'filename': 'attachment.bin', 'hash': upload['hash'], 'size': upload['size']}
+
+    body = json.dumps(build_merge_request(case, sink_port, attachment)).encode('utf-8')
+    if options.get('gzip'):
+        import gzip
+        body = gzip.compress(body, compresslevel=6)  # What the browser's CompressionStream produces
+    status, reply = post(conn, '/send-emails', body, 'application/json', 'gzip' if options.get('gzip') else None)
+    elapsed = time.perf_counter() - started
+    request_bytes += len(body)
+    response_bytes += len(reply)
+    result = json.loads(reply)
+    httpd.shutdown()
+
+    if not result.get('success'):
+        return dict(case, error=result.get('error'))
+    return dict(
+        case,
+        sent=result['sent'],
+        failed=result['failed'],
+        elapsed=round(elapsed, 3),
+        messagesPerSecond=round(result['sent'] / elapsed, 2) if elapsed else None,
+        latency={
+            'p50': round(percentile(samples, 0.50), 6),
+            'p99': round(percentile(samples, 0.99), 6),
+        } if samples else None,
+        requestBytes=request_bytes,
+        responseBytes=response_bytes,
+        peakRssBytes=peak_rss_bytes(),
+        engine=result.get('stats'),
+        phases=result.get('timings'),
+    )
+
+
+# --- Matrix ---
+
+def estimated_payload(case):
+    """Rough bytes the case pushes through SMTP (base64 adds a third)."""
+    return case['rows'] * (case['attachmentBytes'] * 4 // 3 + 2048)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_matrix(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from server import DemoSMTPServer  # The sink Demo Mode sends to
+    sink = DemoSMTPServer(latency=args.latency_ms / 1000.0, defer_rate=args.failure_rate).start()
+    options = {'connections': args.connections, 'paced': args.paced, 'renderProcesses': args.render_processes,
+               'gzip': args.gzip}
+    report = {
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'latencyMs': args.latency_ms, 'failureRate': args.failure_rate,
+                     'connections': args.connections, 'paced': args.paced,
+                     'renderProcesses': args.render_processes, 'gzip': args.gzip},
+        'runs': [],
+    }
+    cases = [{'rows': rows, 'attachmentBytes': int(megabytes * 1024 * 1024), 'body': body}
+             for body in args.bodies for megabytes in args.attachment_mb for rows in args.rows]
+
+    for case in cases:
+        label = f"{case['rows']} rows, {case['attachmentBytes'] // 1024} KB attachment, {case['body']} body"
+        if estimated_payload(case) > args.max_payload_gb * 1024 ** 3:
+            print(f"⏭️  Skipping {label} (over --max-payload-gb)")
+            report['runs'].append(dict(case, skipped=True))
+            continue
+        sink.reset()
+        command = [sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case),
+                   '--sink-port', str(sink.server_address[1]), '--options', json.dumps(options)]
+        child = subprocess.run(command, capture_output=True, text=True)
+        if child.returncode != 0:
+            print(f"❌ {label}: benchmark process failed\n{child.stderr}")
+            report['runs'].append(dict(case, error=child.stderr.strip().splitlines()[-1:]))
+            continue
+        run = json.loads(child.stdout.strip().splitlines()[-1])
+        run['smtp'] = dict(sink.counters)
+        report['runs'].append(run)
+        if run.get('error'):
+            print(f"❌ {label}: {run['error']}")
+        else:
+            latency = run['latency'] or {}
+            print(f"✅ {label}: {run['messagesPerSecond']} msg/s, "
+                  f"p50 {latency.get('p50', 0) * 1000:.1f} ms, p99 {latency.get('p99', 0) * 1000:.1f} ms, "
+                  f"peak RSS {(run['peakRssBytes'] or 0) / 1024 ** 2:.0f} MB")
+    sink.shutdown()
+    return report
+
+
+# --- Startup ---
+
+def import_profile():
+    """
+    One `python -X importtime -c "import server"` run. Returns (total_us, modules)
+    where modules maps each module imported to its self time in microseconds.
+    """
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)  # Measure with bytecode cached, as the binary runs
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import server'], env=env,
+                           capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if child.returncode != 0:
+        raise RuntimeError(child.stderr.strip().splitlines()[-1])
+    modules = {}
+    total = None
+    for line in child.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(own)
+        if name.strip() == 'server':
+            total = int(cumulative)
+    return total, modules
+
+
+def time_to_ready():
+    """Seconds from launching `server.py --demo` until its port accepts connections."""
+    with socketserver.TCPServer(('127.0.0.1', 0), None) as probe:
+        port = probe.server_address[1]
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__).replace('benchmark.py', 'server.py'),
+                               str(port), '--demo', '--journal', ''],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while server.poll() is None:
+            try:
+                http.client.HTTPConnection('127.0.0.1', port, timeout=1).connect()
+                return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.002)
+        raise RuntimeError(f'server exited with code {server.returncode}')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_startup(args):
+    """Median import time and time to ready over `args.startup_runs` runs, checked against the budget."""
+    import_profile()  # Warm the bytecode cache
+    profiles = [import_profile() for _ in range(args.startup_runs)]
+    ready = [time_to_ready() for _ in range(args.startup_runs)]
+    total_ms = statistics.median(total for total, _ in profiles) / 1000
+    modules = min(profiles)[1]
+    loaded = [name for name in STARTUP_DEFERRED if name in modules]
+    report = {
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'importMs': round(total_ms, 1),
+        'readyMs': round(statistics.median(ready) * 1000, 1),
+        'budgetMs': args.startup_budget_ms,
+        'slowestModules': [{'module': name, 'selfMs': round(own / 1000, 2)}
+                           for name, own in sorted(modules.items(), key=lambda item: -item[1])[:15]],
+        'deferredModulesLoaded': loaded,
+        'withinBudget': total_ms <= args.startup_budget_ms and not loaded,
+    }
+    verdict = '✅' if report['withinBudget'] else '❌'
+    print(f"{verdict} import server: {report['importMs']} ms (budget {args.startup_budget_ms} ms), "
+          f"ready to serve in {report['readyMs']} ms")
+    if loaded:
+        print(f"❌ Loaded at startup but should be imported on first use: {', '.join(loaded)}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Envialite throughput benchmark.')
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS, help='Merge sizes to run.')
+    parser.add_argument('--attachment-mb', type=float, nargs='+', default=DEFAULT_ATTACHMENT_MB,
+                        help='Size of the attachment sent with every email (0 for none).')
+    parser.add_argument('--bodies', nargs='+', choices=DEFAULT_BODIES, default=DEFAULT_BODIES,
+                        help='plain: one body for everyone; personalized: placeholders filled per row.')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='SMTP sink delay before each reply.')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of MAIL FROM commands the sink answers with 451.')
+    parser.add_argument('--connections', type=int, default=4, help='SMTP connections per merge.')
+    parser.add_argument('--render-processes', type=int, default=0,
+                        help='Processes building messages in parallel (the server\'s --render-processes).')
+    parser.add_argument('--paced', action='store_true',
+                        help='Keep the adaptive rate limiter at its defaults instead of unlimited.')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Post merge requests with Content-Encoding: gzip, as the browser does.')
+    parser.add_argument('--max-payload-gb', type=float, default=DEFAULT_MAX_PAYLOAD_GB,
+                        help='Skip cases that would send more than this much mail data.')
+    parser.add_argument('--startup', action='store_true',
+                        help='Measure server startup (-X importtime) instead of throughput; exits 1 over budget.')
+    parser.add_argument('--startup-budget-ms', type=float, default=STARTUP_BUDGET_MS,
+                        help='Import time `--startup` allows for server.py.')
+    parser.add_argument('--startup-runs', type=int, default=STARTUP_RUNS, help='Runs `--startup` takes the median of.')
+    parser.add_argument('-o', '--output', help='Write the JSON report here (default: stdout).')
+    # Internal: run a single case in this (child) process
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--sink-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case), args.sink_port, json.loads(args.options))))
+        return
+
+    report = run_startup(args) if args.startup else run_matrix(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + '\n')
+        print(f"📄 Report written to {args.output}")
+    else:
+        print(output)
+    if args.startup and not report['withinBudget']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
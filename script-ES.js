@@ -20,12 +20,22 @@ class EnvialiteApp {
         this.csvData = '';
         this.recipients = [];
         this.attachments = new Map(); // Store attachments as Map(filename -> fileData)
+        this.verifiedAttachmentHashes = new Set(); // Hashes confirmed present in the server's attachment store
+        this.contactList = null; // Imported CSV parsed by the server: {datasetId, rows, csvData}
+        this.contactTableRows = 1000; // Rows of an imported list shown in the table editor
+        this.previewId = null; // Server-side preview the emails below are fetched from
+        this.previewChecks = null; // Its checks over every row (missing variables, attachments, addresses)
+        this.previewPageSize = 50; // Emails rendered per preview request
+        this.compressMinBytes = 16 * 1024; // Request bodies at least this big are sent gzipped
 
         // SMTP settings
         this.smtpServer = 'smtp.gmail.com';
         this.smtpPort = 587;
         this.smtpUser = '';
         this.smtpPassword = '';
+        this.smtpWeight = 1;
+        this.smtpQuota = 0; // 0 means no daily limit
+        this.smtpRelays = []; // Additional accounts a send is spread across
 
         // SMTP connection status
         this.smtpConnectionTested = false;
@@ -37,6 +47,8 @@ class EnvialiteApp {
         this.currentEmailIndex = 0;
         this.emailPreviews = []; // Store all generated email previews
         this.sendResults = []; // Store results from the server
+        this.sendBatchId = null; // Server batch id used to fetch full message details
+        this.sentPreviewIndices = []; // Preview index for each row of the last send
 
         this.init();
     }
@@ -55,6 +67,9 @@ class EnvialiteApp {
         // Initialize table editor
         this.initializeTableEditor();
 
+        // Bring back the results of the last send, even if it is still running
+        this.restoreLastSendJob();
+
         console.log('Envía inicializado');
     }
 
@@ -107,15 +122,9 @@ class EnvialiteApp {
         csvFileInput.addEventListener('change', (e) => {
             const file = e.target.files[0];
             if (file) {
-                const reader = new FileReader();
-                reader.onload = (event) => {
-                    try {
-                        this.parsePastedData(event.target.result);
-                    } catch (error) {
-                        this.showStatus(`Error al procesar archivo CSV: ${error.message}`, 'error');
-                    }
-                };
-                reader.readAsText(file);
+                this.importContactList(file).catch(error => {
+                    this.showStatus(`Error al procesar archivo CSV: ${error.message}`, 'error');
+                });
             }
             e.target.value = ''; // Reset input so the same file can be selected again
         });
@@ -260,16 +269,16 @@ class EnvialiteApp {
 
     parseCSV() {
         try {
-            const lines = this.csvData.trim().split('\n');
+            const lines = this.parseDelimited(this.csvData, ',');
             if (lines.length < 2) {
                 throw new Error('CSV debe tener al menos una fila de encabezado y una fila de datos');
             }
 
-            const headers = lines[0].split(',').map(h => h.trim());
+            const headers = lines[0];
             this.recipients = [];
 
             for (let i = 1; i < lines.length; i++) {
-                const values = lines[i].split(',').map(v => v.trim());
+                const values = lines[i];
                 if (values.length === headers.length && values.some(v => v)) {
                     const recipient = {};
                     headers.forEach((header, index) => {
@@ -296,10 +305,9 @@ class EnvialiteApp {
     parsePastedData(text) {
         // Try to detect delimiter (tab, comma, semicolon)
         let delimiter = '\t'; // Default to tab
-        let rows = text.trim().split('\n');
+        const firstRow = text.trim().split('\n')[0];
 
-        if (rows.length > 0) {
-            const firstRow = rows[0];
+        if (firstRow) {
 
             // Detect delimiter by counting occurrences
             const tabCount = (firstRow.match(/\t/g) || []).length;
@@ -313,8 +321,8 @@ class EnvialiteApp {
             }
         }
 
-        // Parse rows
-        const dataRows = rows.map(row => row.split(delimiter).map(cell => cell.trim()));
+        // Parse rows (quoted cells may hold delimiters and line breaks)
+        const dataRows = this.parseDelimited(text, delimiter);
 
         if (dataRows.length === 0) {
             this.showStatus('No data to paste', 'error');
@@ -346,6 +354,11 @@ class EnvialiteApp {
         }
     }
 
+    setSendProgress(processed, total) {
+        const sendBtn = document.getElementById('sendBtn');
+        sendBtn.innerHTML = `<span class="spinner"></span>Enviando... ${processed}${total !== null ? ` / ${total}` : ''}`;
+    }
+
     showStatus(message, type) {
         // Remove existing status
         const existingStatus = document.querySelector('.status-message');
@@ -394,6 +407,9 @@ class EnvialiteApp {
                 document.getElementById('smtpPort').value = settings.smtpPort || 587;
                 document.getElementById('smtpUser').value = settings.smtpUser || '';
                 document.getElementById('smtpPassword').value = settings.smtpPassword || '';
+                document.getElementById('smtpWeight').value = settings.smtpWeight || '';
+                document.getElementById('smtpQuota').value = settings.smtpQuota || '';
+                this.renderSmtpRelays(settings.smtpRelays || []);
                 document.getElementById('fromEmail').value = settings.fromEmail || '';
                 document.getElementById('fromName').value = settings.fromName || '';
                 document.getElementById('defaultSubject').value = settings.defaultSubject || '';
@@ -403,6 +419,9 @@ class EnvialiteApp {
                 this.smtpPort = settings.smtpPort || 587;
                 this.smtpUser = settings.smtpUser || '';
                 this.smtpPassword = settings.smtpPassword || '';
+                this.smtpWeight = settings.smtpWeight || 1;
+                this.smtpQuota = settings.smtpQuota || 0;
+                this.smtpRelays = settings.smtpRelays || [];
                 this.fromEmail = settings.fromEmail || '';
                 this.fromName = settings.fromName || '';
                 this.subject = settings.defaultSubject || '';
@@ -417,15 +436,43 @@ class EnvialiteApp {
             // Get the latest form data every time a preview is requested
             this.getFormData();
 
-            this.parseCSV();
+            // Ensure we have the latest SMTP settings for fallback logic
+            this.getSmtpSettings();
+            if (this.smtpUser && !this.isValidEmail(this.smtpUser)) {
+                this.showStatus('Advertencia: el usuario SMTP no parece ser una dirección de correo. El campo De puede quedar vacío.', 'error');
+            }
 
-            if (this.recipients.length === 0) {
-                this.showStatus('No valid recipients to preview', 'error');
+            // The server resolves attachment names against the uploaded files
+            await this.uploadAttachmentsToServer();
+
+            // The server renders only the window of emails being looked at; the rest on demand
+            this.previewMergeSource = this.getMergeSource(); // What the server will render when sending
+            const request = this.buildMergeRequest(this.previewMergeSource);
+            delete request.smtpPassword;
+            request.limit = this.previewPageSize;
+            const response = await fetch('/api/preview', await this.compressRequest({
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify(request)
+            }));
+            const page = await response.json();
+            if (!page.success) {
+                throw new Error(page.error || 'No se pudo generar la vista previa');
+            }
+
+            if (page.total === 0) {
+                this.showStatus('No hay destinatarios válidos para la vista previa', 'error');
                 return;
             }
 
-            // Generate detailed previews for all emails
-            this.generateEmailPreviews();
+            this.previewId = page.previewId;
+            this.previewChecks = page.checks;
+            this.emailPreviews = new Array(page.total); // Filled in as windows are fetched
+            this.excludedEmailIndices.clear(); // Clear exclusions when new previews are generated
+            this.currentPreviewAttachments = new Map();
+            this.storePreviewPage(page);
 
             // Show the first email
             this.currentEmailIndex = 0;
@@ -433,69 +480,62 @@ class EnvialiteApp {
 
             document.getElementById('previewSection').style.display = 'block';
 
-            this.showStatus(`Vista previa generada para ${this.recipients.length} correos`, 'success');
+            const warnings = this.describePreviewChecks(page.checks);
+            const message = `Vista previa generada para ${page.total} correos`;
+            this.showStatus(warnings.length ? `${message}: ${warnings.join('; ')}` : message,
+                warnings.length ? 'error' : 'success');
 
         } catch (error) {
             this.showStatus(error.message, 'error');
         }
     }
 
-    generateEmailPreviews() {
-        this.emailPreviews = [];
-        this.excludedEmailIndices.clear(); // Clear exclusions when new previews are generated
-
-        // Initialize currentPreviewAttachments as empty Map
-        this.currentPreviewAttachments = new Map();
+    storePreviewPage(page) {
+        page.emails.forEach(email => {
+            // Keep previews already fetched, with any attachment edits made to them
+            if (!this.emailPreviews[email.index]) {
+                this.emailPreviews[email.index] = email;
+            }
+        });
+    }
 
-        // Ensure we have the latest SMTP settings for fallback logic
-        this.getSmtpSettings();
+    async loadPreviewPage(index) {
+        // Fetch the window of rendered emails around `index`
+        const offset = Math.max(0, index - Math.floor(this.previewPageSize / 2));
+        const response = await fetch(`/api/preview/${this.previewId}?offset=${offset}&limit=${this.previewPageSize}`);
+        const page = await response.json();
+        if (!page.success) {
+            throw new Error(page.error || 'No se pudo generar la vista previa');
+        }
+        this.storePreviewPage(page);
+    }
 
-        // Check if SMTP username is a valid email for fallback
-        const smtpEmailFallback = this.isValidEmail(this.smtpUser) ? this.smtpUser : null;
-        if (this.smtpUser && !smtpEmailFallback) {
-            this.showStatus('Warning: SMTP username does not appear to be an email address. From field may be empty.', 'error');
-        }
-
-        this.recipients.forEach((recipient, index) => {
-            // Merge both the From Name and From Email templates
-            const mergedFromName = this.mergeTemplate(this.fromName, recipient);
-            let mergedFromEmail = this.mergeTemplate(this.fromEmail, recipient);
-
-            const mergedTo = this.mergeTemplate(this.toEmail, recipient);
-            const mergedCc = this.mergeTemplate(this.ccEmail, recipient);
-            const mergedBcc = this.mergeTemplate(this.bccEmail, recipient);
-            const mergedSubject = this.mergeTemplate(this.emailSubject, recipient);
-            const mergedBody = this.mergeTemplate(this.emailBody, recipient);
-
-            // Use SMTP username as fallback if no From email is provided
-            if (!mergedFromEmail && smtpEmailFallback) {
-                mergedFromEmail = smtpEmailFallback;
-                console.log(`Using SMTP username as From email for recipient ${index + 1}`);
-            }
-
-            // Construct the final 'From' string, e.g., "John Doe <email@example.com>"
-            let finalFrom = mergedFromEmail;
-            if (mergedFromName) {
-                finalFrom = `"${mergedFromName.replace(/"/g, '\\"')}" <${mergedFromEmail}>`;
-            }
-
-            // Get attachments for this email (without emailIndex to avoid preview-specific logic)
-            const emailAttachments = this.getAttachmentsForEmail(recipient);
-
-            this.emailPreviews.push({
-                index: index,
-                recipient: recipient,
-                fromName: mergedFromName, // Store name part
-                fromEmail: mergedFromEmail, // Store email part
-                from: finalFrom,
-                to: mergedTo,
-                cc: mergedCc,
-                bcc: mergedBcc,
-                subject: mergedSubject,
-                body: mergedBody,
-                attachments: emailAttachments
-            });
-        });
+    describePreviewChecks(checks) {
+        const warnings = [];
+        if (checks.missingVariables.length > 0) {
+            warnings.push(`variables que no están en los datos: ${checks.missingVariables.join(', ')}`);
+        }
+        if (checks.missingAttachmentCount > 0) {
+            warnings.push(`adjuntos no encontrados: ${Object.keys(checks.missingAttachments).join(', ')}`);
+        }
+        if (checks.rowsWithoutRecipientCount > 0) {
+            warnings.push(`${checks.rowsWithoutRecipientCount} sin destinatario válido (primero: correo ${checks.rowsWithoutRecipient[0] + 1})`);
+        }
+        if (checks.rowsWithoutSenderCount > 0) {
+            warnings.push(`${checks.rowsWithoutSenderCount} sin dirección De`);
+        }
+        if (checks.rowsWithDuplicateRecipientCount > 0) {
+            const outcome = {
+                skip: 'que no lo recibirá de nuevo',
+                flag: 'que lo recibirá de nuevo, marcado en los resultados',
+                send: 'que lo recibirá de nuevo'
+            }[checks.duplicatePolicy] || 'que puede recibirlo de nuevo';
+            warnings.push(`${checks.rowsWithDuplicateRecipientCount} a un destinatario de un correo anterior, ${outcome} (primero: correo ${checks.rowsWithDuplicateRecipient[0] + 1})`);
+        }
+        if (checks.suppressedRecipientCount > 0) {
+            warnings.push(`${checks.suppressedRecipientCount} destinatario(s) suprimido(s) que se omitirán`);
+        }
+        return warnings;
     }
 
     showCurrentEmailPreview() {
@@ -624,6 +664,7 @@ class EnvialiteApp {
         if (currentPreview) {
             // Add the attachment data to the preview object
             currentPreview.attachments = Array.from(this.currentPreviewAttachments.values());
+            currentPreview.customAttachments = true;
             console.log('Updated email preview object with attachments:', currentPreview.attachments.length);
         } else {
             console.error('Current preview not found!');
@@ -801,6 +842,7 @@ class EnvialiteApp {
                     if (currentPreview) {
                         // Update the preview's attachments array
                         currentPreview.attachments = Array.from(this.currentPreviewAttachments.values());
+                        currentPreview.customAttachments = true;
                         console.log('Updated email preview object with attachments:', currentPreview.attachments.length);
                     } else {
                         console.error('Current preview not found!');
@@ -861,6 +903,7 @@ class EnvialiteApp {
             const currentPreview = this.emailPreviews[this.currentEmailIndex];
             if (currentPreview) {
                 currentPreview.attachments = Array.from(this.currentPreviewAttachments.values());
+                currentPreview.customAttachments = true;
                 console.log('Updated email preview object after removal:', currentPreview.attachments.length);
             }
 
@@ -869,22 +912,26 @@ class EnvialiteApp {
         }
     }
 
-    navigateEmail(direction) {
+    async navigateEmail(direction) {
         const newIndex = this.currentEmailIndex + direction;
         if (newIndex >= 0 && newIndex < this.emailPreviews.length) {
-            this.currentEmailIndex = newIndex;
-            this.showCurrentEmailPreview();
+            try {
+                if (!this.emailPreviews[newIndex]) {
+                    await this.loadPreviewPage(newIndex);
+                }
+                this.currentEmailIndex = newIndex;
+                this.showCurrentEmailPreview();
+            } catch (error) {
+                this.showStatus(error.message, 'error');
+            }
         }
     }
 
     storeSendResults(results) {
         // Match server results with preview objects and store status
         results.forEach(result => {
-            // Find the corresponding preview by email address and row number
-            const matchingPreview = this.emailPreviews.find(preview =>
-                preview.to === result.email ||
-                preview.recipient._rowNumber === result._rowNumber
-            );
+            // Results carry the row index of the submitted batch
+            const matchingPreview = this.getPreviewForResult(result);
 
             if (matchingPreview) {
                 matchingPreview.sendStatus = result.success ? 'sent' : 'failed';
@@ -893,6 +940,26 @@ class EnvialiteApp {
         });
     }
 
+    getPreviewForResult(result) {
+        if (!result || result.index === undefined) return null;
+        const previewIndex = this.sentPreviewIndices[result.index];
+        return previewIndex !== undefined ? this.emailPreviews[previewIndex] || null : null;
+    }
+
+    async fetchMessageDetails(result) {
+        // Results are compact; load the full message from the server the first time it is opened
+        if (!result || result.message || !this.sendBatchId || result.index === undefined) return;
+        try {
+            const response = await fetch(`/api/messages/${this.sendBatchId}/${result.index}`);
+            const data = await response.json();
+            if (data.success) {
+                result.message = data.message;
+            }
+        } catch (error) {
+            console.error('Could not load message details:', error);
+        }
+    }
+
     refreshPreviewDisplay() {
         // Simplified - just update the basic counter
         const totalCount = this.emailPreviews.length;
@@ -983,6 +1050,7 @@ class EnvialiteApp {
                             filename: option.value,
                             size: fileData.size,
                             type: fileData.type,
+                            hash: fileData.hash,
                             data: fileData.data // Include the base64 data
                         });
                         console.log('Added consistent attachment:', option.value);
@@ -1029,6 +1097,7 @@ class EnvialiteApp {
                             filename: att.filename,
                             size: fullAttachmentData.size,
                             type: fullAttachmentData.type,
+                            hash: fullAttachmentData.hash,
                             data: fullAttachmentData.data
                         });
                         console.log('Added preview-specific attachment:', att.filename);
@@ -1088,6 +1157,7 @@ class EnvialiteApp {
                         filename: filename,
                         size: foundAttachment.size,
                         type: foundAttachment.type,
+                        hash: foundAttachment.hash,
                         data: foundAttachment.data // Include the base64 data
                     });
                 } else {
@@ -1106,12 +1176,6 @@ class EnvialiteApp {
 
     async sendEmails() {
         try {
-            // If server is in demo mode, show a message and exit.
-            if (this.isServerInDemoMode) {
-                this.showStatus('Emails will not be sent because the server is in Demo Mode.', 'success');
-                return;
-            }
-
             this.setLoading(true);
 
             // Perform a silent connection test before sending
@@ -1163,103 +1227,62 @@ class EnvialiteApp {
             this.getSmtpSettings();
 
             // Validate we have recipients
-            if (this.recipients.length === 0) {
+            if (this.emailPreviews.length === 0) {
                 this.showStatus('No hay destinatarios válidos para enviar', 'error');
                 return;
             }
 
             // Check if any preview emails have empty From addresses
-            const emailsWithoutFrom = this.emailPreviews.filter(preview => !preview.from);
-            if (emailsWithoutFrom.length > 0) {
+            const checks = this.previewChecks;
+            const missingFrom = checks.rowsWithoutSenderCount > checks.rowsWithoutSender.length ||
+                checks.rowsWithoutSender.some(index => !this.excludedEmailIndices.has(index));
+            if (missingFrom) {
                 this.showStatus(`Algunos correos no tienen dirección De. Por favor verifica la vista previa y asegúrate de que todos los correos tengan direcciones de remitente válidas.`, 'error');
                 return;
             }
 
-            // Create individual email data for each recipient with their specific attachments
-            const emailsData = this.emailPreviews.filter((_, index) => !this.excludedEmailIndices.has(index)).map((preview, index) => {
-                // Get attachments specifically for this email
-                const emailAttachments = this.getAttachmentsForEmail(preview.recipient, index);
-
-                console.log(`DEBUG: Email ${index + 1} - Recipient: ${preview.recipient._rowNumber}, Preview attachments: ${preview.attachments.length}, Final attachments: ${emailAttachments.length}`);
-                console.log(`DEBUG: Email ${index + 1} - Available global attachments: [${Array.from(this.attachments.keys())}]`);
-
-                // Validate that all attachments have the required data property
-                const validAttachments = emailAttachments.filter(att => {
-                    if (!att || !att.data) {
-                        console.error(`Email ${index + 1}: Missing attachment data for ${att ? att.filename : 'unknown'}`);
-                        return false;
-                    }
-                    return true;
-                });
-
-                if (validAttachments.length !== emailAttachments.length) {
-                    console.error(`Email ${index + 1}: Some attachments are missing data. Expected ${emailAttachments.length}, got ${validAttachments.length}`);
-                    this.showStatus(`Email ${index + 1}: Some attachments are missing data and will not be sent`, 'error');
+            // Upload each attachment once; emails below refer to it by content hash
+            await this.uploadAttachmentsToServer();
+
+            // The server renders every email from the template and CSV captured when the
+            // previews were generated, so only those (not N rendered copies) are uploaded.
+            this.sentPreviewIndices = Array.from(this.emailPreviews.keys()).filter(index => !this.excludedEmailIndices.has(index));
+
+            // Previews whose attachments were edited send their own attachment list
+            const rowAttachments = {};
+            this.emailPreviews.forEach((preview, previewIndex) => {
+                if (preview.customAttachments && !this.excludedEmailIndices.has(previewIndex)) {
+                    rowAttachments[previewIndex] = preview.attachments
+                        .map(att => {
+                            const filename = att.filename || att.name;
+                            return this.getAttachmentReference(this.attachments.get(filename) || att, filename);
+                        })
+                        .filter(ref => ref.hash);
                 }
-
-                return {
-                    to: preview.to,
-                    from: preview.from,
-                    cc: preview.cc,
-                    bcc: preview.bcc,
-                    subject: preview.subject,
-                    body: preview.body,
-                    attachments: validAttachments
-                };
             });
 
-            // Use the first email's data as template for server compatibility
-            const firstEmail = this.emailPreviews[0];
-            const template = firstEmail.body || this.emailBody || '';
-            const subject = firstEmail.subject || this.emailSubject || '';
-            const fromEmail = firstEmail.from || this.fromEmail || '';
+            const mergeRequest = this.buildMergeRequest(
+                this.previewMergeSource || this.getMergeSource(),
+                Array.from(this.excludedEmailIndices),
+                rowAttachments
+            );
 
-            // Debug logging
-            console.log('DEBUG: Sending emails from preview data (filtered):', {
-                recipientsCount: this.recipients.length,
+            console.log('DEBUG: Sending merge from preview data:', {
                 previewCount: this.emailPreviews.length,
-                templateLength: template.length,
-                fromEmail: fromEmail,
-                subject: subject,
-                hasAttachments: this.attachments.size > 0,
-                attachments: Array.from(this.attachments.keys()),
+                sendingCount: this.sentPreviewIndices.length,
+                attachments: Object.keys(mergeRequest.attachmentFiles),
                 smtpServer: this.smtpServer,
                 smtpPort: this.smtpPort,
                 smtpUser: this.smtpUser
             });
 
-            // Prepare attachments data - ensure all attachments are properly formatted
-            const attachmentsData = {};
-            for (const [filename, fileData] of this.attachments) {
-                if (fileData && fileData.data) {
-                    attachmentsData[filename] = {
-                        filename: fileData.name, // ✅ Backend expects 'filename' property
-                        type: fileData.type,
-                        size: fileData.size,
-                        data: fileData.data, // Base64 data URL
-                        uploadedAt: fileData.uploadedAt
-                    };
-                } else {
-                    console.error(`Global attachment ${filename} is missing data`);
-                }
-            }
-
-            const response = await fetch('/send-emails', {
+            const response = await fetch('/api/jobs', await this.compressRequest({
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({
-                    emails: emailsData, // Send individual email data with specific attachments
-                    csvData: this.csvData,
-                    attachments: attachmentsData,
-                    // Include SMTP settings
-                    smtpServer: this.smtpServer,
-                    smtpPort: this.smtpPort,
-                    smtpUser: this.smtpUser,
-                    smtpPassword: this.smtpPassword
-                })
-            });
+                body: JSON.stringify(mergeRequest)
+            }));
 
             let result;
             try {
@@ -1272,11 +1295,17 @@ class EnvialiteApp {
                 return;
             }
 
+            // The send runs as a background job on the server; wait for it to finish
+            if (result.success && result.jobId) {
+                result = await this.waitForSendJob(result.jobId);
+            }
+
             this.setLoading(false);
 
             if (result.success) {
                 this.setLoading(false);
                 // Store results in each preview object for status display
+                this.sendBatchId = result.batchId || null;
                 this.storeSendResults(result.results); // This will only contain results for sent emails
                 this.refreshPreviewDisplay();
                 this.displayResults(result.results, result.summary);
@@ -1292,6 +1321,188 @@ class EnvialiteApp {
         }
     }
 
+    async uploadAttachmentsToServer() {
+        // The server keeps attachments keyed by content hash, so each file is uploaded only once
+        let changed = false;
+        for (const [filename, fileData] of this.attachments) {
+            if (!fileData || !fileData.data) continue;
+
+            if (fileData.hash) {
+                if (this.verifiedAttachmentHashes.has(fileData.hash)) continue;
+                const check = await fetch(`/api/attachments/${fileData.hash}`);
+                if (check.ok) {
+                    this.verifiedAttachmentHashes.add(fileData.hash);
+                    continue;
+                }
+            }
+
+            const blob = await (await fetch(fileData.data)).blob();
+            const response = await fetch('/api/attachments', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/octet-stream',
+                },
+                body: blob
+            });
+            const result = await response.json();
+            if (!result.success) {
+                throw new Error(result.error || `Could not upload ${filename}`);
+            }
+            fileData.hash = result.hash;
+            this.verifiedAttachmentHashes.add(result.hash);
+            changed = true;
+        }
+        if (changed) {
+            this.saveAttachments();
+        }
+    }
+
+    getMergeSource() {
+        // Template fields and raw CSV; the server renders each email from these
+        return {
+            fromName: this.fromName,
+            fromEmail: this.fromEmail,
+            toEmail: this.toEmail,
+            ccEmail: this.ccEmail,
+            bccEmail: this.bccEmail,
+            subject: this.emailSubject,
+            template: this.emailBody,
+            csvData: this.csvData,
+            // An imported list the table has not been edited since is sent whole from the server's copy
+            datasetId: this.contactList && this.contactList.csvData === this.csvData ? this.contactList.datasetId : null,
+            variableAttachments: this.variableAttachments,
+            attachmentDelimiter: this.attachmentDelimiter
+        };
+    }
+
+    getAttachmentReference(fileData, filename) {
+        return { filename: filename, size: fileData.size, type: fileData.type, hash: fileData.hash };
+    }
+
+    async compressRequest(options) {
+        // Large merge requests and contact lists go gzipped; the server decompresses them while parsing
+        const body = typeof options.body === 'string' ? new Blob([options.body]) : options.body;
+        if (typeof CompressionStream === 'undefined' || !(body instanceof Blob) || body.size < this.compressMinBytes) {
+            return options;
+        }
+        const compressed = await new Response(body.stream().pipeThrough(new CompressionStream('gzip'))).blob();
+        return { ...options, body: compressed, headers: { ...options.headers, 'Content-Encoding': 'gzip' } };
+    }
+
+    buildMergeRequest(source, excludedRows = [], rowAttachments = {}) {
+        // Attachments selected for all emails
+        const commonAttachments = [];
+        const selectedAttachments = document.getElementById('emailAttachments');
+        if (selectedAttachments) {
+            for (const option of selectedAttachments.options) {
+                const fileData = option.selected && option.value ? this.attachments.get(option.value) : null;
+                if (fileData && fileData.hash) {
+                    commonAttachments.push(this.getAttachmentReference(fileData, option.value));
+                }
+            }
+        }
+
+        // Every uploaded file, for resolving the attachments variable on the server
+        const attachmentFiles = {};
+        for (const [filename, fileData] of this.attachments) {
+            if (fileData && fileData.hash) {
+                attachmentFiles[filename] = this.getAttachmentReference(fileData, filename);
+            }
+        }
+
+        return {
+            ...source,
+            commonAttachments: commonAttachments,
+            attachmentFiles: attachmentFiles,
+            rowAttachments: rowAttachments,
+            excludedRows: excludedRows,
+            // Include SMTP settings
+            smtpServer: this.smtpServer,
+            smtpPort: this.smtpPort,
+            smtpUser: this.smtpUser,
+            smtpPassword: this.smtpPassword,
+            smtpWeight: this.smtpWeight,
+            smtpQuota: this.smtpQuota,
+            smtpRelays: this.smtpRelays
+        };
+    }
+
+    async waitForSendJob(jobId) {
+        // Poll the server-side send job until it finishes, showing progress meanwhile
+        localStorage.setItem('envialite_last_job', jobId);
+        while (true) {
+            const response = await fetch(`/api/jobs/${jobId}`);
+            const job = await response.json();
+            if (!response.ok || ['completed', 'failed', 'interrupted'].includes(job.status)) {
+                return job;
+            }
+            this.setSendProgress(job.processed, job.total);
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    }
+
+    async restoreLastSendJob() {
+        const jobId = localStorage.getItem('envialite_last_job');
+        if (!jobId) return;
+
+        try {
+            const response = await fetch(`/api/jobs/${jobId}`);
+            if (!response.ok) {
+                // The server was restarted or has forgotten the job
+                localStorage.removeItem('envialite_last_job');
+                return;
+            }
+            let job = await response.json();
+            if (job.status === 'interrupted') {
+                // The server stopped mid-send; its journal knows which rows are done
+                this.sendBatchId = job.batchId;
+                this.displayResults(job.results, job.summary);
+                if (!confirm(`Un envío anterior se interrumpió tras ${job.processed} de ${job.total} correos. ¿Reanudarlo ahora?`)) return;
+                this.setLoading(true);
+                job = await this.resumeSendJob(jobId);
+                this.setLoading(false);
+            }
+            if (!job.results) {
+                this.setLoading(true);
+                job = await this.waitForSendJob(jobId);
+                this.setLoading(false);
+            }
+            if (job.success && job.results) {
+                this.sendBatchId = job.batchId;
+                this.displayResults(job.results, job.summary);
+            }
+        } catch (error) {
+            this.setLoading(false);
+            console.error('Could not restore the last send job:', error);
+        }
+    }
+
+    async resumeSendJob(jobId) {
+        // The server never stores the SMTP password, so send the current settings again
+        this.getSmtpSettings();
+        const response = await fetch(`/api/jobs/${jobId}/resume`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                smtpServer: this.smtpServer,
+                smtpPort: this.smtpPort,
+                smtpUser: this.smtpUser,
+                smtpPassword: this.smtpPassword,
+                smtpWeight: this.smtpWeight,
+                smtpQuota: this.smtpQuota,
+                smtpRelays: this.smtpRelays
+            })
+        });
+        const job = await response.json();
+        if (!job.success) {
+            this.showStatus(`Error al enviar correos: ${job.error}`, 'error');
+            throw new Error(job.error);
+        }
+        return this.waitForSendJob(jobId);
+    }
+
     createModifiedCSVForSending() {
         // For now, return the original CSV data
         // The server expects the traditional format where it processes the CSV itself
@@ -1304,6 +1515,7 @@ class EnvialiteApp {
 
             // Get SMTP settings before sending
             this.getSmtpSettings();
+            await this.uploadAttachmentsToServer();
 
             // Debug logging for email sending
             console.log('Sending emails with traditional data:', {
@@ -1317,24 +1529,14 @@ class EnvialiteApp {
                 csvData: this.csvData.substring(0, 200) + '...'
             });
 
-            const response = await fetch('/send-emails', {
+            const response = await fetch('/api/jobs', await this.compressRequest({
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({
-                    template: this.template,
-                    csvData: this.csvData,
-                    subject: this.subject,
-                    fromEmail: this.fromEmail,
-                    attachments: Object.fromEntries(this.attachments),
-                    // Include SMTP settings
-                    smtpServer: this.smtpServer,
-                    smtpPort: this.smtpPort,
-                    smtpUser: this.smtpUser,
-                    smtpPassword: this.smtpPassword
-                })
-            });
+                // Template and CSV only; the server renders each email
+                body: JSON.stringify(this.buildMergeRequest(this.getMergeSource()))
+            }));
 
             let result;
             try {
@@ -1347,9 +1549,16 @@ class EnvialiteApp {
                 return;
             }
 
+            // The send runs as a background job on the server; wait for it to finish
+            if (result.success && result.jobId) {
+                result = await this.waitForSendJob(result.jobId);
+            }
+
             this.setLoading(false);
 
             if (result.success) {
+                this.sendBatchId = result.batchId || null;
+                this.sentPreviewIndices = [];
                 this.displayResults(result.results, result.summary);
                 this.showStatus(result.summary, 'success');
             } else {
@@ -1380,8 +1589,10 @@ class EnvialiteApp {
             resultDiv.className = `result-item ${result.success ? 'success' : 'error'} clickable-result`;
             resultDiv.dataset.resultIndex = index; // Add index for event handling
 
-            const statusIcon = result.success ? '✅' : '❌';
+            const statusIcon = result.skipped ? '⏭️' : result.success ? '✅' : '❌';
+            const relayText = result.relay && this.smtpRelays.length ? ` vía ${this.escapeHtml(result.relay)}` : '';
             const errorText = result.error ? `<div class="result-error">Error: ${result.error}</div>` : '';
+            const screenedText = result.success && result.screened ? `<div class="result-error">${this.describeScreened(result.screened)}</div>` : '';
 
             // Handle cases where there's no email column
             const resultIdentifier = result.email || `Row ${result._rowNumber || 'Unknown'}`;
@@ -1389,8 +1600,9 @@ class EnvialiteApp {
             resultDiv.innerHTML = `
                 <div class="result-header">
                     <div class="result-email">${statusIcon} ${resultIdentifier}</div>
-                    <div class="result-status">${result.success ? 'Enviado exitosamente' : 'Error al enviar'}</div>
+                    <div class="result-status">${result.skipped ? 'Omitido' : result.success ? 'Enviado exitosamente' : 'Error al enviar'}${relayText}</div>
                     ${errorText}
+                    ${screenedText}
                 </div>
                 <div class="result-details expandable-collapsed" style="display: none;"></div>
             `;
@@ -1399,15 +1611,29 @@ class EnvialiteApp {
         });
     }
 
-    showMessageDetails(index) {
+    describeScreened(notes) {
+        // Addresses the server took out of a sent email, or sent to again
+        const removed = notes.filter(note => note.removed).map(note => {
+            const reason = note.reason === 'duplicate' ? `duplicado del correo ${note.row + 1}` :
+                note.reason === 'invalid' ? 'inválido' : 'suprimido';
+            return `${this.escapeHtml(note.address)} (${reason})`;
+        });
+        const flagged = notes.filter(note => !note.removed)
+            .map(note => `${this.escapeHtml(note.address)} (también en el correo ${note.row + 1})`);
+        return [removed.length ? `No enviado a: ${removed.join(', ')}` : '', ...flagged].filter(Boolean).join('; ');
+    }
+
+    async showMessageDetails(index) {
         const result = this.sendResults[index];
         let message = null;
 
+        await this.fetchMessageDetails(result);
+
         if (result && result.message) {
             message = result.message;
-        } else if (this.emailPreviews[index]) {
+        } else if (this.getPreviewForResult(result)) {
             // Use the preview data as fallback
-            const preview = this.emailPreviews[index];
+            const preview = this.getPreviewForResult(result);
             message = {
                 to: preview.to,
                 from: preview.from,
@@ -1519,8 +1745,8 @@ class EnvialiteApp {
         document.getElementById('messageModal').style.display = 'none';
     }
 
-    toggleResultDetails(cardElement, index) {
-        const detailsDiv = cardElement.querySelector('.result-details');
+    async toggleResultDetails(cardElement, index) {
+        let detailsDiv = cardElement.querySelector('.result-details');
         const isExpanded = detailsDiv && detailsDiv.style.display !== 'none';
 
         // Collapse if already expanded
@@ -1535,16 +1761,17 @@ class EnvialiteApp {
         let message = null;
 
         console.log('toggleResultDetails for index:', index);
-        console.log('sendResults:', JSON.stringify(this.sendResults, null, 2));
         console.log('emailPreviews length:', this.emailPreviews ? this.emailPreviews.length : 0);
 
+        await this.fetchMessageDetails(result);
+
         // Try to find message data from various sources
         if (result && result.message) {
             message = result.message;
             console.log('✅ Using message from server result:', message);
-        } else if (this.emailPreviews && this.emailPreviews[index]) {
+        } else if (this.getPreviewForResult(result)) {
             // Use the preview data as fallback
-            const preview = this.emailPreviews[index];
+            const preview = this.getPreviewForResult(result);
             message = {
                 to: preview.to,
                 from: preview.from,
@@ -1688,6 +1915,9 @@ class EnvialiteApp {
             smtpPort: parseInt(document.getElementById('smtpPort').value) || 587,
             smtpUser: document.getElementById('smtpUser').value,
             smtpPassword: document.getElementById('smtpPassword').value,
+            smtpWeight: parseInt(document.getElementById('smtpWeight').value) || 1,
+            smtpQuota: parseInt(document.getElementById('smtpQuota').value) || 0,
+            smtpRelays: this.getSmtpRelays(),
             fromEmail: document.getElementById('fromEmail').value,
             fromName: document.getElementById('fromName').value,
             timestamp: new Date().toISOString()
@@ -1706,6 +1936,9 @@ class EnvialiteApp {
         document.getElementById('smtpPort').value = '587';
         document.getElementById('smtpUser').value = '';
         document.getElementById('smtpPassword').value = '';
+        document.getElementById('smtpWeight').value = '';
+        document.getElementById('smtpQuota').value = '';
+        this.renderSmtpRelays([]);
         document.getElementById('fromEmail').value = '';
         document.getElementById('fromName').value = '';
         document.getElementById('defaultSubject').value = '';
@@ -1715,6 +1948,9 @@ class EnvialiteApp {
         this.smtpPort = 587;
         this.smtpUser = '';
         this.smtpPassword = '';
+        this.smtpWeight = 1;
+        this.smtpQuota = 0;
+        this.smtpRelays = [];
         this.fromEmail = '';
         this.fromName = '';
         this.subject = '';
@@ -1815,15 +2051,8 @@ class EnvialiteApp {
         try {
             this.getSmtpSettings();
 
-            // If server is in demo mode, simulate a successful connection.
-            if (this.isServerInDemoMode) {
-                const testResult = document.getElementById('smtpTestResult');
-                testResult.innerHTML = '<span style="color: #28a745;">El modo demo no prueba conexiones</span>';
-                this.showStatus('La conexión SMTP está en modo demo.', 'success');
-                return;
-            }
-
-            if (!this.smtpServer || !this.smtpUser || !this.smtpPassword) {
+            // In Demo Mode the server logs in to its local SMTP stand-in instead
+            if (!this.isServerInDemoMode && (!this.smtpServer || !this.smtpUser || !this.smtpPassword)) {
                 this.showStatus('Por favor rellena toda la configuración SMTP', 'error');
                 return;
             }
@@ -1860,7 +2089,7 @@ class EnvialiteApp {
                 this.smtpConnectionTested = true;
                 this.smtpConnectionValid = true;
 
-                testResult.innerHTML = '<span style="color: #28a745;">✅ Conexión exitosa!</span>';
+                testResult.innerHTML = `<span style="color: #28a745;">${result.demo ? '✅ Conectado al servidor SMTP de demostración' : '✅ Conexión exitosa!'}</span>`;
                 this.showStatus('Prueba de conexión SMTP pasada', 'success');
             } else {
                 // Mark as tested but invalid
@@ -1884,11 +2113,11 @@ class EnvialiteApp {
     async _testSmtpConnectionInternal() {
         this.getSmtpSettings();
 
-        if (!this.smtpServer || !this.smtpUser || !this.smtpPassword) {
+        if (!this.isServerInDemoMode && (!this.smtpServer || !this.smtpUser || !this.smtpPassword)) {
             return { success: false, error: 'Por favor rellena toda la configuración SMTP.' };
         }
 
-        // If in server demo mode, the test endpoint will simulate success, so we just call it.
+        // In server demo mode, the test endpoint logs in to the local SMTP stand-in.
 
         try {
             const response = await fetch('/test-smtp', {
@@ -1921,6 +2150,9 @@ class EnvialiteApp {
     }
 
     validateSmtpSettings() {
+        // Demo sends go to the server's local SMTP stand-in, which needs no account
+        if (this.isServerInDemoMode) return true;
+
         // Get current SMTP settings
         const smtpServerField = document.getElementById('smtpServer');
         const smtpUserField = document.getElementById('smtpUser');
@@ -1966,16 +2198,66 @@ class EnvialiteApp {
         this.smtpPassword = smtpPasswordField ? smtpPasswordField.value : '';
         this.fromEmail = fromEmailField ? fromEmailField.value : '';
         this.fromName = fromNameField ? fromNameField.value : '';
+        const smtpWeightField = document.getElementById('smtpWeight');
+        const smtpQuotaField = document.getElementById('smtpQuota');
+        this.smtpWeight = smtpWeightField ? parseInt(smtpWeightField.value) || 1 : 1;
+        this.smtpQuota = smtpQuotaField ? parseInt(smtpQuotaField.value) || 0 : 0;
+        this.smtpRelays = this.getSmtpRelays();
         this.subject = defaultSubjectField ? defaultSubjectField.value : '';
     }
 
+    getSmtpRelays() {
+        // Read the additional SMTP accounts; rows without a server are ignored
+        const relays = [];
+        document.querySelectorAll('#smtpRelaysList .smtp-relay-row').forEach(row => {
+            const field = name => row.querySelector(`[data-field="${name}"]`).value.trim();
+            if (!field('smtpServer')) return;
+            relays.push({
+                smtpServer: field('smtpServer'),
+                smtpPort: parseInt(field('smtpPort')) || 587,
+                smtpUser: field('smtpUser'),
+                smtpPassword: field('smtpPassword'),
+                weight: parseInt(field('weight')) || 1,
+                quota: parseInt(field('quota')) || 0
+            });
+        });
+        return relays;
+    }
+
+    addSmtpRelay(relay = {}) {
+        const list = document.getElementById('smtpRelaysList');
+        if (!list) return;
+
+        const row = document.createElement('div');
+        row.className = 'form-row smtp-relay-row';
+        row.innerHTML = `
+            <div class="form-group"><input type="text" data-field="smtpServer" placeholder="Servidor SMTP" /></div>
+            <div class="form-group"><input type="number" data-field="smtpPort" placeholder="Puerto" /></div>
+            <div class="form-group"><input type="text" data-field="smtpUser" placeholder="Usuario" /></div>
+            <div class="form-group"><input type="password" data-field="smtpPassword" placeholder="Contraseña" /></div>
+            <div class="form-group"><input type="number" data-field="weight" min="1" placeholder="Peso" /></div>
+            <div class="form-group"><input type="number" data-field="quota" min="0" placeholder="Cuota diaria" /></div>
+            <button class="btn-small btn-delete" title="Quitar cuenta" onclick="this.closest('.smtp-relay-row').remove()">🗑️</button>
+        `;
+        // Assign values rather than interpolating them, so saved passwords need no escaping
+        row.querySelector('[data-field="smtpServer"]').value = relay.smtpServer || '';
+        row.querySelector('[data-field="smtpPort"]').value = relay.smtpPort || 587;
+        row.querySelector('[data-field="smtpUser"]').value = relay.smtpUser || '';
+        row.querySelector('[data-field="smtpPassword"]').value = relay.smtpPassword || '';
+        row.querySelector('[data-field="weight"]').value = relay.weight || '';
+        row.querySelector('[data-field="quota"]').value = relay.quota || '';
+        list.appendChild(row);
+    }
+
+    renderSmtpRelays(relays) {
+        const list = document.getElementById('smtpRelaysList');
+        if (!list) return;
+        list.innerHTML = '';
+        relays.forEach(relay => this.addSmtpRelay(relay));
+    }
+
     // Attachment Management Methods
     async uploadFiles() {
-        if (this.isServerInDemoMode) {
-            this.showStatus('Subida de archivos deshabilitada en Modo Demo.', 'error');
-            return;
-        }
-
         const fileInput = document.getElementById('fileUpload');
         const files = fileInput.files;
 
@@ -2491,16 +2773,93 @@ class EnvialiteApp {
         }
     }
 
+    parseDelimited(text, delimiter) {
+        // RFC 4180: quoted cells may contain the delimiter, line breaks and doubled quotes
+        const rows = [];
+        let row = [];
+        let cell = '';
+        let quoted = false;
+        text = text.trim();
+        for (let i = 0; i < text.length; i++) {
+            const char = text[i];
+            if (quoted) {
+                if (char !== '"') {
+                    cell += char;
+                } else if (text[i + 1] === '"') {
+                    cell += '"';
+                    i++;
+                } else {
+                    quoted = false;
+                }
+            } else if (char === '"' && !cell.trim()) {
+                quoted = true;
+                cell = '';
+            } else if (char === delimiter) {
+                row.push(cell.trim());
+                cell = '';
+            } else if (char === '\n') {
+                row.push(cell.trim());
+                rows.push(row);
+                row = [];
+                cell = '';
+            } else if (char !== '\r') {
+                cell += char;
+            }
+        }
+        if (text) {
+            row.push(cell.trim());
+            rows.push(row);
+        }
+        return rows;
+    }
+
+    formatCSVRow(values) {
+        return values.map(value => /[",\r\n]/.test(value) ? `"${value.replace(/"/g, '""')}"` : value).join(',');
+    }
+
+    async importContactList(file) {
+        // The server parses the file; the table shows the first rows and sends refer to the whole list
+        const response = await fetch('/api/contacts', await this.compressRequest({
+            method: 'POST',
+            headers: {
+                'Content-Type': 'text/csv',
+            },
+            body: file
+        }));
+        const summary = await response.json();
+        if (!summary.success) {
+            throw new Error(summary.error || 'No se pudo importar el archivo');
+        }
+        const page = await (await fetch(`/api/contacts/${summary.datasetId}?limit=${this.contactTableRows}`)).json();
+        if (!page.success) {
+            throw new Error(page.error || 'No se pudo importar el archivo');
+        }
+
+        this.populateTableFromArray([page.headers, ...page.data]);
+        this.updateCSVFromTable();
+        this.contactList = { datasetId: summary.datasetId, rows: summary.rows, csvData: this.csvData };
+
+        const list = summary;
+        const shownRows = page.data.length;
+        let message = `Importadas ${list.rows} filas y ${list.headers.length} columnas`;
+        if (shownRows < list.rows) {
+            message += ` (se muestran las primeras ${shownRows}; se enviarán todas mientras no se edite la tabla)`;
+        }
+        if (list.errorCount > 0) {
+            message += `. ${list.errorCount} filas omitidas (línea ${list.errors[0].line}: ${list.errors[0].error})`;
+        }
+        this.showStatus(message, list.errorCount > 0 ? 'error' : 'success');
+    }
+
     updateTableFromCSV() {
         if (!this.csvData || this.csvData.trim() === '') {
             return;
         }
 
         try {
-            const rows = this.csvData.trim().split('\n').filter(row => row.trim());
-            if (rows.length === 0) return;
+            const dataRows = this.parseDelimited(this.csvData, ',').filter(row => row.some(cell => cell));
+            if (dataRows.length === 0) return;
 
-            const dataRows = rows.map(row => row.split(',').map(cell => cell.trim()));
             this.populateTableFromArray(dataRows);
         } catch (error) {
             console.error('Error actualizando tabla desde CSV:', error);
@@ -2523,7 +2882,7 @@ class EnvialiteApp {
         const rows = [];
 
         // Add headers as first row
-        rows.push(headers.join(','));
+        rows.push(this.formatCSVRow(headers));
 
         // Add data rows
         Array.from(tbody.rows).forEach(row => {
@@ -2531,7 +2890,7 @@ class EnvialiteApp {
                 const cellTextSpan = cell.querySelector('.cell-text');
                 return cellTextSpan ? cellTextSpan.textContent.trim() : cell.textContent.trim();
             });
-            rows.push(rowData.join(','));
+            rows.push(this.formatCSVRow(rowData));
         });
 
         this.csvData = rows.join('\n');
@@ -2756,6 +3115,10 @@ function clearAccountSettings() {
     window.envialiteApp.clearAccountSettings();
 }
 
+function addSmtpRelay() {
+    window.envialiteApp.addSmtpRelay();
+}
+
 function clearTemplateData() {
     window.envialiteApp.clearTemplateData();
 }
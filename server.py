@@ -4,32 +4,48 @@ Minimal email merge application using Python's built-in HTTP server.
 Single-user, no database, stores everything client-side.
 Now includes the GUI launcher logic.
 """
+import io
 import os
+import errno
+import gzip
 import re
 import sys
+import mmap
 import time
 import json
+import queue
 import base64
-import locale
-import smtplib
+import bisect
+import codecs
+import itertools
+import random
+import hashlib
+import tempfile
 import argparse
-import platform
-import webbrowser
-import subprocess
+import threading
+import socket
 import socketserver
 import http.server
 import urllib.parse
 
-from email import encoders
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.utils import formataddr, parseaddr
+from array import array
+from collections import Counter, OrderedDict, deque
+from email.header import Header
+from email.utils import (encode_rfc2231, formataddr, formatdate, getaddresses, make_msgid, parseaddr,
+                         parsedate_to_datetime)
+# Modules only some paths need (smtplib, sqlite3, csv, multiprocessing, the launcher's
+# tkinter/webbrowser/subprocess...) are imported where they are used, so a server that never
+# sends, or the launcher, does not pay for them at startup. See `benchmark.py --startup`.
+
+try:
+    import brotli  # Optional: adds br variants of the static assets
+except ImportError:
+    brotli = None
 
 # --- CRITICAL FIX FOR WINDOWS EMOJI/UNICODE PRINTING ---
 # On Windows, sys.stdout.encoding is often 'cp1252', which cannot handle emojis.
 # This forces the terminal output to use UTF-8 if running on Windows.
-if platform.system() == "Windows":
+if sys.platform == "win32":
     try:
         sys.stdout.reconfigure(encoding='utf-8')
         sys.stderr.reconfigure(encoding='utf-8')
@@ -42,6 +58,79 @@ if platform.system() == "Windows":
 # Configuration
 DEMO_MODE = False # Default to live mode
 
+# Demo Mode's local SMTP stand-in (overridable from the command line)
+DEMO_SMTP_LATENCY_MS = 20          # Delay before each of its replies, like a nearby provider
+DEMO_SMTP_RATE = 0.0               # Messages/second it accepts before answering 451 (0: never throttles)
+DEMO_SMTP_FAILURE_RATE = 0.0       # Fraction of recipients it refuses with 550
+DEMO_SAVE_DIR = None               # Directory it writes each message to as an .eml file (None: discarded)
+
+# Delivery engine settings (overridable from the command line)
+SMTP_POOL_SIZE = 4                 # Authenticated connections (and worker threads) per merge
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100  # Recycle a connection after this many messages
+SMTP_RETRY_ATTEMPTS = 4            # Extra attempts for transient failures (dropped connection, 4xx reply)
+SMTP_BACKOFF_BASE = 0.5            # Seconds; retry n waits about BASE * 2**n (jittered)
+SMTP_BACKOFF_MAX = 30.0            # Upper bound on a single retry delay
+SMTP_THROTTLE_CODES = (421, 450, 451, 452)  # Replies that mean "slow down"
+SMTP_INITIAL_RATE = 20.0           # Messages/second a provider starts at; doubles each second until throttled
+SMTP_MAX_RATE = 500.0              # Ceiling for providers without an explicit --rate-limit
+SMTP_MIN_RATE = 0.2                # Floor the adaptive rate never drops below
+SMTP_RATE_LIMITS = {}              # smtpServer -> messages/second ceiling ('*' for the default)
+SMTP_TIMEOUT = 60                  # Socket timeout in seconds for SMTP connections
+SMTP_DIRECT_WRITE_BYTES = 64 * 1024  # DATA chunks at least this big are written without copying
+SMTP_SESSION_IDLE = 300            # Seconds a logged-in connection stays warm for the next request (0 disables)
+SMTP_SESSION_KEEPALIVE = 30        # Seconds between NOOPs that keep a warm connection open and catch dropped ones
+SMTP_SESSION_LIMIT = 16            # Warm connections kept over all accounts; the least recently used go first
+SEND_HISTORY_LIMIT = 10            # Finished sends whose message details stay available
+SMTP_MAX_RECIPIENTS = 100          # Envelope recipients per shared-content transaction (1 sends each row alone)
+RENDER_PROCESSES = 0               # Processes building messages (0: built on the SMTP worker threads)
+RENDER_BATCH = 32                  # Messages handed to a render process per task
+RELAY_QUOTA_WINDOW = 24 * 3600     # Seconds a relay's quota (recipients it may send to) is counted over
+RELAY_HEALTH_DECAY = 0.2           # Weight of the newest send in a relay's latency and error-rate averages
+RELAY_MIN_SHARE = 0.02             # Part of its weight a failing relay keeps, so it is still probed and can recover
+DUPLICATE_RECIPIENTS = 'flag'      # An address already mailed earlier in a send: 'skip' it, 'flag' it or 'send' anyway
+
+# HTTP server core (overridable from the command line)
+HTTP_SERVER_MODE = 'threaded'      # 'threaded' (worker pool + keep-alive) or 'single' (one request at a time)
+HTTP_WORKERS = 16                  # Worker threads handling connections in threaded mode
+HTTP_QUEUE_DEPTH = 64              # Accepted connections waiting for a worker before new ones get a 503
+HTTP_KEEPALIVE_TIMEOUT = 5         # Seconds an idle keep-alive connection may hold a worker
+HTTP_REQUEST_TIMEOUT = 60          # Seconds a client may stall mid-request before it is dropped
+HTTP_INFLATED_BODY_LIMIT = 2 * 1024 ** 3  # Bytes a compressed request body may expand to before it is refused
+
+# GUI launcher
+LAUNCHER_POLL_MS = 20              # How often the launcher checks whether a starting server is ready
+LAUNCHER_START_TIMEOUT = 30        # Seconds a server sub-process has to start listening
+
+# Send journal (SQLite, WAL mode) used to resume sends cut short by a crash or restart
+JOURNAL_PATH = os.path.join(os.path.expanduser('~'), '.envialite', 'journal.sqlite3')
+JOURNAL_RETENTION_DAYS = 30        # Finished sends older than this are pruned at startup
+
+# Suppression list: addresses never mailed (unsubscribes, bounces), one per line
+SUPPRESSION_PATH = os.path.join(os.path.expanduser('~'), '.envialite', 'suppressed.txt')
+
+# Web assets loaded (and precompressed) into memory at startup
+STATIC_ASSETS = ('index.html', 'index-ES.html', 'script.js', 'script-ES.js', 'styles.css')
+
+# Attachment store (uploaded once, referenced by SHA-256 from each email)
+ATTACHMENT_DIR = os.path.join(tempfile.gettempdir(), 'envialite-attachments')
+ATTACHMENT_CACHE_BYTES = 256 * 1024 * 1024  # Encoded MIME payloads kept in memory
+ATTACHMENT_STREAM_BYTES = 4 * 1024 * 1024   # Files at least this big are encoded to disk once and sent from there
+ATTACHMENT_STREAM_CHUNK = 57 * 1024          # Bytes encoded per write: a whole number of 76-char base64 lines
+
+# Contact lists (CSV/TSV uploads parsed on the server into a columnar store)
+CONTACT_LIST_CACHE = 4             # Parsed lists kept in memory; others are re-parsed from the stored upload
+CONTACT_SNIFF_BYTES = 64 * 1024    # Sample the delimiter and quoting are detected from
+CONTACT_DELIMITERS = ',;\t|'       # Delimiters the sniffer may pick
+CONTACT_ERROR_LIMIT = 100          # Parse errors reported per upload (all of them are counted)
+CONTACT_DISTINCT_LIMIT = 10000     # Distinct values counted per column before the count is capped
+CONTACT_PAGE_LIMIT = 5000          # Rows returned per GET /api/contacts/<id> request
+
+# Merge previews (rendered on the server a window at a time)
+PREVIEW_CACHE = 8                  # Previews kept in memory, most recently used first
+PREVIEW_CACHE_ROWS = 500           # Rendered rows kept per preview
+PREVIEW_PAGE_LIMIT = 200           # Rows rendered per preview request
+PREVIEW_CHECK_LIMIT = 100          # Row numbers listed per check (all of them are counted)
+
 # --- PyInstaller Resource Handling ---
 
 def resource_path(relative_path):
@@ -61,6 +150,9 @@ def launch_gui():
     """
     import tkinter as tk
     from tkinter import ttk
+    import locale
+    import subprocess
+    import webbrowser
 
     GUI_LANGUAGES = {
         'en': {
@@ -72,6 +164,8 @@ def launch_gui():
             'status_stopped': "Server stopped",
             'status_starting': "Server starting on port {port}...",
             'status_running': "Server running successfully on port {port}",
+            'status_running_timed': "Server running on port {port} (ready in {ms} ms)",
+            'status_error_start_timeout': "Server did not start listening within {seconds} seconds.",
             'status_error_port_range': "Error: Port must be between 1024 and 65535.",
             'status_error_already_running': "Error: Server is already running.",
             'status_error_start_failed': "Server failed to start (Code: {code}).\nERROR: {error_msg}",
@@ -84,6 +178,8 @@ def launch_gui():
             'status_open_browser_first': "Start the server before opening the browser.",
             'web_app_lang_label': "Web App Language:",
             'gui_lang_label': "Launcher Language:",
+            'threaded_checkbox': "Concurrent Server (handle requests in parallel)",
+            'in_process_checkbox': "Run server inside the launcher (faster start)",
         },
         'es': {
             'title': "Lanzador Envía",
@@ -94,6 +190,8 @@ def launch_gui():
             'status_stopped': "Servidor detenido",
             'status_starting': "Iniciando servidor en el puerto {port}...",
             'status_running': "Servidor iniciado correctamente en el puerto {port}",
+            'status_running_timed': "Servidor en ejecución en el puerto {port} (listo en {ms} ms)",
+            'status_error_start_timeout': "El servidor no empezó a escuchar en {seconds} segundos.",
             'status_error_port_range': "Error: El puerto debe estar entre 1024 y 65535.",
             'status_error_already_running': "Error: El servidor ya está en ejecución.",
             'status_error_start_failed': "El servidor no pudo iniciar (Código: {code}).\nERROR: {error_msg}",
@@ -106,6 +204,8 @@ def launch_gui():
             'status_open_browser_first': "Inicie el servidor antes de abrir el navegador.",
             'web_app_lang_label': "Idioma de la Aplicación Web:",
             'gui_lang_label': "Idioma del Lanzador:",
+            'threaded_checkbox': "Servidor Concurrente (atender peticiones en paralelo)",
+            'in_process_checkbox': "Ejecutar el servidor dentro del lanzador (inicio más rápido)",
         }
     }
 
@@ -119,7 +219,7 @@ def launch_gui():
             self.web_app_lang_var = tk.StringVar(value=initial_gui_lang)
 
             self.root.title(self._('title'))
-            self.root.geometry("400x300") 
+            self.root.geometry("400x360") 
             self.root.resizable(False, False)
 
             # sys.executable points to the current running binary/interpreter
@@ -127,8 +227,12 @@ def launch_gui():
 
             self.port_var = tk.StringVar(value="8000")
             self.demo_var = tk.BooleanVar(value=False)
+            self.threaded_var = tk.BooleanVar(value=True)
+            self.in_process_var = tk.BooleanVar(value=True)
             self.status_var = tk.StringVar(value=self._('status_stopped'))
             self.server_process = None 
+            self.server_thread = None  # ServerThread when running inside the launcher
+            self.start_time = None
 
             self.create_gui()
             self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -143,6 +247,8 @@ def launch_gui():
             self.root.title(self._('title'))
             self.port_label.config(text=self._('port_label'))
             self.demo_check.config(text=self._('demo_checkbox'))
+            self.threaded_check.config(text=self._('threaded_checkbox'))
+            self.in_process_check.config(text=self._('in_process_checkbox'))
             self.start_btn.config(text=self._('start_btn'))
             self.stop_btn.config(text=self._('stop_btn'))
             # Update status if it's a default message
@@ -176,6 +282,16 @@ def launch_gui():
             self.demo_check.grid(row=row_idx, column=0, columnspan=2, sticky=tk.W, pady=(10, 0))
             row_idx += 1
 
+            # Concurrent Server Checkbox
+            self.threaded_check = ttk.Checkbutton(frame, text=self._('threaded_checkbox'), variable=self.threaded_var)
+            self.threaded_check.grid(row=row_idx, column=0, columnspan=2, sticky=tk.W, pady=(5, 0))
+            row_idx += 1
+
+            # In-process Server Checkbox
+            self.in_process_check = ttk.Checkbutton(frame, text=self._('in_process_checkbox'), variable=self.in_process_var)
+            self.in_process_check.grid(row=row_idx, column=0, columnspan=2, sticky=tk.W, pady=(5, 0))
+            row_idx += 1
+
             # Web App Language Radio Buttons
             self.web_app_lang_label = ttk.Label(frame, text=self._('web_app_lang_label'))
             self.web_app_lang_label.grid(row=row_idx, column=0, sticky=tk.W, pady=(10, 0))
@@ -229,9 +345,16 @@ def launch_gui():
                 self.start_btn.config(state=tk.NORMAL)
                 self.stop_btn.config(state=tk.DISABLED)
 
+        def is_running(self):
+            return bool(self.server_process or self.server_thread)
+
         def start_server(self):
-            """Start the server by launching a new instance of the executable without the --gui flag"""
-            if self.server_process:
+            """
+            Start the server, either on a thread of this process or by launching a
+            new instance of the executable without the --gui flag, then wait for
+            it to accept connections without blocking the window.
+            """
+            if self.is_running():
                 self.status_var.set(self._('status_error_already_running'))
                 return
 
@@ -241,56 +364,46 @@ def launch_gui():
                     self.status_var.set(self._('status_error_port_range'))
                     return
                 
-                # CRITICAL: Launch the same executable. Arguments are port and optional --demo.
-                # Since the new logic checks for 'frozen' status, this sub-process will run the server
-                # because it will have arguments (the port number).
-                command = [self.executable_path, str(port)]
+                arguments = [str(port)]
                 if self.demo_var.get():
-                    command.append('--demo')
+                    arguments.append('--demo')
+                arguments.extend(['--server-mode', 'threaded' if self.threaded_var.get() else 'single'])
                 
                 self.status_var.set(self._('status_starting').format(port=port))
+                self.start_btn.config(state=tk.DISABLED)
+                self.start_time = time.perf_counter()
+
+                if self.in_process_var.get():
+                    self.server_thread = ServerThread(arguments).start()
+                    self.root.after(LAUNCHER_POLL_MS, self.check_thread_ready, port)
+                    return
+
+                # CRITICAL: Launch the same executable. Arguments are port and optional --demo.
+                # Since the new logic checks for 'frozen' status, this sub-process will run the server
+                # because it will have arguments (the port number).
+                command = [self.executable_path] + arguments
+                if not hasattr(sys, '_MEIPASS'):
+                    command.insert(1, os.path.abspath(__file__))  # Interpreter needs the script
                 
                 creationflags = 0
                 if sys.platform == 'win32':
                     # Prevents a new console window and detaches the process
                     creationflags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
 
-                # Launch the subprocess, keeping pipes open
+                # Output goes nowhere so a chatty server cannot fill an unread pipe; stderr is
+                # kept for the failure message and is only written to when something goes wrong
                 self.server_process = subprocess.Popen(
                     command,
-                    stdout=subprocess.PIPE, 
+                    stdout=subprocess.DEVNULL,
                     stderr=subprocess.PIPE,
                     creationflags=creationflags,
                     close_fds=False
                 )
-                
-                time.sleep(0.05) # Give the OS time to start the process
-                poll_result = self.server_process.poll()
-                
-                if poll_result is not None: # Process died immediately
-                    # Read any output from the pipes
-                    stdout, stderr = self.server_process.communicate(timeout=0.5)
-                    self.server_process = None
-                    
-                    error_message = self._('status_error_start_failed').format(code=poll_result, error_msg="")
-                    if stderr:
-                        error_message = self._('status_error_start_failed').format(code=poll_result, error_msg=stderr.decode('utf-8', errors='ignore').strip())
-                    else:
-                         error_message = self._('status_error_start_failed_generic')                    
-                    
-                    print(f"Server failed: {error_message}")
-                    self.status_var.set(error_message[:200]) 
-                    self.update_button_state(False)
-                    return
-
-                self.status_var.set(self._('status_running').format(port=port))
-                # Construct URL with selected web app language
-                web_app_lang_prefix = f"{self.web_app_lang_var.get()}/" if self.web_app_lang_var.get() != 'en' else ''
-                self.url_text.set(f'http://localhost:{port}/{web_app_lang_prefix}')
-                self.update_button_state(True)
+                self.root.after(LAUNCHER_POLL_MS, self.check_process_ready, port)
 
             except ValueError:
                 self.status_var.set(self._('status_error_port_range'))
+                self.update_button_state(False)
             except Exception as e:
                 self.status_var.set(self._('status_fatal_error').format(error_msg=e))
                 if self.server_process:
@@ -298,9 +411,75 @@ def launch_gui():
                     self.server_process = None
                 self.update_button_state(False)
 
+        def check_thread_ready(self, port):
+            """Waits for the in-process server's ready event, polled from the Tk loop."""
+            server = self.server_thread
+            if server is None:
+                return
+            if not server.ready.is_set():
+                self.root.after(LAUNCHER_POLL_MS, self.check_thread_ready, port)
+                return
+            if server.error is not None:
+                self.server_thread = None
+                error = server.error
+                if isinstance(error, OSError) and error.errno == errno.EADDRINUSE:
+                    error = f"Port {port} is already in use."
+                self.start_failed(self._('status_error_start_failed').format(code='-', error_msg=error))
+                return
+            self.server_ready(port, server.startup_seconds)
+
+        def check_process_ready(self, port):
+            """Polls the server sub-process until its port accepts connections or it exits."""
+            process = self.server_process
+            if process is None:
+                return
+            poll_result = process.poll()
+            if poll_result is not None: # Process died during startup
+                stderr = process.stderr.read() if process.stderr else b''
+                self.server_process = None
+                if stderr:
+                    error_message = self._('status_error_start_failed').format(code=poll_result, error_msg=stderr.decode('utf-8', errors='ignore').strip())
+                else:
+                    error_message = self._('status_error_start_failed_generic')
+                self.start_failed(error_message)
+                return
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            except OSError:
+                if time.perf_counter() - self.start_time > LAUNCHER_START_TIMEOUT:
+                    self.stop_server()
+                    self.start_failed(self._('status_error_start_timeout').format(seconds=LAUNCHER_START_TIMEOUT))
+                else:
+                    self.root.after(LAUNCHER_POLL_MS, self.check_process_ready, port)
+                return
+            self.server_ready(port, time.perf_counter() - self.start_time)
+
+        def server_ready(self, port, seconds):
+            print(f"Server ready in {seconds * 1000:.0f} ms")
+            self.status_var.set(self._('status_running_timed').format(port=port, ms=round(seconds * 1000)))
+            # Construct URL with selected web app language
+            web_app_lang_prefix = f"{self.web_app_lang_var.get()}/" if self.web_app_lang_var.get() != 'en' else ''
+            self.url_text.set(f'http://localhost:{port}/{web_app_lang_prefix}')
+            self.update_button_state(True)
+
+        def start_failed(self, error_message):
+            print(f"Server failed: {error_message}")
+            self.status_var.set(str(error_message)[:200])
+            self.update_button_state(False)
+
         def stop_server(self):
-            """Stop the server by terminating the process"""
-            if self.server_process:
+            """Stop the server: a graceful shutdown in-process, otherwise terminate the process"""
+            if self.server_thread:
+                self.status_var.set(self._('status_stopping'))
+                try:
+                    self.server_thread.shutdown()
+                except Exception as e:
+                    self.status_var.set(self._('status_error_stopping').format(error_msg=e))
+                    return
+                self.server_thread = None
+                self.status_var.set(self._('status_stopped_clean'))
+                self.update_button_state(False)
+            elif self.server_process:
                 self.status_var.set(self._('status_stopping'))
                 try:
                     self.server_process.terminate()
@@ -326,7 +505,7 @@ def launch_gui():
 
         def open_browser(self, event=None):
             """Open browser"""
-            if self.server_process:
+            if self.is_running():
                 webbrowser.open(self.url_text.get())
             else:
                 self.status_var.set(self._('status_open_browser_first'))
@@ -337,305 +516,3953 @@ def launch_gui():
     root.mainloop()
 
 
-# --- Original Server Handler Class ---
+# --- Metrics ---
+# Counters and per-phase timings for the send path, exposed at /api/metrics in
+# the Prometheus text format. Recording costs a perf_counter() pair and a lock
+# per event, so they stay on in production.
 
-class EmailMergeHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        # The directory needs to be set to the location of the assets (index.html, etc.)
-        # This is correctly handled by resource_path in the do_GET method now, so we remove the directory kwarg
-        # and simply rely on the default behavior for SimpleHTTPRequestHandler setup.
-        super().__init__(*args, **kwargs)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PHASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_HELP = {
+    'envialite_http_requests_total': ('counter', 'HTTP requests answered, by method and status.'),
+    'envialite_http_rejected_total': ('counter', 'Connections answered 503 because the request queue was full.'),
+    'envialite_messages_built_total': ('counter', 'MIME messages built.'),
+    'envialite_messages_sent_total': ('counter', 'Messages accepted by the SMTP server.'),
+    'envialite_messages_failed_total': ('counter', 'Messages that could not be delivered.'),
+    'envialite_messages_skipped_total': ('counter', 'Messages not sent because screening left them without recipients.'),
+    'envialite_message_bytes_total': ('counter', 'Bytes of message data accepted by the SMTP server.'),
+    'envialite_smtp_replies_total': ('counter', 'Final SMTP reply codes of send attempts.'),
+    'envialite_smtp_connections_opened_total': ('counter', 'SMTP connections opened (connect, TLS, login).'),
+    'envialite_smtp_connections_reused_total': ('counter', 'Sends that reused an already open SMTP connection.'),
+    'envialite_smtp_retries_total': ('counter', 'Send attempts retried after a transient failure.'),
+    'envialite_smtp_throttled_total': ('counter', 'Times a rate limiter slowed down on a throttling reply.'),
+}
+PHASES_HELP = ('Seconds spent per phase: parse (request JSON), render (merge rows), build (message bytes), '
+               'connect (SMTP login), smtp (transaction), respond (reply).')
 
-    def end_headers(self):
-        # Enable CORS for all responses
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        super().end_headers()
 
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.end_headers()
+class PhaseTimings:
+    """Total seconds and event count per phase for one send job."""
+    def __init__(self):
+        self._phases = {}
+        self._lock = threading.Lock()
 
-    def do_POST(self):
-        # This endpoint is now handled by do_GET
-        if self.path == '/api/status':
-            self.send_error(405, "Method Not Allowed")
-            return
-        if self.path == '/send-emails':
+    def add(self, phase, seconds):
+        with self._lock:
+            totals = self._phases.setdefault(phase, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {phase: {'seconds': round(seconds, 6), 'count': count}
+                    for phase, (seconds, count) in self._phases.items()}
+
+
+class PhaseTimer:
+    """Context manager recording the time spent in a `with` block."""
+    __slots__ = ('metrics', 'phase', 'timings', 'started')
+
+    def __init__(self, metrics, phase, timings):
+        self.metrics = metrics
+        self.phase = phase
+        self.timings = timings
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.phase, time.perf_counter() - self.started, self.timings)
+
+
+class Metrics:
+    """Process-wide counters, phase histograms and gauges."""
+    def __init__(self):
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # phase -> [bucket counts..., sum, count]
+        self._gauges = {}      # name -> (help, function returning {labels: value})
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, phase, seconds, timings=None):
+        index = bisect.bisect_left(PHASE_BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = self._histograms[phase] = [0] * len(PHASE_BUCKETS) + [0.0, 0]
+            if index < len(PHASE_BUCKETS):
+                histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        if timings is not None:
+            timings.add(phase, seconds)
+
+    def time(self, phase, timings=None):
+        """`with metrics.time('build', job.timings):` records the block's duration."""
+        return PhaseTimer(self, phase, timings)
+
+    def gauge(self, name, help_text, function):
+        """Register a gauge read at scrape time; `function` returns {((label, value), ...): value}."""
+        self._gauges[name] = (help_text, function)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = {phase: list(values) for phase, values in self._histograms.items()}
+        lines = []
+        described = set()
+        for (name, labels), value in counters:
+            if name not in described:
+                kind, help_text = METRIC_HELP.get(name, ('counter', name))
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+                described.add(name)
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        if histograms:
+            name = 'envialite_phase_seconds'
+            lines += [f'# HELP {name} {PHASES_HELP}', f'# TYPE {name} histogram']
+            for phase in sorted(histograms):
+                values = histograms[phase]
+                cumulative = 0
+                for bound, count in zip(PHASE_BUCKETS, values):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels((("phase", phase), ("le", repr(bound))))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels((("phase", phase), ("le", "+Inf")))} {values[-1]}')
+                lines.append(f'{name}_sum{format_labels((("phase", phase),))} {values[-2]:.6f}')
+                lines.append(f'{name}_count{format_labels((("phase", phase),))} {values[-1]}')
+        for name, (help_text, function) in sorted(self._gauges.items()):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+            for labels, value in sorted(function().items()):
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    """Render ((name, value), ...) as a Prometheus label set."""
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def render_job_timings(job):
+    """One job's phase breakdown in the Prometheus text format (/api/metrics?job=<id>)."""
+    lines = ['# HELP envialite_job_phase_seconds_total Seconds a send job spent per phase.',
+             '# TYPE envialite_job_phase_seconds_total counter']
+    timings = job.timings.as_dict()
+    for phase in sorted(timings):
+        lines.append(f'envialite_job_phase_seconds_total{format_labels((("job", job.id), ("phase", phase)))} '
+                     f'{timings[phase]["seconds"]}')
+    lines += ['# HELP envialite_job_phase_events_total Events a send job recorded per phase.',
+              '# TYPE envialite_job_phase_events_total counter']
+    for phase in sorted(timings):
+        lines.append(f'envialite_job_phase_events_total{format_labels((("job", job.id), ("phase", phase)))} '
+                     f'{timings[phase]["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+_delivery_queues = set()  # Task queues of running DeliveryEngines, for the queue-depth gauge
+
+metrics.gauge('envialite_delivery_queue_depth', 'Emails waiting for a delivery worker.',
+              lambda: {(): sum(tasks.qsize() for tasks in list(_delivery_queues))})
+metrics.gauge('envialite_send_jobs', 'Send jobs held in memory, by status.',
+              lambda: {(('status', status),): count
+                       for status, count in Counter(job.status for job in list_jobs()).items()})
+metrics.gauge('envialite_smtp_rate_limit', 'Current messages/second allowed per SMTP server and account.',
+              lambda: {(('server', server), ('user', user)): round(limiter.rate, 3)
+                       for (server, user), limiter in list(_rate_limiters.items())})
+metrics.gauge('envialite_smtp_warm_sessions', 'Logged-in SMTP connections kept warm between requests.',
+              lambda: {(): len(smtp_sessions)})
+
+
+# --- Static Asset Cache ---
+
+def content_type_for(filename):
+    """Content-Type header for a web asset."""
+    if filename.endswith('.html'):
+        return 'text/html; charset=utf-8'
+    if filename.endswith('.css'):
+        return 'text/css'
+    if filename.endswith('.js'):
+        return 'application/javascript; charset=utf-8'
+    return 'application/octet-stream'
+
+
+def accepted_encodings(header):
+    """Content codings an Accept-Encoding header allows (q > 0)."""
+    accepted = set()
+    for item in (header or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
             try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                data = json.loads(post_data.decode('utf-8'))
-
-                results = []
-
-                if DEMO_MODE:
-                    emails_to_send = data.get('emails', [])
-                    for email_data in emails_to_send:
-                        if 'results' not in locals():
-                            results = []
-                        results.append({'email': email_data.get('to'), 'success': True, 'error': None})
-                    summary = f"Simulated sending {len(results)} emails (Demo Mode)."
-                    self.send_json_response({'success': True, 'summary': summary, 'results': results})
-                    return
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
 
-                # Live Mode Logic
-                smtp_server = data.get('smtpServer')
-                smtp_port = data.get('smtpPort')
-                smtp_user = data.get('smtpUser')
-                smtp_password = data.get('smtpPassword')
-                emails_to_send = data.get('emails', [])
 
-                if not all([smtp_server, smtp_port, smtp_user, smtp_password]):
-                    self.send_json_response({'success': False, 'error': 'Missing SMTP credentials.'})
-                    return
+class StaticAsset:
+    """One web asset held in memory with its compressed variants."""
+    __slots__ = ('content_type', 'variants', 'etag', 'last_modified', 'mtime')
 
-                with smtplib.SMTP(smtp_server, smtp_port) as server:
-                    server.starttls()
-                    server.login(smtp_user, smtp_password)
-
-                    for email_data in emails_to_send:
-                        recipient_email = email_data.get('to')
-                        try:
-                            msg = MIMEMultipart()
-                            from_header = email_data.get('from')
-                            name, email = parseaddr(from_header)
-                            msg['From'] = formataddr((name, email))
-
-                            # Handle multiple recipients in To, Cc, and Bcc fields
-                            if recipient_email:
-                                to_addrs = [addr.strip() for addr in re.split(r'[;,]', recipient_email) if addr.strip()]
-                                msg['To'] = ', '.join(to_addrs)
-
-                            msg['Subject'] = email_data.get('subject')
-
-                            if email_data.get('cc'):
-                                cc_addrs = [addr.strip() for addr in re.split(r'[;,]', email_data.get('cc')) if addr.strip()]
-                                msg['Cc'] = ', '.join(cc_addrs)
-
-                            if email_data.get('bcc'):
-                                bcc_addrs = [addr.strip() for addr in re.split(r'[;,]', email_data.get('bcc')) if addr.strip()]
-                                msg['Bcc'] = ', '.join(bcc_addrs)
-
-                            # Convert plain text newlines to HTML line breaks
-                            body_content = email_data.get('body', '')
-                            msg.attach(MIMEText(body_content.replace('\n', '<br>'), 'html'))
-
-                            for attachment in email_data.get('attachments', []):
-                                part = MIMEBase('application', 'octet-stream')
-                                _, b64_data = attachment['data'].split(',', 1)
-                                part.set_payload(base64.b64decode(b64_data))
-                                encoders.encode_base64(part)
-                                part.add_header('Content-Disposition', f'attachment; filename="{attachment["filename"]}"')
-                                msg.attach(part)
-
-                            server.send_message(msg)
-                            results.append({'email': recipient_email, 'success': True, 'error': None, 'message': email_data})
-                        except Exception as e:
-                            results.append({'email': recipient_email, 'success': False, 'error': str(e), 'message': email_data})
-                
-                summary = f"Processed {len(results)} emails."
-                self.send_json_response({'success': True, 'summary': summary, 'results': results})
+    def __init__(self, filename, body, mtime):
+        self.content_type = content_type_for(filename)
+        self.mtime = int(mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.etag = '"%s"' % hashlib.sha256(body).hexdigest()[:20]
+        self.variants = {'identity': body}
+        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body)
+            if len(compressed) < len(body):
+                self.variants['br'] = compressed
 
-            except Exception as e:
-                self.send_json_response({'success': False, 'error': f'Server error: {str(e)}'})
+    def negotiate(self, accept_encoding):
+        """Pick the smallest variant the client accepts: (coding, body)."""
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ('br', 'gzip'):
+            if coding in self.variants and (coding in accepted or '*' in accepted):
+                return coding, self.variants[coding]
+        return 'identity', self.variants['identity']
 
-        elif self.path == '/test-smtp':
+    def etag_for(self, coding):
+        # Each representation gets its own validator, as caches store them separately
+        return self.etag if coding == 'identity' else self.etag[:-1] + '-' + coding + '"'
+
+    def not_modified(self, if_none_match, if_modified_since):
+        """True if the client's cached copy (by ETag, else by date) is current."""
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            known = {self.etag_for(coding) for coding in self.variants}
+            return '*' in tags or any(tag.removeprefix('W/') in known for tag in tags)
+        if if_modified_since:
             try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                data = json.loads(post_data.decode('utf-8'))
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.mtime
+            except (TypeError, ValueError):
+                return False
+        return False
 
-                smtp_server = data.get('smtpServer')
-                smtp_port = data.get('smtpPort')
-                smtp_user = data.get('smtpUser')
-                smtp_password = data.get('smtpPassword')
 
-                if not all([smtp_server, smtp_port, smtp_user, smtp_password]):
-                    self.send_json_response({'success': False, 'error': 'Missing SMTP credentials.'})
-                    return
+class StaticAssetCache:
+    """
+    Web assets read from disk (or the PyInstaller bundle) once and served from
+    memory. Only the named `filenames` are served, so the cache is bounded and
+    no request path ever reaches the filesystem. Restart the server to pick up
+    edits to the files.
+    """
 
-                # If in demo mode, simulate success without actually connecting
-                if DEMO_MODE:
-                    self.send_json_response({'success': True, 'message': 'Connection successful (Demo Mode)'})
-                    self.send_json_response({'success': False, 'error': 'Missing SMTP credentials.'})
-                    return
+    def __init__(self, filenames=STATIC_ASSETS):
+        self.filenames = frozenset(filenames)
+        self._assets = {}
+        self._lock = threading.Lock()
 
-                try:
-                    with smtplib.SMTP(smtp_server, smtp_port) as server:
-                        server.starttls()
-                        server.login(smtp_user, smtp_password)
-                    self.send_json_response({'success': True})
-                except smtplib.SMTPAuthenticationError:
-                    self.send_json_response({'success': False, 'error': 'Authentication failed. Check username/password.'})
-                except Exception as e:
-                    self.send_json_response({'success': False, 'error': str(e)})
+    def preload(self):
+        """Load and compress the assets so first requests cost no disk I/O."""
+        return sum(1 for filename in sorted(self.filenames) if self.get(filename) is not None)
 
-            except json.JSONDecodeError:
-                self.send_json_response({'success': False, 'error': 'Invalid JSON format.'})
-            except Exception as e:
-                self.send_json_response({'success': False, 'error': f'Internal server error: {str(e)}'})
-        else:
-            self.send_error(404)
+    def get(self, filename):
+        """The cached StaticAsset for `filename`, loading it on first use; None if it is not an asset or missing."""
+        asset = self._assets.get(filename)
+        if asset is not None:
+            return asset
+        if filename not in self.filenames:
+            return None
+        full_path = resource_path(filename)
+        if not os.path.isfile(full_path):
+            return None
+        with open(full_path, 'rb') as file:
+            body = file.read()
+        asset = StaticAsset(filename, body, os.path.getmtime(full_path))
+        with self._lock:
+            return self._assets.setdefault(filename, asset)
 
-    def do_GET(self):
-        """Handle file requests (index.html, styles.css, script.js) with language support"""
-        if self.path == '/favicon.ico':
-            self.send_response(204)  # No Content
-            self.end_headers()
-            return
 
-        # Add a new endpoint to get the server status
-        if self.path == '/api/status':
-            self.send_json_response({'demoMode': DEMO_MODE})
-            return
+static_assets = StaticAssetCache()
 
-        # Parse the URL path
-        requested_path = self.path.lstrip('/')
 
-        # Determine language from path prefix (e.g., /es/index.html)
-        # This logic is used when the GUI launcher constructs a URL like http://localhost:8000/es/
-        current_lang = 'en' # Default language
-        lang_prefix_match = re.match(r'^(en|es)/', requested_path)
-        if lang_prefix_match:
-            current_lang = lang_prefix_match.group(1)
-            requested_path = requested_path[len(lang_prefix_match.group(0)):].lstrip('/') # Remove the language prefix
+# --- Attachment Store ---
 
+class EncodedAttachment:
+    """
+    The base64 MIME payload of a large stored attachment, kept in a file
+    beside it and written to the SMTP socket with sendfile() (zero-copy on
+    plain connections; TLS sends it in small blocks), so a message never
+    holds it in memory. len() is its size. Base64 lines never start with
+    '.', so it needs no dot-stuffing.
+    """
+    __slots__ = ('path', 'size')
 
-        # Determine which file to serve based on the requested path and language
-        path_to_serve = 'index.html'  # Default fallback
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
 
-        if not requested_path or requested_path == '/':
-            # Serve language-specific index file
-            if current_lang == 'es':
-                path_to_serve = 'index-ES.html'  # Spanish file
-            elif current_lang == 'en':
-                path_to_serve = 'index.html'
-            else:
-                path_to_serve = 'index.html'     # English file (fallback)
-        elif requested_path == 'script.js':
-            # Serve language-specific script file
-            if current_lang == 'es':
-                path_to_serve = 'script-ES.js'  # Spanish script
-            elif current_lang == 'en':
-                path_to_serve = 'script.js'
-            else:
-                path_to_serve = 'script.js'    # English script (fallback)
-        else:
-            # For other resources (CSS, etc.), serve as-is
-            path_to_serve = requested_path
+    def __len__(self):
+        return self.size
 
-        # If the request is for a specific language's index/script, ensure it's served
-        if requested_path == 'index.html' and current_lang == 'es':
-            path_to_serve = 'index-ES.html'
+    def send_to(self, sock):
+        with open(self.path, 'rb') as f:
+            sent = sock.sendfile(f)
+        if sent != self.size:
+            raise OSError(f'Sent {sent} of {self.size} bytes of {os.path.basename(self.path)}')
 
-        if requested_path == 'script.js' and current_lang == 'es':
-            path_to_serve = 'script-ES.js'
 
-        try:
-            full_path = resource_path(path_to_serve)
+class AttachmentStore:
+    """
+    Content-addressed attachment files on disk, keyed by SHA-256.
+    The base64 MIME payload of each file is encoded once and cached (LRU,
+    bounded by `cache_bytes`) so it can be reused for every recipient;
+    files of `stream_bytes` or more are encoded as they are sent instead.
+    """
+    CHUNK_SIZE = 64 * 1024
 
-            if not os.path.exists(full_path):
-                self.send_error(404, f'File Not Found: {path_to_serve}')
-                return
+    def __init__(self, directory, cache_bytes=ATTACHMENT_CACHE_BYTES, stream_bytes=ATTACHMENT_STREAM_BYTES):
+        self.directory = directory
+        self.cache_bytes = cache_bytes
+        self.stream_bytes = stream_bytes
+        self._encoded = OrderedDict()
+        self._encoded_size = 0
+        self._lock = threading.Lock()
 
-            self.send_response(200)
+    def path(self, digest):
+        if not re.fullmatch(r'[0-9a-f]{64}', digest or ''):
+            raise KeyError(digest)
+        return os.path.join(self.directory, digest)
 
-            # Determine MIME type
-            if path_to_serve.endswith('.html'):
-                self.send_header('Content-type', 'text/html; charset=utf-8')
-            elif path_to_serve.endswith('.css'):
-                self.send_header('Content-type', 'text/css')
-            elif path_to_serve.endswith('.js'):
-                self.send_header('Content-type', 'application/javascript; charset=utf-8')
+    def size(self, digest):
+        """Size in bytes of a stored attachment, or None if it is not stored."""
+        try:
+            return os.path.getsize(self.path(digest))
+        except (KeyError, OSError):
+            return None
+
+    def put(self, stream, length):
+        """
+        Copy `length` bytes from `stream` (None: all of it, as for a decompressed
+        body) into the store. Returns (digest, size).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while length is None or size < length:
+                    chunk = stream.read(self.CHUNK_SIZE if length is None else min(self.CHUNK_SIZE, length - size))
+                    if not chunk and length is None:
+                        break
+                    if not chunk:
+                        raise ValueError('Upload ended before Content-Length bytes were received.')
+                    sha.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            digest = sha.hexdigest()
+            if os.path.exists(self.path(digest)):
+                os.remove(tmp_path)
             else:
-                self.send_header('Content-type', 'application/octet-stream')
+                os.replace(tmp_path, self.path(digest))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest, size
 
-            self.end_headers()
+    def encoded(self, digest):
+        """
+        The base64 MIME payload of a stored attachment: 76-char lines, CRLF
+        line endings. Bytes, or an EncodedAttachment for a large file.
+        """
+        with self._lock:
+            payload = self._encoded.get(digest)
+            if payload is not None:
+                self._encoded.move_to_end(digest)
+                return payload
 
-            with open(full_path, 'rb') as file:
-                self.wfile.write(file.read())
+        try:
+            with open(self.path(digest), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    payload = b''
+                elif size >= self.stream_bytes:
+                    return self._encoded_file(digest, f)
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        payload = base64.encodebytes(data).replace(b'\n', b'\r\n')
+        except (KeyError, FileNotFoundError):
+            raise ValueError(f'Attachment {digest} has not been uploaded.')
 
-        except Exception as e:
-            print(f"Error serving file {path_to_serve}: {e}")
-            self.send_error(500, 'Internal Server Error')
+        with self._lock:
+            if digest not in self._encoded and len(payload) <= self.cache_bytes:
+                self._encoded[digest] = payload
+                self._encoded_size += len(payload)
+                while self._encoded_size > self.cache_bytes:
+                    _, evicted = self._encoded.popitem(last=False)
+                    self._encoded_size -= len(evicted)
+        return payload
 
-    def get_language_preference(self):
-        """Get language preference from URL parameter or browser settings"""
-        # Check for ?lang= parameter first (overrides everything)
-        parsed_url = urllib.parse.urlparse(self.path)
-        query_params = urllib.parse.parse_qs(parsed_url.query)
-        if 'lang' in query_params:
-            lang = query_params['lang'][0].lower()
-            if lang in ['en', 'es']:
-                return lang
+    def _encoded_file(self, digest, source):
+        """The EncodedAttachment of a large file, encoding it to `<digest>.b64` on first use."""
+        path = self.path(digest) + '.b64'
+        try:
+            return EncodedAttachment(path, os.path.getsize(path))
+        except FileNotFoundError:
+            pass
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as tmp, \
+                    mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for start in range(0, len(data), ATTACHMENT_STREAM_CHUNK):
+                    tmp.write(base64.encodebytes(data[start:start + ATTACHMENT_STREAM_CHUNK]).replace(b'\n', b'\r\n'))
+            os.replace(tmp_path, path)  # Concurrent encoders write identical files
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return EncodedAttachment(path, os.path.getsize(path))
 
-        # Check Accept-Language header for auto-detection
-        accept_lang = self.headers.get('Accept-Language', '')
-        if accept_lang:
-            # Parse Accept-Language header (e.g., "es-ES,en-US;q=0.9")
-            # Simple approach: look for 'es' first
-            if accept_lang.lower().startswith('es'):
-                return 'es'
+attachment_store = AttachmentStore(ATTACHMENT_DIR)
 
-        # Default to English
-        return 'en'
 
-    def send_json_response(self, data):
-        """Helper to send a JSON response"""
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        response_json = json.dumps(data)
-        self.wfile.write(response_json.encode('utf-8'))
+# --- SMTP Delivery Engine ---
 
-    def log_message(self, format, *args):
-        # Override to reduce noise - only log errors
-        if "POST" in format or "error" in format.lower():
-            super().log_message(format, *args)
+ADDRESS_SEPARATORS = re.compile(r'[;,]')
+BASE64_TEXT = re.compile(r'[A-Za-z0-9+/]*={0,2}')
 
 
-# --- Main Application Entry Point ---
+def split_addresses(value):
+    """Split a To/Cc/Bcc field on commas and semicolons."""
+    return [addr.strip() for addr in ADDRESS_SEPARATORS.split(value or '') if addr.strip()]
 
-def main():
-    parser = argparse.ArgumentParser(description='Envialite Email Merge Server and Launcher.')
-    parser.add_argument('-g', '--gui', action='store_true', help='Launch the graphical user interface.')
-    parser.add_argument('-d', '--demo', action='store_true', help='Enable demo mode (safe testing).')
-    parser.add_argument('port', type=int, nargs='?', default=8000, help='Port number to run the server on.')
-    
-    # Check if running as a frozen PyInstaller executable AND if it's the main entry point (no arguments).
-    # This is the core logic for the hybrid approach.
-    is_frozen_main_entry = hasattr(sys, '_MEIPASS') and len(sys.argv) == 1
 
-    # 1. FROZEN MODE (PyInstaller Binary, primary launch) -> Always launch GUI
-    if is_frozen_main_entry:
-        print("Launching GUI from frozen binary...")
-        launch_gui()
-        return
+def header_line(name, value, international=False):
+    """One header as CRLF-terminated bytes; non-ASCII values are RFC 2047 encoded unless SMTPUTF8 is used."""
+    if '\n' in value or '\r' in value:
+        value = ' '.join(value.splitlines())  # No header injection through merge data
+    if international:
+        return f'{name}: {value}\r\n'.encode('utf-8')
+    if value.isascii() and len(name) + len(value) < 76:
+        return f'{name}: {value}\r\n'.encode('ascii')
+    charset = 'us-ascii' if value.isascii() else 'utf-8'
+    encoded = Header(value, charset, header_name=name).encode(linesep='\r\n')
+    return f'{name}: {encoded}\r\n'.encode('ascii')
 
-    # 2. DEVELOPMENT MODE (python server.py) OR SUB-PROCESS MODE (launched by GUI)
-    
-    # Parse arguments for either server (default) or explicit GUI launch
-    args = parser.parse_args()
 
-    # Set DEMO_MODE from arguments before it's used
-    global DEMO_MODE
-    DEMO_MODE = args.demo
+def address_header(name, addresses, international=False):
+    """To/Cc header; display names with non-ASCII characters are encoded, addresses left alone."""
+    value = ', '.join(addresses)
+    if not international and not value.isascii():
+        value = ', '.join(formataddr(pair) for pair in getaddresses(addresses))
+    return header_line(name, value, international)
 
-    port = args.port
 
-    print(f"Starting Envialite server on http://localhost:{port}")
-    print(f"DEMO_MODE: {'ON' if DEMO_MODE else 'OFF'}")
-    if DEMO_MODE:
-        print("✅ Demo mode: No emails will actually be sent")
+def wrap_base64(encoded):
+    """Re-wrap base64 text to 76-char CRLF lines without decoding it."""
+    encoded = ''.join(encoded.split())
+    if len(encoded) % 4 or not BASE64_TEXT.fullmatch(encoded):
+        raise ValueError('Attachment data is not valid base64.')
+    data = encoded.encode('ascii')
+    return b''.join(data[start:start + 76] + b'\r\n' for start in range(0, len(data), 76))
+
+
+def attachment_header(boundary, filename):
+    """Delimiter and headers of an attachment part."""
+    if filename.isascii():
+        disposition = 'attachment; filename="%s"' % filename.replace('\\', '\\\\').replace('"', '\\"')
     else:
-        print("⚠️  Live mode: Emails will be sent for real")
+        disposition = "attachment; filename*=%s" % encode_rfc2231(filename, 'utf-8')
+    return (f'--{boundary}\r\n'
+            'Content-Type: application/octet-stream\r\n'
+            'MIME-Version: 1.0\r\n'
+            'Content-Transfer-Encoding: base64\r\n'
+            f'Content-Disposition: {disposition}\r\n\r\n').encode('utf-8')
+
+
+class StoredAttachment:
+    """Stands in for an attachment store entry in a message built by a render process."""
+    __slots__ = ('digest',)
+
+    def __init__(self, digest):
+        self.digest = digest
+
+
+class OutgoingMessage:
+    """
+    A message ready for DATA: its envelope and a list of payload chunks that
+    are already CRLF-terminated and dot-stuffed. Attachment chunks are the
+    attachment store's cached bytes, shared by every message that carries them,
+    or EncodedAttachments for large files.
+    """
+    __slots__ = ('sender', 'recipients', 'message_id', 'chunks', 'size', 'mail_options')
+
+    def __init__(self, sender, recipients, message_id, chunks, mail_options):
+        self.sender = sender
+        self.recipients = recipients
+        self.message_id = message_id
+        self.chunks = chunks
+        self.size = sum(len(chunk) for chunk in chunks if not isinstance(chunk, StoredAttachment))
+        self.mail_options = mail_options
+
+    def resolve_attachments(self):
+        """Swap StoredAttachment placeholders for the store's encoded bytes."""
+        self.chunks = [attachment_store.encoded(chunk.digest) if isinstance(chunk, StoredAttachment) else chunk
+                       for chunk in self.chunks]
+        self.size = sum(len(chunk) for chunk in self.chunks)
+
+
+class MessageBuilder:
+    """
+    Writes merge messages straight to bytes (multipart/mixed with an HTML body,
+    as the web app has always sent). The parts that repeat across a merge are
+    prepared once: the boundary, the formatted From header and the encoded
+    attachments. Per recipient only the variable headers and the body are
+    written, so the cost of a message barely depends on its attachments.
+    """
+    SENDER_CACHE_SIZE = 1024
+
+    def __init__(self, share_attachments=True):
+        import uuid
+        self.boundary = '=' * 15 + uuid.uuid4().hex + '=='
+        # False in render processes: stored attachments are left as placeholders for the parent to fill
+        self.share_attachments = share_attachments
+        self._senders = {}
+
+    def _sender(self, from_value):
+        """(From header value, envelope address, Message-ID domain), parsed once per distinct sender."""
+        sender = self._senders.get(from_value)
+        if sender is None:
+            name, address = parseaddr(from_value)
+            sender = (formataddr((name, address)), address, address.rpartition('@')[2] or 'localhost')
+            if len(self._senders) >= self.SENDER_CACHE_SIZE:
+                self._senders.clear()
+            self._senders[from_value] = sender
+        return sender
+
+    def build(self, email_data):
+        """Build the OutgoingMessage for one entry of a send batch."""
+        from_header, sender, domain = self._sender(email_data.get('from') or '')
+        to_addrs = split_addresses(email_data.get('to'))
+        cc_addrs = split_addresses(email_data.get('cc'))
+        bcc_addrs = split_addresses(email_data.get('bcc'))
+        # A screened row may withhold some of its To/Cc from the envelope; the headers still show them all
+        envelope = email_data.get('envelope')
+        visible = to_addrs + cc_addrs if envelope is None else envelope
+        recipients = [addr for _, addr in getaddresses(visible + bcc_addrs) if addr]
+        international = not all(addr.isascii() for addr in [sender] + recipients)
+        message_id = make_msgid(domain=domain)
+
+        # Body: newlines become <br>, as in the web app's preview
+        body = email_data.get('body') or ''
+        html = body.replace('\r\n', '\n').replace('\r', '\n').replace('\n', '<br>')
+        if html.isascii() and len(html) <= 998:
+            charset, encoding = 'us-ascii', '7bit'
+            body_bytes = (('.' + html) if html.startswith('.') else html).encode('ascii') + b'\r\n'
+        else:
+            charset = 'us-ascii' if html.isascii() else 'utf-8'
+            encoding = 'base64'
+            body_bytes = base64.encodebytes(html.encode(charset)).replace(b'\n', b'\r\n')
+        boundary = self.boundary
+        if boundary.encode('ascii') in body_bytes:
+            import uuid
+            boundary = '=' * 15 + uuid.uuid4().hex + '=='
+
+        head = [
+            f'Content-Type: multipart/mixed; boundary="{boundary}"\r\nMIME-Version: 1.0\r\n'.encode('ascii'),
+            header_line('From', from_header, international),
+            f'Message-ID: {message_id}\r\n'.encode('ascii'),
+        ]
+        if to_addrs:
+            head.append(address_header('To', to_addrs, international))
+        head.append(header_line('Subject', email_data.get('subject') or '', international))
+        if cc_addrs:
+            head.append(address_header('Cc', cc_addrs, international))
+        head.append((f'\r\n--{boundary}\r\n'
+                     f'Content-Type: text/html; charset="{charset}"\r\n'
+                     'MIME-Version: 1.0\r\n'
+                     f'Content-Transfer-Encoding: {encoding}\r\n\r\n').encode('ascii'))
+        chunks = [b''.join(head), body_bytes]
+
+        for attachment in email_data.get('attachments', []):
+            chunks.append(attachment_header(boundary, attachment.get('filename') or 'attachment'))
+            if attachment.get('hash'):
+                # Uploaded once to /api/attachments; the encoded bytes are cached and shared
+                if self.share_attachments:
+                    chunks.append(attachment_store.encoded(attachment['hash']))
+                else:
+                    chunks.append(StoredAttachment(attachment['hash']))
+            else:
+                chunks.append(wrap_base64(attachment['data'].split(',', 1)[1]))
+        chunks.append(f'--{boundary}--\r\n'.encode('ascii'))
+
+        mail_options = ('SMTPUTF8', 'BODY=8BITMIME') if international else ()
+        return OutgoingMessage(sender, recipients, message_id, chunks, mail_options)
+
+
+_process_builder = None  # The MessageBuilder of a render process
 
+
+def build_batch(batch):
+    """
+    Render-process task: build each (index, email_data) of `batch`. Returns
+    (messages, seconds), with the exception in place of a message that failed.
+    """
+    global _process_builder
+    if _process_builder is None:
+        _process_builder = MessageBuilder(share_attachments=False)
+    started = time.perf_counter()
+    messages = []
+    for _, email_data in batch:
+        try:
+            messages.append(_process_builder.build(email_data))
+        except Exception as e:
+            messages.append(e)
+    return messages, time.perf_counter() - started
+
+
+class RenderPool:
+    """
+    Builds messages in worker processes, so MIME generation (header encoding,
+    body HTML and base64) runs on every core instead of contending with the
+    SMTP threads for the GIL. Only the per-recipient parts cross the process
+    boundary: stored attachments come back as placeholders and are filled
+    with the encoded bytes this process already caches. At most two batches
+    per process are in flight, so rendering cannot run far ahead of delivery.
+    """
+    def __init__(self, processes, batch_size=None):
+        self.processes = processes
+        self.batch_size = batch_size or RENDER_BATCH
+        import multiprocessing
+        self._context = multiprocessing.get_context('spawn')  # Safe with the server's threads; works frozen
+        self._executor = self._start()
+        self._lock = threading.Lock()
+
+    def _start(self):
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(self.processes, mp_context=self._context)
+
+    def build(self, items, timings=None):
+        """Yield (rows, email_data, message) for each (rows, email_data) of `items`, in order."""
+        in_flight = deque()
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                in_flight.append(self._submit(batch))
+                batch = []
+                while len(in_flight) >= self.processes * 2:
+                    yield from self._collect(*in_flight.popleft(), timings)
+        if batch:
+            in_flight.append(self._submit(batch))
+        while in_flight:
+            yield from self._collect(*in_flight.popleft(), timings)
+
+    def _submit(self, batch):
+        from concurrent.futures.process import BrokenProcessPool
+        with self._lock:
+            executor = self._executor
+        try:
+            return batch, executor.submit(build_batch, batch)
+        except BrokenProcessPool:
+            return batch, None
+
+    def _collect(self, batch, future, timings):
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            if future is None:
+                raise BrokenProcessPool('render pool unavailable')
+            messages, seconds = future.result()
+        except BrokenProcessPool:
+            # A render process died: restart the pool and build this batch here
+            self._restart()
+            messages, seconds = build_batch(batch)
+        per_message = seconds / len(batch)
+        for (rows, email_data), message in zip(batch, messages):
+            metrics.observe('build', per_message, timings)
+            if isinstance(message, OutgoingMessage):
+                message.resolve_attachments()
+            yield rows, email_data, message
+
+    def _restart(self):
+        with self._lock:
+            old, self._executor = self._executor, self._start()
+        old.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+render_pool = None  # RenderPool, started by main() when --render-processes is set
+
+
+def smtp_data(smtp, chunks):
+    """
+    DATA for a payload that is already CRLF-terminated and dot-stuffed (SMTP.data
+    would copy and regex the whole message twice). Large chunks are written as
+    they are; small ones are coalesced so a message costs few writes. An
+    EncodedAttachment is sent from its file.
+    """
+    import smtplib
+    code, reply = smtp.docmd('data')
+    if code != 354:
+        raise smtplib.SMTPDataError(code, reply)
+    pending = []
+    for chunk in chunks:
+        if isinstance(chunk, EncodedAttachment):
+            if pending:
+                smtp.send(b''.join(pending))
+                pending = []
+            chunk.send_to(smtp.sock)
+        elif len(chunk) >= SMTP_DIRECT_WRITE_BYTES:
+            if pending:
+                smtp.send(b''.join(pending))
+                pending = []
+            smtp.send(chunk)
+        else:
+            pending.append(chunk)
+    pending.append(b'.\r\n')
+    smtp.send(b''.join(pending))
+    return smtp.getreply()
+
+
+def smtp_transaction(smtp, message, recipients=None):
+    """
+    Run MAIL/RCPT/DATA for an OutgoingMessage, to `recipients` if given rather
+    than all of the message's. Mirrors SMTP.sendmail but also returns the
+    final reply code. Returns (code, refused) where refused maps recipient ->
+    (code, reply).
+    """
+    import smtplib
+    sender = message.sender
+    recipients = message.recipients if recipients is None else recipients
+    smtp.ehlo_or_helo_if_needed()
+    options = list(message.mail_options)  # SMTP.mail() checks SMTPUTF8 support itself
+    if smtp.does_esmtp and smtp.has_extn('size'):
+        options.append(f'size={message.size}')
+
+    code, reply = smtp.mail(sender, options)
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, reply, sender)
+
+    refused = {}
+    for recipient in recipients:
+        code, reply = smtp.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, reply)
+        if code == 421:
+            smtp.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(recipients):
+        smtp.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, reply = smtp_data(smtp, message.chunks)
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            smtp.rset()
+        raise smtplib.SMTPDataError(code, reply)
+    return code, refused
+
+
+def smtp_error_code(error):
+    """Best-effort SMTP reply code for a failed send (None for non-SMTP errors)."""
+    import smtplib
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        return next(iter(error.recipients.values()))[0]
+    return None
+
+
+def is_connection_lost(error):
+    """True if `error` means the SMTP connection is unusable and should be replaced."""
+    import smtplib
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421  # Service not available, closing channel
+    # Plain socket errors (SMTPException is itself an OSError subclass)
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class PooledConnection:
+    """An authenticated SMTP connection plus the number of messages it has carried."""
+    __slots__ = ('smtp', 'sent')
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.sent = 0
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+
+
+class SMTPSessionCache:
+    """
+    Logged-in SMTP connections kept warm between requests, so a send right
+    after /test-smtp (or another send) skips the TCP, TLS and AUTH round
+    trips. Sessions are filed under the server, port, user and security mode
+    plus a keyed hash of the password, so one is only handed to a request
+    that could have logged in itself. A maintenance thread sends NOOP to each
+    session every SMTP_SESSION_KEEPALIVE seconds, dropping those that fail,
+    and closes sessions unused for SMTP_SESSION_IDLE seconds.
+    """
+    def __init__(self, idle=None, keepalive=None, limit=None):
+        self.idle = SMTP_SESSION_IDLE if idle is None else idle
+        self.keepalive = keepalive or SMTP_SESSION_KEEPALIVE
+        self.limit = SMTP_SESSION_LIMIT if limit is None else limit
+        self._secret = os.urandom(16)
+        self._sessions = OrderedDict()  # (key, id) -> [conn, parked at, last NOOP], least recently parked first
+        self._changed = threading.Condition()
+        self._thread = None
+
+    def key(self, host, port, user, password, security):
+        digest = hashlib.blake2b((password or '').encode('utf-8'), key=self._secret, digest_size=16).digest()
+        return ((host or '').strip().lower(), int(port), user or '', security or 'starttls', digest)
+
+    def __len__(self):
+        with self._changed:
+            return len(self._sessions)
+
+    def take(self, key):
+        """A warm connection for `key` that still answers NOOP, or None."""
+        while True:
+            with self._changed:
+                entry = next((entry for (session_key, _), entry in reversed(self._sessions.items())
+                              if session_key == key), None)
+                if entry is None:
+                    return None
+                del self._sessions[(key, id(entry[0]))]
+            if self._alive(entry[0]):
+                return entry[0]
+
+    def put(self, key, conn):
+        """Keep `conn` warm for the next request; closes it instead if caching is off."""
+        if not self.idle or not self.limit:
+            conn.close()
+            return
+        now = time.monotonic()
+        evicted = []
+        with self._changed:
+            self._sessions[(key, id(conn))] = [conn, now, now]
+            while len(self._sessions) > self.limit:
+                evicted.append(self._sessions.popitem(last=False)[1][0])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._maintain, name='smtp-sessions', daemon=True)
+                self._thread.start()
+            self._changed.notify_all()
+        for old in evicted:
+            old.close()
+
+    def clear(self):
+        """Log out of every warm connection."""
+        with self._changed:
+            sessions, self._sessions = list(self._sessions.values()), OrderedDict()
+        for conn, _, _ in sessions:
+            conn.close()
+
+    @staticmethod
+    def _alive(conn):
+        try:
+            return conn.smtp.noop()[0] == 250
+        except Exception:
+            conn.smtp.close()
+            return False
+
+    def _maintain(self):
+        while True:
+            with self._changed:
+                # Sleep until the next session is due for a NOOP or has been idle too long
+                deadlines = [min(parked + self.idle, checked + self.keepalive)
+                             for _, parked, checked in self._sessions.values()]
+                self._changed.wait(max(0.0, min(deadlines) - time.monotonic()) if deadlines else None)
+                now = time.monotonic()
+                expired = [name for name, (_, parked, _) in self._sessions.items() if now - parked >= self.idle]
+                due = [name for name, (_, _, checked) in self._sessions.items()
+                       if name not in expired and now - checked >= self.keepalive]
+                expired = [self._sessions.pop(name)[0] for name in expired]
+                due = [(name, self._sessions.pop(name)) for name in due]
+            for conn in expired:
+                conn.close()
+            # NOOPs go out with the sessions checked out, so take() never gets one mid-command
+            alive = [(name, entry) for name, entry in due if self._alive(entry[0])]
+            with self._changed:
+                for name, entry in alive:
+                    entry[2] = time.monotonic()
+                    self._sessions[name] = entry
+
+
+smtp_sessions = SMTPSessionCache()
+
+
+class SMTPConnectionPool:
+    """
+    Keeps up to `size` authenticated connections to one SMTP account.
+    Connections are opened lazily, handed out one per caller and recycled
+    once they have carried `max_messages` messages. A new connection is
+    taken from the warm sessions when one is cached for the account, and
+    close() leaves the pool's idle connections there for the next request.
+    `security` is 'starttls' (the default), 'ssl' (implicit TLS, usually
+    port 465) or 'none'.
+    """
+    def __init__(self, host, port, user, password, size=None, max_messages=None, timeout=None,
+                 security='starttls', timings=None):
+        self.host = host
+        self.port = int(port)
+        self.user = user
+        self.password = password
+        self.size = size or SMTP_POOL_SIZE
+        self.max_messages = max_messages or SMTP_MAX_MESSAGES_PER_CONNECTION
+        self.timeout = timeout or SMTP_TIMEOUT
+        self.security = security or 'starttls'
+        self.timings = timings
+        self.connects = 0  # Connections opened (and logged in to) by this pool
+        self.warm = 0  # Connections taken from the warm sessions instead
+        self.session_key = smtp_sessions.key(host, self.port, user, password, self.security)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _connect(self):
+        import smtplib
+        with metrics.time('connect', self.timings):
+            smtp_class = smtplib.SMTP_SSL if self.security == 'ssl' else smtplib.SMTP
+            smtp = smtp_class(self.host, self.port, timeout=self.timeout)
+            try:
+                if self.security == 'starttls':
+                    smtp.starttls()
+                smtp.login(self.user, self.password)
+                # Replies gate every command, so do not let Nagle hold back small writes
+                smtp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except Exception:
+                smtp.close()
+                raise
+        with self._lock:
+            self.connects += 1
+        metrics.inc('envialite_smtp_connections_opened_total')
+        return PooledConnection(smtp)
+
+    def acquire(self):
+        """Return an idle connection, opening a new one if the pool is not full."""
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                metrics.inc('envialite_smtp_connections_reused_total')
+                return self._idle.pop()
+        try:
+            conn = smtp_sessions.take(self.session_key)
+            if conn is not None:
+                with self._lock:
+                    self.warm += 1
+                metrics.inc('envialite_smtp_connections_reused_total')
+                return conn
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        """Give a connection back; broken or exhausted connections are closed."""
+        if discard or conn.sent >= self.max_messages:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle.append(conn)
+        self._slots.release()
+
+    def close(self):
+        """Hand the idle connections to the warm sessions for the next request."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            smtp_sessions.put(self.session_key, conn)
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket whose rate follows the provider's replies: it doubles every
+    second until the first throttling reply (slow start), then grows by about
+    one message/second per second, and halves on each 421/450/451/452 (at
+    most once per second, since one slowdown usually fails several sends).
+    """
+    def __init__(self, max_rate=None, initial_rate=None):
+        self.max_rate = max_rate or SMTP_MAX_RATE
+        self.rate = min(initial_rate or SMTP_INITIAL_RATE, self.max_rate)
+        self.throttles = 0
+        self._slow_start = True
+        self._tokens = 1.0
+        self._stamp = time.monotonic()
+        self._last_throttle = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        burst = max(1.0, self.rate)  # At most one second's worth of sends at once
+        self._tokens = min(burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self):
+        """Block until the current rate allows one more message."""
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self._lock:
+            step = self.rate if self._slow_start else 1.0
+            self.rate = min(self.max_rate, self.rate + step / self.rate)
+
+    def throttled(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_throttle < 1.0:
+                return
+            self._refill(now)
+            self._last_throttle = now
+            self._slow_start = False
+            self.throttles += 1
+            metrics.inc('envialite_smtp_throttled_total')
+            self.rate = max(SMTP_MIN_RATE, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)  # Pause briefly before the next send
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def rate_limiter_for(smtp_server, smtp_user=None):
+    """The limiter shared by every send through one account of `smtp_server`, so learned limits persist."""
+    host = (smtp_server or '').strip().lower()
+    key = (host, (smtp_user or '').strip().lower())
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            ceiling = SMTP_RATE_LIMITS.get(host, SMTP_RATE_LIMITS.get('*'))
+            limiter = _rate_limiters[key] = AdaptiveRateLimiter(max_rate=ceiling)
+        return limiter
+
+
+def smtp_accounts(settings):
+    """
+    The SMTP accounts a send may use, as dicts with smtpServer, smtpPort,
+    smtpUser, smtpPassword, smtpSecurity, weight, quota and name: the
+    request's own account first (smtpWeight, smtpQuota and smtpName set its
+    share), then each entry of its 'smtpRelays'. Entries without a server
+    are left out. A quota of 0 or none means no limit. Raises ValueError for
+    a weight that is not a positive number or a negative quota.
+    """
+    primary = dict(settings, weight=settings.get('smtpWeight'), quota=settings.get('smtpQuota'),
+                   name=settings.get('smtpName'))
+    relays = settings.get('smtpRelays') or []
+    accounts, names = [], set()
+    for entry in [primary] + [relay for relay in relays if isinstance(relay, dict)]:
+        if not entry.get('smtpServer'):
+            continue
+        try:
+            weight = float(entry.get('weight') or 1)
+            quota = int(entry.get('quota') or 0) or None  # The web UI sends 0 for no daily limit
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid weight or quota for SMTP account {entry.get('smtpUser') or entry['smtpServer']}.")
+        if weight <= 0 or (quota is not None and quota < 0):
+            raise ValueError(f"Invalid weight or quota for SMTP account {entry.get('smtpUser') or entry['smtpServer']}.")
+        base = name = entry.get('name') or f"{entry.get('smtpUser') or 'anonymous'} via {entry['smtpServer']}"
+        for number in itertools.count(2):
+            if name not in names:
+                break
+            name = f'{base} ({number})'
+        names.add(name)
+        accounts.append({
+            'smtpServer': entry['smtpServer'],
+            'smtpPort': entry.get('smtpPort'),
+            'smtpUser': entry.get('smtpUser'),
+            'smtpPassword': entry.get('smtpPassword'),
+            'smtpSecurity': entry.get('smtpSecurity') or settings.get('smtpSecurity'),
+            'weight': weight,
+            'quota': quota,
+            'name': name,
+        })
+    return accounts
+
+
+class RelayUsage:
+    """
+    Recipients sent to through each relay (by name) over the last
+    RELAY_QUOTA_WINDOW, across merges, so a quota holds however the sending is
+    split up; providers count a message to 100 Bcc recipients as 100. The send
+    journal keeps each row's accepted recipients per relay and seeds it from
+    them at startup.
+    """
+    def __init__(self):
+        self._sent = {}
+        self._lock = threading.Lock()
+
+    def _recent(self, name, now):
+        stamps = self._sent.setdefault(name, deque())
+        while stamps and stamps[0] < now - RELAY_QUOTA_WINDOW:
+            stamps.popleft()
+        return stamps
+
+    def reserve(self, name, quota=None, recipients=1):
+        """Count `recipients` against `name`; False (and nothing counted) if they do not fit in `quota`."""
+        with self._lock:
+            now = time.time()
+            stamps = self._recent(name, now)
+            if quota is not None and len(stamps) + recipients > quota:
+                return False
+            stamps.extend(itertools.repeat(now, recipients))
+            return True
+
+    def cancel(self, name, recipients=1):
+        """Take back reserved recipients the relay did not accept."""
+        with self._lock:
+            stamps = self._sent.get(name)
+            for _ in range(min(recipients, len(stamps or ()))):
+                stamps.pop()
+
+    def count(self, name):
+        with self._lock:
+            return len(self._recent(name, time.time()))
+
+    def load(self, sent):
+        """Add (name, timestamp) pairs of earlier sends, oldest first."""
+        with self._lock:
+            for name, stamp in sent:
+                self._sent.setdefault(name, deque()).append(stamp)
+
+
+relay_usage = RelayUsage()
+
+
+class Relay:
+    """
+    One SMTP account or relay a merge sends through: its connection pool and
+    rate limiter, a `weight` for its share of the messages and an optional
+    `quota` of recipients per RELAY_QUOTA_WINDOW. Latency and error rate are
+    moving averages of its recent transactions, so a relay that slows down,
+    is throttled or keeps failing is given less of the traffic.
+    """
+    def __init__(self, pool, limiter=None, weight=1.0, quota=None, name=None):
+        self.pool = pool
+        self.limiter = limiter or AdaptiveRateLimiter()
+        self.weight = weight
+        self.quota = quota
+        self.name = name or f'{pool.user} via {pool.host}'
+        self.latency = None  # Seconds per transaction
+        self.error_rate = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.error = None  # Why the relay was dropped from the merge (e.g. its login failed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_account(cls, account, timings=None):
+        """A relay for one entry of smtp_accounts()."""
+        pool = SMTPConnectionPool(account['smtpServer'], account['smtpPort'], account['smtpUser'],
+                                  account['smtpPassword'], security=account.get('smtpSecurity'), timings=timings)
+        return cls(pool, rate_limiter_for(account['smtpServer'], account['smtpUser']),
+                   weight=account.get('weight') or 1.0, quota=account.get('quota'), name=account.get('name'))
+
+    def score(self, fastest=None):
+        """Relative share of new messages: the weight, scaled down while slower than `fastest` or failing."""
+        speed = fastest / self.latency if fastest and self.latency else 1.0
+        return self.weight * max(RELAY_MIN_SHARE, (1.0 - self.error_rate) ** 2 * speed)
+
+    def observe(self, delivered, fault=False, seconds=None):
+        """Record a transaction: whether it was accepted, whether the relay was at fault, and how long it took."""
+        with self._lock:
+            if delivered:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self.error_rate += RELAY_HEALTH_DECAY * (float(fault) - self.error_rate)
+            if seconds is not None:
+                self.latency = seconds if self.latency is None else \
+                    self.latency + RELAY_HEALTH_DECAY * (seconds - self.latency)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'sent': self.sent,
+            'failed': self.failed,
+            'connections': self.pool.connects + self.pool.warm,
+            'warmConnections': self.pool.warm,
+            'latencyMs': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'errorRate': round(self.error_rate, 3),
+            'rateLimit': round(self.limiter.rate, 2),
+            'weight': self.weight,
+            'quota': self.quota,
+            'error': self.error,
+        }
+
+
+def shared_content_key(email_data):
+    """
+    What must match for rows to go out as one message to all their recipients:
+    everything but Bcc, which is only in the envelope. None for rows without Bcc
+    recipients, which are never merged (identical rows would be sent once).
+    """
+    if not split_addresses(email_data.get('bcc')):
+        return None
+    attachments = tuple((attachment.get('hash') or attachment.get('data'), attachment.get('filename'))
+                        for attachment in email_data.get('attachments') or ())
+    return (email_data.get('from'), email_data.get('to'), email_data.get('cc'), email_data.get('subject'),
+            email_data.get('body'), attachments)
+
+
+def group_shared_content(items, limit):
+    """
+    Merge runs of consecutive (index, email_data) whose messages differ only in
+    their Bcc recipients into one email whose Bcc lists them all, up to `limit`
+    envelope recipients. Yields (rows, email_data), where rows are the merged
+    (index, email_data) pairs (a single pair for an email sent on its own).
+    """
+    rows, key, bcc, base = [], None, {}, 0
+
+    def flush():
+        if len(rows) == 1:
+            return rows, rows[0][1]
+        return rows, dict(rows[0][1], bcc=', '.join(bcc))
+
+    for index, email_data in items:
+        row_key = shared_content_key(email_data) if limit > 1 else None
+        row_bcc = split_addresses(email_data.get('bcc')) if row_key is not None else ()
+        if rows and (row_key is None or row_key != key
+                     or base + len(bcc.keys() | set(row_bcc)) > limit):
+            yield flush()
+            rows, bcc = [], {}
+        if not rows:
+            key = row_key
+            base = len(split_addresses(email_data.get('to'))) + len(split_addresses(email_data.get('cc')))
+        rows.append((index, email_data))
+        bcc.update(dict.fromkeys(row_bcc))
+    if rows:
+        yield flush()
+
+
+def row_recipients(email_data, fields=('to', 'cc', 'bcc')):
+    """Envelope addresses of one row (from the given address fields)."""
+    fields = (split_addresses(email_data.get(field)) for field in fields)
+    return [address for _, address in getaddresses([value for field in fields for value in field]) if address]
+
+
+def retry_delay(attempt):
+    """Exponential backoff with jitter, so throttled workers do not retry in lockstep."""
+    delay = min(SMTP_BACKOFF_MAX, SMTP_BACKOFF_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def is_transient(error):
+    """True if a retry may succeed: a lost connection or any 4xx reply."""
+    code = smtp_error_code(error)
+    return is_connection_lost(error) or (code is not None and 400 <= code < 500)
+
+
+class DeliveryEngine:
+    """
+    Sends one merge through a connection pool, or through several relays,
+    spreading messages across worker threads (one per pooled connection).
+    Each send goes to a relay picked at random in proportion to its score,
+    so traffic follows the weights while every relay is healthy and drains
+    away from one that is slow, throttled, failing or out of quota.
+    """
+    def __init__(self, pool=None, workers=None, limiter=None, timings=None, renderer=None, relays=None,
+                 screen=None):
+        self.relays = relays or [Relay(pool, limiter)]
+        self.workers = workers or sum(relay.pool.size for relay in self.relays)
+        self.timings = timings  # PhaseTimings of the job being sent, if any
+        self.renderer = renderer  # RenderPool building messages ahead of the workers, if any
+        self.screen = screen  # RecipientScreen the rows pass through before they are built, if any
+        self.builder = MessageBuilder()
+        self.retries = 0
+        self.shared = 0  # Messages that carried several rows
+        self.recipient_limit = SMTP_MAX_RECIPIENTS  # Lowered if the server defers recipients with 452
+        self._lock = threading.Lock()
+
+    def run(self, emails, on_result=None, on_send=None, skip=()):
+        """
+        Deliver every email in the iterable `emails`. Returns (results, stats).
+        `on_result` is called from the worker threads as each result arrives,
+        and `on_send(indexes)` with the rows of a message just before it goes
+        to the server.
+        Positions listed in `skip` are passed over (already handled). Rows
+        the screen leaves without recipients are reported without being sent.
+        """
+        # Open the first connection up front so bad credentials fail the whole
+        # request once instead of once per message. With several relays only
+        # the ones that cannot log in are dropped.
+        errors = []
+        for relay in self.relays:
+            try:
+                relay.pool.release(relay.pool.acquire())
+            except Exception as e:
+                if len(self.relays) == 1:
+                    raise
+                relay.error = str(e)
+                errors.append(e)
+        if len(errors) == len(self.relays):
+            raise errors[0]
+
+        started = time.perf_counter()
+        throttles = sum(relay.limiter.throttles for relay in self.relays)
+        tasks = queue.Queue(maxsize=self.workers * 2)
+        _delivery_queues.add(tasks)
+        results = {}
+        threads = [threading.Thread(target=self._worker, args=(tasks, results, on_result, on_send), daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            if self.screen is not None:
+                pending = self.screen.rows(emails, skip, lambda result: self._skipped(result, results, on_result))
+            else:
+                pending = ((index, email_data) for index, email_data in enumerate(emails) if index not in skip)
+            grouped = group_shared_content(pending, SMTP_MAX_RECIPIENTS)
+            if self.renderer is not None:
+                for item in self.renderer.build(grouped, self.timings):
+                    tasks.put(item)
+            else:
+                for rows, email_data in grouped:
+                    tasks.put((rows, email_data, None))
+        finally:
+            for _ in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+            _delivery_queues.discard(tasks)
+
+        elapsed = time.perf_counter() - started
+        ordered = [results[index] for index in sorted(results)]
+        stats = {
+            'elapsed': round(elapsed, 3),
+            'messagesPerSecond': round(len(ordered) / elapsed, 2) if elapsed > 0 else 0.0,
+            'workers': self.workers,
+            'renderProcesses': self.renderer.processes if self.renderer is not None else 0,
+            'connections': sum(relay.pool.connects + relay.pool.warm for relay in self.relays),
+            'warmConnections': sum(relay.pool.warm for relay in self.relays),
+            'rateLimit': round(sum(relay.limiter.rate for relay in self.relays if relay.error is None), 2),
+            'throttled': sum(relay.limiter.throttles for relay in self.relays) - throttles,
+            'retries': self.retries,
+            'sharedMessages': self.shared,
+            'screened': dict(self.screen.counts) if self.screen is not None else {},
+            'relays': [relay.as_dict() for relay in self.relays],
+        }
+        return ordered, stats
+
+    def _worker(self, tasks, results, on_result, on_send):
+        while True:
+            item = tasks.get()
+            if item is None:
+                return
+            rows, email_data, message = item
+            row_results = [{'index': index, 'email': row.get('to'), 'success': True,
+                            'error': None, 'code': None, 'messageId': None, 'relay': None} for index, row in rows]
+            for result, (_, row) in zip(row_results, rows):
+                if row.get('screened'):
+                    result['screened'] = row['screened']
+            try:
+                if message is None:
+                    with metrics.time('build', self.timings):
+                        message = self.builder.build(email_data)
+                elif isinstance(message, Exception):
+                    raise message  # Building it failed in a render process
+                metrics.inc('envialite_messages_built_total')
+                for result in row_results:
+                    result['messageId'] = message.message_id
+                if on_send:
+                    on_send([index for index, _ in rows])
+                if len(rows) == 1:
+                    code, refused, relay = self.send(message)
+                    row_results[0]['relay'] = relay.name
+                    row_results[0]['accepted'] = {relay.name: len(message.recipients) - len(refused)}
+                    self._apply_reply(row_results[0], code, refused)
+                else:
+                    code, refused, carried = self.send_shared(message)
+                    counted = set()  # Shared To/Cc are charged to the first row that lists them
+                    for result, (_, row) in zip(row_results, rows):
+                        relays = [carried[address] for address in row_recipients(row) if address in carried]
+                        result['relay'] = ', '.join(dict.fromkeys(relays)) or None
+                        result['accepted'] = dict(Counter(
+                            carried[address] for address in dict.fromkeys(row_recipients(row))
+                            if address in carried and address not in counted))
+                        counted.update(row_recipients(row))
+                        self._apply_reply(result, code, refused, row)
+            except Exception as e:
+                for result in row_results:
+                    result.update(success=False, error=str(e), code=smtp_error_code(e),
+                                  relay=getattr(e, 'relay', None))
+            for result in row_results:
+                metrics.inc('envialite_messages_sent_total' if result['success'] else 'envialite_messages_failed_total')
+                results[result['index']] = result
+                if on_result:
+                    on_result(result)
+
+    @staticmethod
+    def _skipped(result, results, on_result):
+        metrics.inc('envialite_messages_skipped_total')
+        results[result['index']] = result
+        if on_result:
+            on_result(result)
+
+    @staticmethod
+    def _apply_reply(result, code, refused, row=None):
+        """
+        Fill in a row's result from the transaction's reply. A `row` sharing
+        the message reports only its own recipients' refusals, and fails if
+        all of its Bcc recipients (the ones only it sent to) were refused.
+        """
+        result['code'] = code
+        if row is not None:
+            refused = {address: refused[address] for address in row_recipients(row) if address in refused}
+            own = set(row_recipients(row, ('bcc',)))
+            if own and own.issubset(refused):
+                result.update(success=False, code=refused[next(iter(own))][0])
+        if refused:
+            result['error'] = 'Refused: ' + ', '.join(
+                f'{addr} ({reply_code})' for addr, (reply_code, _) in refused.items())
+
+    def send_shared(self, message):
+        """
+        Send a message carrying several rows' recipients, in transactions of at
+        most `recipient_limit` RCPTs. Recipients the server defers with 452
+        (too many recipients) move to the next transaction and lower the limit.
+        Returns (code, refused, carried) over every recipient, where carried maps
+        each address sent to the name of its relay; raises only if all were refused.
+        """
+        import smtplib
+        with self._lock:
+            self.shared += 1
+        remaining = message.recipients
+        refused = {}
+        carried = {}
+        code = None
+        while remaining:
+            chunk, remaining = remaining[:self.recipient_limit], remaining[self.recipient_limit:]
+            try:
+                code, chunk_refused, relay = self.send(message, chunk)
+                carried.update(dict.fromkeys(chunk, relay.name))
+            except smtplib.SMTPRecipientsRefused as e:
+                chunk_refused = e.recipients
+            deferred = [address for address in chunk if chunk_refused.get(address, (None,))[0] == 452]
+            if deferred and len(deferred) < len(chunk):
+                self.recipient_limit = max(1, len(chunk) - len(deferred))
+                remaining = deferred + remaining
+                chunk_refused = {address: reply for address, reply in chunk_refused.items()
+                                 if address not in deferred}
+            refused.update(chunk_refused)
+        if len(refused) == len(message.recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return code, refused, {address: relay for address, relay in carried.items() if address not in refused}
+
+    def _choose(self, recipients=1):
+        """
+        Pick the relay for the next transaction in proportion to its score and
+        count its `recipients` against the relay's quota.
+        """
+        candidates = [relay for relay in self.relays if relay.error is None]
+        while candidates:
+            if len(candidates) == 1:
+                relay = candidates[0]
+            else:
+                fastest = min((relay.latency for relay in candidates if relay.latency), default=None)
+                relay = random.choices(candidates, [relay.score(fastest) for relay in candidates])[0]
+            if relay_usage.reserve(relay.name, relay.quota, recipients):
+                return relay
+            candidates.remove(relay)
+        reasons = '; '.join(f'{relay.name}: {relay.error or "quota reached"}' for relay in self.relays)
+        raise RuntimeError(f'No SMTP account can send right now ({reasons}).')
+
+    def send(self, message, recipients=None):
+        """
+        Send one message (to `recipients` if given) through a relay, at the
+        rate it allows. Transient failures (dropped connections, 4xx replies)
+        are retried after a jittered exponential backoff, on a fresh connection
+        of whichever relay is picked next; a relay whose login starts failing
+        is dropped. Returns (code, refused, relay).
+        """
+        import smtplib
+        count = len(message.recipients if recipients is None else recipients)
+        for attempt in range(SMTP_RETRY_ATTEMPTS + 1):
+            relay = self._choose(count)
+            relay.limiter.acquire()
+            conn = None
+            started = time.perf_counter()
+            try:
+                conn = relay.pool.acquire()
+                with metrics.time('smtp', self.timings):
+                    reply = smtp_transaction(conn.smtp, message, recipients)
+            except Exception as e:
+                relay_usage.cancel(relay.name, count)
+                e.relay = relay.name
+                code = smtp_error_code(e)
+                metrics.inc('envialite_smtp_replies_total', code=code or 'none')
+                lost = is_connection_lost(e)
+                if conn is not None:
+                    relay.pool.release(conn, discard=lost)
+                if code in SMTP_THROTTLE_CODES:
+                    relay.limiter.throttled()
+                retry = is_transient(e)
+                if isinstance(e, smtplib.SMTPAuthenticationError) and len(self.relays) > 1:
+                    relay.error = str(e)
+                    retry = True  # Another relay can carry it
+                relay.observe(False, fault=retry,
+                              seconds=None if lost or conn is None else time.perf_counter() - started)
+                if not retry or attempt == SMTP_RETRY_ATTEMPTS:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                metrics.inc('envialite_smtp_retries_total')
+                time.sleep(retry_delay(attempt))
+                continue
+            if reply[1]:
+                relay_usage.cancel(relay.name, len(reply[1]))  # Only accepted RCPTs use the quota
+            conn.sent += 1
+            relay.pool.release(conn)
+            relay.limiter.succeeded()
+            relay.observe(True, seconds=time.perf_counter() - started)
+            metrics.inc('envialite_smtp_replies_total', code=reply[0])
+            metrics.inc('envialite_message_bytes_total', message.size)
+            return reply + (relay,)
+
+
+# --- Send Journal ---
+
+class SendJournal:
+    """
+    Durable record of every send in SQLite (WAL mode), so a send cut short by
+    a crash or a stopped server can be resumed without resending anything.
+    Each message moves queued -> sending -> sent/failed (or straight to
+    skipped if screening left it without recipients); one that was left
+    in 'sending' may have been delivered and becomes 'unknown' instead of
+    being retried. Writes are committed in batches by a single writer
+    thread; only the 'sending' mark is waited for before the message goes out.
+    No SMTP password is ever written.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            created_at REAL,
+            status TEXT,
+            total INTEGER,
+            summary TEXT,
+            settings TEXT,
+            is_merge INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            job_id TEXT,
+            idx INTEGER,
+            recipient TEXT,
+            status TEXT,
+            code INTEGER,
+            response TEXT,
+            message_id TEXT,
+            payload TEXT,
+            updated_at REAL,
+            relay TEXT,
+            accepted TEXT,
+            PRIMARY KEY (job_id, idx)
+        );
+    '''
+
+    def __init__(self, path):
+        import sqlite3
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')  # Survives a process crash; fsync only at checkpoints
+        self._db.executescript(self.SCHEMA)
+        columns = {column[1] for column in self._db.execute('PRAGMA table_info(messages)')}
+        if 'relay' not in columns:
+            self._db.execute('ALTER TABLE messages ADD COLUMN relay TEXT')  # Journal from before relays
+        if 'accepted' not in columns:
+            self._db.execute('ALTER TABLE messages ADD COLUMN accepted TEXT')  # Journal from before per-recipient quotas
+        self._db_lock = threading.Lock()
+        self._pending = []
+        self._queued = 0   # Writes accepted so far
+        self._written = 0  # Writes committed so far
+        self._changed = threading.Condition()
+        threading.Thread(target=self._writer, name='send-journal', daemon=True).start()
+
+    def _write(self, sql, params, wait=False):
+        self._write_many(sql, [params], wait)
+
+    def _write_many(self, sql, rows, wait=False):
+        """Queue `sql` once per params in `rows`, to be committed together."""
+        with self._changed:
+            self._pending.extend((sql, params) for params in rows)
+            self._queued += 1
+            sequence = self._queued
+            self._changed.notify_all()
+            if wait:
+                self._changed.wait_for(lambda: self._written >= sequence)
+
+    def _writer(self):
+        import sqlite3
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._pending)
+                batch, self._pending = self._pending, []
+                sequence = self._queued
+            try:
+                with self._db_lock:
+                    self._db.execute('BEGIN')
+                    for sql, params in batch:
+                        self._db.execute(sql, params)
+                    self._db.execute('COMMIT')
+            except sqlite3.Error as e:
+                print(f"❌ Send journal write failed: {e}")
+                with self._db_lock:
+                    if self._db.in_transaction:
+                        self._db.execute('ROLLBACK')
+            with self._changed:
+                self._written = sequence
+                self._changed.notify_all()
+
+    def flush(self):
+        """Block until everything written so far is committed."""
+        with self._changed:
+            sequence = self._queued
+            self._changed.wait_for(lambda: self._written >= sequence)
+
+    def _query(self, sql, params=()):
+        with self._db_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def start_job(self, job):
+        self._write('INSERT OR REPLACE INTO jobs (id, created_at, status, total, summary, settings, is_merge) '
+                    'VALUES (?, ?, ?, ?, NULL, ?, ?)',
+                    (job.id, job.created_at, 'running', job.total, json.dumps(job.settings),
+                     int(isinstance(job.emails, MailMerge))))
+
+    def finish_job(self, job_id, status, summary):
+        self._write('UPDATE jobs SET status = ?, summary = ? WHERE id = ?', (status, summary, job_id))
+
+    def queued(self, job_id, index, recipient, payload=None):
+        self._write('INSERT OR IGNORE INTO messages (job_id, idx, recipient, status, payload, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (job_id, index, recipient, 'queued',
+                     None if payload is None else json.dumps(payload), time.time()))
+
+    def sending(self, job_id, indexes):
+        """Mark the rows of one message as handed to the server; returns once that is on disk."""
+        now = time.time()
+        self._write_many('UPDATE messages SET status = ?, updated_at = ? WHERE job_id = ? AND idx = ?',
+                         [('sending', now, job_id, index) for index in indexes], wait=True)
+
+    def finished(self, job_id, result):
+        self._write('UPDATE messages SET status = ?, code = ?, response = ?, message_id = ?, relay = ?, '
+                    'accepted = ?, updated_at = ? WHERE job_id = ? AND idx = ?',
+                    ('sent' if result['success'] else 'skipped' if result.get('skipped') else 'failed',
+                     result['code'], result['error'], result['messageId'], result.get('relay'),
+                     json.dumps(result['accepted']) if result.get('accepted') else None,
+                     time.time(), job_id, result['index']))
+
+    def recover(self):
+        """
+        Close out what the last run left open: messages caught mid-send become
+        'unknown' and unfinished jobs 'interrupted'. Old finished jobs are
+        pruned. Returns the interrupted jobs' rows, oldest first.
+        """
+        cutoff = time.time() - JOURNAL_RETENTION_DAYS * 86400
+        with self._db_lock:
+            self._db.execute('BEGIN')
+            self._db.execute("UPDATE messages SET status = 'unknown' WHERE status = 'sending'")
+            self._db.execute("UPDATE jobs SET status = 'interrupted' WHERE status IN ('queued', 'running')")
+            self._db.execute('DELETE FROM messages WHERE job_id IN (SELECT id FROM jobs WHERE created_at < ? '
+                             "AND status IN ('completed', 'failed'))", (cutoff,))
+            self._db.execute("DELETE FROM jobs WHERE created_at < ? AND status IN ('completed', 'failed')",
+                             (cutoff,))
+            self._db.execute('COMMIT')
+        return self._query("SELECT id, created_at, total, settings, is_merge FROM jobs "
+                           "WHERE status = 'interrupted' ORDER BY created_at")
+
+    def messages(self, job_id):
+        """(index, recipient, status, code, response, message_id, relay, payload) rows of a job."""
+        return self._query('SELECT idx, recipient, status, code, response, message_id, relay, payload '
+                           'FROM messages WHERE job_id = ? ORDER BY idx', (job_id,))
+
+    def sent_by_relay(self, since):
+        """
+        (relay, timestamp) of each recipient accepted since `since`, oldest
+        first, to seed relay quotas the way RelayUsage.reserve charges them.
+        Rows journalled before accepted counts were kept count once per relay.
+        """
+        rows = self._query("SELECT relay, accepted, updated_at FROM messages WHERE updated_at >= ? "
+                           "AND (accepted IS NOT NULL OR (status = 'sent' AND relay IS NOT NULL)) "
+                           'ORDER BY updated_at', (since,))
+        for relay, accepted, stamp in rows:
+            accepted = json.loads(accepted) if accepted else dict.fromkeys(relay.split(', '), 1)
+            for name, count in accepted.items():
+                yield from itertools.repeat((name, stamp), count)
+
+
+send_journal = None  # SendJournal, opened by main() unless --journal '' disables it
+
+
+def demo_journal_path(path):
+    """The journal Demo Mode uses beside `path`, so demo sends never mix with (or resume as) live ones."""
+    root, extension = os.path.splitext(path)
+    return f'{root}-demo{extension}'
+
+
+# --- Recipient Screening ---
+# Before a row is sent its To, Cc and Bcc are parsed once and looked up in an
+# index of every address the send has already mailed, so duplicates, malformed
+# addresses and suppressed addresses never cost an SMTP transaction.
+
+DUPLICATE_POLICIES = ('skip', 'flag', 'send')
+
+
+def normalize_address(address):
+    """The comparable form of one address (bare or `Name <addr>`): its addr-spec, stripped and lowercased."""
+    return parseaddr(address)[1].strip().lower()
+
+
+def duplicate_policy(value):
+    """The duplicate-recipient policy a send asked for (DUPLICATE_RECIPIENTS if none); ValueError if unknown."""
+    policy = (value or DUPLICATE_RECIPIENTS).strip().lower()
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"duplicateRecipients must be one of {', '.join(DUPLICATE_POLICIES)}, got {value!r}.")
+    return policy
+
+
+class SuppressionList:
+    """
+    Addresses never to be mailed (unsubscribes, hard bounces), kept one per
+    line in a text file. The file is read into a set at startup, so checking
+    a recipient is one hash lookup. Additions are appended to the file;
+    removals rewrite it.
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._addresses = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._addresses = {address for address in map(normalize_address, f) if address}
+
+    def __contains__(self, address):
+        """Whether a normalized address is suppressed."""
+        return address in self._addresses
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def addresses(self):
+        with self._lock:
+            return sorted(self._addresses)
+
+    def add(self, addresses):
+        """Suppress each valid address of `addresses`. Returns how many were not suppressed before."""
+        with self._lock:
+            new = [address for address in dict.fromkeys(map(normalize_address, addresses))
+                   if VALID_EMAIL.match(address) and address not in self._addresses]
+            if new:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(address + '\n' for address in new))
+                self._addresses.update(new)
+            return len(new)
+
+    def remove(self, addresses):
+        """Stop suppressing `addresses`. Returns how many were suppressed."""
+        with self._lock:
+            removed = set(map(normalize_address, addresses)) & self._addresses
+            if removed:
+                self._addresses -= removed
+                temporary = f'{self.path}.tmp'
+                with open(temporary, 'w', encoding='utf-8') as f:
+                    f.write(''.join(address + '\n' for address in sorted(self._addresses)))
+                os.replace(temporary, self.path)
+            return len(removed)
+
+
+suppression_list = None  # SuppressionList, opened by main() unless --suppression-list '' disables it
+
+
+class RecipientScreen:
+    """
+    Screens the rows of one send on their way to the SMTP workers. Each
+    address is parsed once and looked up in a dict of the addresses mailed so
+    far (address -> first row), so the pass costs a hash lookup per
+    recipient. Screening only ever trims the envelope: the To and Cc headers
+    are left as written, and a To/Cc address that must not be mailed is left
+    out of the row's 'envelope' list instead. Malformed and suppressed
+    addresses are left out, as is an address the row already lists. One
+    mailed by an earlier row is left out under the 'skip' policy, sent but
+    noted under 'flag', and sent silently under 'send'. Rows that will go out
+    as one shared message (see group_shared_content) mail their common To/Cc
+    once, so only the first of them screens it. A row left without
+    recipients is not sent.
+    """
+    FIELDS = ('to', 'cc', 'bcc')
+
+    def __init__(self, duplicates=None, suppressed=None, shared=True):
+        self.duplicates = duplicate_policy(duplicates)
+        self.suppressed = suppressed
+        self.shared = shared  # Whether consecutive rows differing only in Bcc are merged into one message
+        self.seen = {}
+        self.counts = Counter()  # Addresses left out by reason, and duplicates 'flagged'
+        self._run = None  # (shared content key, envelope, listed) of the message the last row started
+
+    def check(self, index, email_data):
+        """
+        Screen one row. Returns (email_data, notes): the row with the left-out
+        Bcc addresses removed and an 'envelope' of the To/Cc addresses to mail
+        (the same dict if nothing was left out), or None if no recipient is
+        left, and a note for each address left out or flagged:
+        {'address', 'reason', 'removed'} plus the first 'row' of a duplicate.
+        """
+        key = shared_content_key(email_data) if self.shared else None
+        continued = key is not None and self._run is not None and self._run[0] == key
+        notes = []
+        if continued:
+            envelope, listed = self._run[1], set(self._run[2])
+            fields = ('bcc',)
+        else:
+            envelope, listed = [], set()
+            fields = self.FIELDS
+        changed = False
+        bcc = []
+        for field in fields:
+            if field == 'bcc':
+                visible = set(listed)  # What rows continuing this message may not list again
+            for entry in split_addresses(email_data.get(field)):
+                address = normalize_address(entry)
+                if not VALID_EMAIL.match(address):
+                    notes.append({'address': entry, 'reason': 'invalid', 'removed': True})
+                elif self.suppressed is not None and address in self.suppressed:
+                    notes.append({'address': address, 'reason': 'suppressed', 'removed': True})
+                elif address in listed:
+                    notes.append({'address': address, 'reason': 'duplicate', 'removed': True, 'row': index})
+                else:
+                    first = self.seen.setdefault(address, index)
+                    if first != index and self.duplicates != 'send':
+                        removed = self.duplicates == 'skip'
+                        notes.append({'address': address, 'reason': 'duplicate', 'removed': removed, 'row': first})
+                        if removed:
+                            changed = True
+                            continue
+                    listed.add(address)
+                    (bcc if field == 'bcc' else envelope).append(entry)
+                    continue
+                changed = True
+        for note in notes:
+            self.counts[note['reason'] if note['removed'] else 'flagged'] += 1
+        if not continued:
+            self._run = (key, envelope, visible) if bcc else None
+        if not bcc and (continued or not envelope):
+            return None, notes
+        fields = {'bcc': ', '.join(bcc)} if changed else {}
+        if len(envelope) != len(split_addresses(email_data.get('to'))) + len(split_addresses(email_data.get('cc'))):
+            fields['envelope'] = envelope
+        return (dict(email_data, **fields) if fields else email_data), notes
+
+    def rows(self, emails, skip=(), on_skipped=None):
+        """
+        Screen `emails` in order, yielding (index, email_data) for each row to
+        send, with its notes under 'screened'. A row left without recipients
+        is passed to `on_skipped` as its result instead. Rows in `skip` are
+        screened too, so the addresses they mailed count, but never yielded.
+        """
+        for index, email_data in enumerate(emails):
+            row, notes = self.check(index, email_data)
+            if index in skip:
+                continue
+            if row is None:
+                if on_skipped:
+                    on_skipped(skipped_result(index, email_data, notes))
+                continue
+            yield index, (dict(row, screened=notes) if notes else row)
+
+    def summary(self):
+        """What screening did, for a send's summary ('' if it changed nothing)."""
+        removed = [f"{self.counts[reason]} {reason}" for reason in ('duplicate', 'invalid', 'suppressed')
+                   if self.counts[reason]]
+        text = f" Not sent to {', '.join(removed)} address(es)." if removed else ''
+        if self.counts['flagged']:
+            text += f" {self.counts['flagged']} address(es) were mailed more than once."
+        return text
+
+
+def describe_screened(notes):
+    """Screening notes as text, e.g. 'a@example.com (duplicate of row 3)'."""
+    return '; '.join(f"{note['address']} (duplicate of row {note['row'] + 1})" if note['reason'] == 'duplicate'
+                     else f"{note['address']} ({note['reason']})" for note in notes)
+
+
+def skipped_result(index, email_data, notes):
+    """The result of a row screening left without recipients."""
+    error = f'No recipient left: {describe_screened(notes)}' if notes else 'No recipient address.'
+    return {'index': index, 'email': email_data.get('to'), 'success': False, 'skipped': True, 'error': error,
+            'code': None, 'messageId': None, 'relay': None, 'screened': notes}
+
+
+# --- Demo SMTP Sink ---
+# In Demo Mode sends run the whole pipeline (parse, render, MIME build, SMTP)
+# against this stand-in on a loopback port instead of the real server, so a
+# demo run shows how long a merge takes and how it behaves before it goes live.
+# benchmark.py drives its merges against the same sink.
+
+class DemoSMTPHandler(socketserver.StreamRequestHandler):
+    """One connection to the demo sink: just enough ESMTP for the delivery engine."""
+
+    def reply(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 envialite-demo ESMTP ready')
+        recipients = []
+        while True:
+            line = self.rfile.readline(4096)
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250-envialite-demo\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SMTPUTF8')
+            elif verb == 'AUTH':
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb == 'MAIL':
+                recipients = []
+                if not self.server.admit():
+                    self.reply('451 4.7.1 Too many messages, slow down (demo)')
+                elif self.server.defer_rate and random.random() < self.server.defer_rate:
+                    self.server.count('deferred')
+                    self.reply('451 4.3.0 Try again later (demo)')
+                else:
+                    self.reply('250 2.1.0 OK')
+            elif verb == 'RCPT':
+                if self.server.failure_rate and random.random() < self.server.failure_rate:
+                    self.server.count('refused')
+                    self.reply('550 5.1.1 Mailbox unavailable (demo)')
+                else:
+                    recipients.append(command[8:].strip())
+                    self.reply('250 2.1.5 OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    self.reply('503 5.5.1 No valid recipients')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = [] if self.server.save_dir else None
+                size = 0
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                    size += len(data_line)
+                    if lines is not None:
+                        lines.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                number = self.server.delivered(len(recipients), size, lines)
+                recipients = []
+                self.reply(f'250 2.0.0 Queued as {number}')
+            elif verb in ('RSET', 'NOOP'):
+                if verb == 'RSET':
+                    recipients = []
+                self.reply('250 2.0.0 OK')
+            elif verb == 'QUIT':
+                self.reply('221 2.0.0 Bye')
+                return
+            else:
+                self.reply('502 5.5.2 Command not recognized')
+
+
+class DemoSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    The SMTP server Demo Mode (and benchmark.py) sends to. It accepts any
+    login, waits `latency` seconds before every reply, answers MAIL with 451
+    beyond `rate` messages a second (0: never) and for a `defer_rate` fraction
+    of messages, refuses a `failure_rate` fraction of recipients with 550, and
+    writes each message to `save_dir` as an .eml file if one is set.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, rate=0.0, failure_rate=0.0, save_dir=None, defer_rate=0.0):
+        super().__init__(('127.0.0.1', 0), DemoSMTPHandler)
+        self.configure(latency, rate, failure_rate, save_dir, defer_rate)
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+
+    def configure(self, latency=0.0, rate=0.0, failure_rate=0.0, save_dir=None, defer_rate=0.0):
+        self.latency = max(0.0, latency)
+        self.rate = max(0.0, rate)
+        self.failure_rate = min(1.0, max(0.0, failure_rate))
+        self.defer_rate = min(1.0, max(0.0, defer_rate))
+        self.save_dir = save_dir
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+
+    def reset(self):
+        """Zero the counters (between benchmark cases)."""
+        with self._lock:
+            self.counters = Counter()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='demo-smtp', daemon=True).start()
+        return self
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def admit(self):
+        """Whether the next message is within `rate` (a token bucket holding a second's worth)."""
+        if not self.rate:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.counters['throttled'] += 1
+            return False
+
+    def delivered(self, recipients, size, lines=None):
+        """Count (and save, given its lines) one accepted message; returns its number."""
+        with self._lock:
+            self.counters['messages'] += 1
+            self.counters['recipients'] += recipients
+            self.counters['bytes'] += size
+            number = self.counters['messages']
+        if lines is not None:
+            with open(os.path.join(self.save_dir, f'{number:06d}.eml'), 'wb') as f:
+                f.writelines(lines)
+        return number
+
+
+demo_sink = None  # DemoSMTPServer, started by main() in Demo Mode
+
+
+def demo_accounts(accounts):
+    """
+    `accounts` (from smtp_accounts) pointed at the demo sink, or one stand-in
+    account if the request named none. Names get a "(demo)" suffix, so demo
+    sends count against their own quotas and never a real account's.
+    """
+    accounts = accounts or [{'smtpUser': 'demo', 'weight': 1.0, 'quota': None, 'name': 'demo'}]
+    host, port = demo_sink.server_address[:2]
+    return [dict(account, smtpServer=host, smtpPort=port, smtpUser=account.get('smtpUser') or 'demo',
+                 smtpPassword='demo', smtpSecurity='none', name=f"{account['name']} (demo)")
+            for account in accounts]
+
+
+# --- Send Jobs ---
+# A send runs as a SendJob: /api/jobs starts it in the background and returns
+# its id at once, while /send-emails runs it on the request thread. Results
+# are compact; the full message for a row is fetched on demand from
+# /api/messages/<job>/<index> when the UI opens it.
+
+_send_jobs = OrderedDict()
+_send_jobs_lock = threading.Lock()
+
+
+def message_details(email_data):
+    """The parts of a submitted email worth showing later (attachment data is dropped)."""
+    return {
+        'from': email_data.get('from'),
+        'to': email_data.get('to'),
+        'cc': email_data.get('cc'),
+        'bcc': email_data.get('bcc'),
+        'subject': email_data.get('subject'),
+        'body': email_data.get('body', ''),
+        'attachments': [{'filename': att.get('filename'), 'size': att.get('size')}
+                        for att in email_data.get('attachments', [])],
+    }
+
+
+class SpooledDetails:
+    """
+    Message details of a send's rows, written as JSON to an anonymous
+    temporary file with an array of offsets, so memory stays flat however
+    many rows (and however long their bodies) stream past. A row is read
+    back from disk when someone asks for it.
+    """
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._offsets = array('Q', [0])
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        with self._lock:
+            self._file.seek(self._offsets[index])
+            data = self._file.read(self._offsets[index + 1] - self._offsets[index])
+        return json.loads(data)
+
+    def append(self, details):
+        data = json.dumps(details).encode('utf-8')
+        with self._lock:
+            self._file.seek(self._offsets[-1])
+            self._file.write(data)
+            self._offsets.append(self._offsets[-1] + len(data))
+
+    def extend(self, items):
+        for details in items:
+            self.append(details)
+
+    def clear(self):
+        with self._lock:
+            self._file.truncate(0)
+            self._offsets = array('Q', [0])
+
+
+def store_inline_attachments(email_data, stored, keep=16):
+    """
+    `email_data` with its inline (base64 data URL) attachments put in the
+    attachment store and referenced by hash, like the web app's uploads.
+    `stored` maps data already stored to its reference (the last `keep`).
+    Data that is not valid base64 is left inline for the build to report.
+    """
+    import binascii
+    attachments = []
+    for attachment in email_data['attachments']:
+        data = attachment.get('data')
+        if attachment.get('hash') or not isinstance(data, str):
+            attachments.append(attachment)
+            continue
+        reference = stored.get(data)
+        if reference is None:
+            try:
+                content = base64.b64decode(''.join(data.split(',', 1)[-1].split()), validate=True)
+            except (binascii.Error, ValueError):
+                attachments.append(attachment)
+                continue
+            digest, size = attachment_store.put(io.BytesIO(content), len(content))
+            reference = stored[data] = {'hash': digest, 'size': size}
+            if len(stored) > keep:
+                stored.popitem(last=False)
+        attachments.append(dict({key: value for key, value in attachment.items() if key != 'data'}, **reference))
+    return dict(email_data, attachments=attachments)
+
+
+class BatchRecorder:
+    """
+    Wraps the emails of one send, keeping the details of each row as it
+    streams past (spooled to disk, see SpooledDetails). A malformed streamed
+    row ends the batch instead of losing the results of everything already sent.
+    """
+    def __init__(self, emails, details=None):
+        self.emails = emails
+        self.record = details is None
+        self.details = SpooledDetails() if details is None else details
+        self.error = None
+
+    def __iter__(self):
+        if self.record:
+            self.details.clear()  # A resumed job walks the batch again from the start
+        try:
+            for email_data in self.emails:
+                if self.record:
+                    self.details.append(message_details(email_data))
+                yield email_data
+        except ValueError as e:
+            self.error = f'Input stopped after {len(self.details)} emails: {e}'
+
+
+class MergeDetails:
+    """Message details for the rows a MailMerge has emitted, rendered again on access."""
+    def __init__(self, merge):
+        self.merge = merge
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return message_details(self.merge.render(*self.rows[index]))
+
+
+class StreamFeed:
+    """
+    Carries emails parsed on the request thread to a job running on its own
+    thread. The queue is bounded, so the upload is read at delivery pace.
+    """
+    _END = object()
+
+    def __init__(self, maxsize=64):
+        self._queue = queue.Queue(maxsize)
+        self._closed = threading.Event()
+
+    def pump(self, emails):
+        """
+        Copy `emails` into the feed; stops early once the job stops reading.
+        Returns whether `emails` was read to its end (False leaves the rest of
+        a streamed request body unread on the connection).
+        """
+        try:
+            for email_data in emails:
+                if not self._put(email_data):
+                    return False
+        except ValueError as e:
+            self._put(e)
+            return False
+        self._put(self._END)
+        return True
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self):
+        self._closed.set()
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, ValueError):
+                raise item
+            yield item
+
+
+class SendJob:
+    """
+    One merge being delivered. Progress counters are updated as each result
+    arrives, and results stay queryable after the job finishes.
+    """
+    def __init__(self, settings, emails, job_id=None):
+        import uuid
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.demo = DEMO_MODE  # A demo job only ever sends to the demo sink, even if resumed after a switch
+        self.accounts = smtp_accounts(settings)
+        # What the journal keeps to resume the job: never a password or inline emails
+        self.settings = {key: value for key, value in settings.items() if key not in ('smtpPassword', 'emails')}
+        if self.settings.get('smtpRelays'):
+            self.settings['smtpRelays'] = [{key: value for key, value in relay.items() if key != 'smtpPassword'}
+                                           for relay in self.settings['smtpRelays'] if isinstance(relay, dict)]
+        self.emails = emails
+        if isinstance(emails, MailMerge):
+            self.batch = BatchRecorder(emails, details=emails.details)
+            self.total = emails.count()
+        else:
+            self.batch = BatchRecorder(emails)
+            self.total = len(emails) if isinstance(emails, list) else None
+
+        self.status = 'queued'
+        self.results = {}
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.summary = None
+        self.error = None
+        self.stats = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.timings = PhaseTimings()
+        if isinstance(emails, MailMerge):
+            emails.timings = self.timings
+        self.version = 0
+        self._changed = threading.Condition()
+
+    @classmethod
+    def restore(cls, row, messages):
+        """Rebuild an interrupted job from its journal rows (see SendJournal.recover)."""
+        job_id, created_at, total, settings, is_merge = row
+        settings = json.loads(settings)
+        if is_merge:
+            emails = MailMerge(settings)
+            emails.details.rows.extend(emails.rows())
+        else:
+            # Emails are journalled as they are queued, so a stream cut short ends there
+            emails = [json.loads(payload) if payload else {} for *_, payload in messages]
+            total = len(emails)
+        job = cls(settings, emails, job_id=job_id)
+        if not is_merge:
+            job.batch.details.extend(message_details(email_data) for email_data in emails)
+        job.total = total
+        job.created_at = created_at
+        job.status = 'interrupted'
+        for index, recipient, status, code, response, message_id, relay, _ in messages:
+            if status in ('queued', 'sending'):
+                continue
+            if status == 'unknown':
+                response = 'Interrupted while sending; it may have been delivered, so it is not resent.'
+            job._record({'index': index, 'email': recipient, 'success': status == 'sent',
+                         'skipped': status == 'skipped', 'error': response, 'code': code,
+                         'messageId': message_id, 'relay': relay})
+        job.summary = (f"Interrupted after {len(job.results)} of {total if total is not None else '?'} "
+                       f"emails. Resume to send the rest.")
+        return job
+
+    @property
+    def finished(self):
+        return self.status in ('completed', 'failed', 'interrupted')
+
+    def resume(self, settings):
+        """Continue an interrupted job with fresh SMTP credentials, skipping finished rows."""
+        self.accounts = smtp_accounts(dict(self.settings, **{key: value for key, value in settings.items() if value}))
+        self._update(status='queued', summary=None, error=None, finished_at=None)
+        self.start()
+
+    def start(self):
+        """Run the job on a background thread."""
+        threading.Thread(target=self.run, name=f'send-job-{self.id}', daemon=True).start()
+
+    def run(self):
+        self._update(status='running', started_at=time.time())
+        status = 'completed'
+        journal = send_journal
+        if journal:
+            journal.start_job(self)
+        try:
+            self._deliver(journal)
+            if self.batch.error:
+                self.summary += f" {self.batch.error}"
+            if isinstance(self.emails, MailMerge) and self.emails.warnings():
+                self.summary += f" {self.emails.warnings()}"
+        except Exception as e:
+            self.error = f'Server error: {str(e)}'
+            status = 'failed'
+        finally:
+            if isinstance(self.emails, StreamFeed):
+                self.emails.close()
+            self.accounts = []  # Do not keep passwords around once the job is done
+            self._update(status=status, finished_at=time.time())
+            if journal:
+                journal.finish_job(self.id, status, self.summary or self.error)
+
+    def _screen(self):
+        return RecipientScreen(self.settings.get('duplicateRecipients'), suppression_list,
+                               shared=SMTP_MAX_RECIPIENTS > 1)
+
+    def _deliver(self, journal=None):
+        done = set(self.results)  # Rows finished before an interruption
+        emails, on_result, on_send = self.batch, self._record, None
+        if journal:
+            def on_send(indexes):
+                journal.sending(self.id, indexes)
+
+            def on_result(result):
+                journal.finished(self.id, result)
+                self._record(result)
+
+            emails = self._journal_queued(journal, done)
+        accounts = demo_accounts(self.accounts) if self.demo else self.accounts
+        relays = [Relay.from_account(account, self.timings) for account in accounts]
+        try:
+            screen = self._screen()
+            engine = DeliveryEngine(relays=relays, timings=self.timings, renderer=render_pool, screen=screen)
+            results, self.stats = engine.run(emails, on_result=on_result, on_send=on_send, skip=done)
+        finally:
+            for relay in relays:
+                relay.pool.close()
+        accounts = f" and {len(relays)} SMTP accounts" if len(relays) > 1 else ''
+        warm = f", {self.stats['warmConnections']} kept warm from earlier" if self.stats['warmConnections'] else ''
+        self.summary = (f"Processed {len(results)} emails in {self.stats['elapsed']:.1f}s "
+                        f"({self.stats['messagesPerSecond']:.1f}/s over {self.stats['connections']} connection(s)"
+                        f"{warm}{accounts}).")
+        if self.demo:
+            self.summary = f"Demo Mode, nothing left this machine: {self.summary}"
+        for relay in relays:
+            if relay.error:
+                self.summary += f" {relay.name} was dropped: {relay.error}"
+        self.summary += screen.summary()
+        if self.skipped:
+            self.summary += f" {self.skipped} email(s) had no recipient left and were not sent."
+        if done:
+            self.summary += f" Resumed after {len(done)} emails already processed."
+        if self.stats['throttled']:
+            self.summary += (f" The server asked to slow down {self.stats['throttled']} time(s); "
+                             f"sending continued at up to {self.stats['rateLimit']:.1f}/s.")
+
+    def _journal_queued(self, journal, done):
+        """
+        Journal each email as the engine takes it. Merges are re-rendered on
+        resume; other emails are kept, with any inline attachment moved to the
+        attachment store so the journal holds its hash rather than its data.
+        """
+        is_merge = isinstance(self.emails, MailMerge)
+        stored = OrderedDict()  # Inline attachment data -> its reference, for rows repeating the same file
+        for index, email_data in enumerate(self.batch):
+            if not is_merge and email_data.get('attachments'):
+                email_data = store_inline_attachments(email_data, stored)
+            if index not in done:
+                journal.queued(self.id, index, email_data.get('to'), None if is_merge else email_data)
+            yield email_data
+
+    def _record(self, result):
+        with self._changed:
+            self.results[result['index']] = result
+            if result['success']:
+                self.sent += 1
+            elif result.get('skipped'):
+                self.skipped += 1
+            else:
+                self.failed += 1
+            self.version += 1
+            self._changed.notify_all()
+
+    def _update(self, **fields):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def wait_for_update(self, version, timeout):
+        """Block until the job changes past `version` (or timeout). Returns the new version."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def ordered_results(self):
+        with self._changed:
+            return [self.results[index] for index in sorted(self.results)]
+
+    def snapshot(self, include_results=False):
+        """JSON-ready progress; finished jobs also carry the /send-emails response fields."""
+        data = {
+            'success': self.status != 'failed',
+            'jobId': self.id,
+            'batchId': self.id,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.sent + self.failed + self.skipped,
+            'sent': self.sent,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'summary': self.summary,
+            'error': self.error,
+            'stats': self.stats,
+            'timings': self.timings.as_dict(),
+            'createdAt': self.created_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at,
+        }
+        if include_results:
+            data['results'] = self.ordered_results()
+        return data
+
+
+def register_job(job):
+    """Track a job, forgetting the oldest finished ones beyond SEND_HISTORY_LIMIT."""
+    with _send_jobs_lock:
+        _send_jobs[job.id] = job
+        finished = [job_id for job_id, other in _send_jobs.items() if other.finished]
+        for job_id in finished[:max(0, len(_send_jobs) - SEND_HISTORY_LIMIT)]:
+            del _send_jobs[job_id]
+
+
+def get_job(job_id):
+    with _send_jobs_lock:
+        return _send_jobs.get(job_id)
+
+
+def list_jobs():
+    with _send_jobs_lock:
+        return list(_send_jobs.values())
+
+
+def restore_interrupted_jobs():
+    """Register the jobs the journal found unfinished, ready to be resumed."""
+    if send_journal is None:
+        return 0
+    rows = send_journal.recover()
+    restored = 0
+    for row in rows:
+        try:
+            register_job(SendJob.restore(row, send_journal.messages(row[0])))
+            restored += 1
+        except ValueError as e:
+            print(f"⚠️  Cannot restore job {row[0]}: {e}")
+    return restored
+
+
+def lookup_message(job_id, index):
+    """Return the stored details for one row of a job, or None."""
+    job = get_job(job_id)
+    if job is None or not 0 <= index < len(job.batch.details):
+        return None
+    return job.batch.details[index]
+
+
+# --- Contact Lists ---
+
+class ContactColumn:
+    """
+    One column of a contact list. Every value is appended to a single string
+    with an array of end offsets, so a 200k-row column costs one str and one
+    array rather than 200k str objects; values are sliced out when read.
+    """
+    __slots__ = ('name', 'filled', 'max_length', 'emails', 'distinct', 'distinct_capped',
+                 'text', 'offsets', '_buffer', '_seen')
+
+    def __init__(self, name):
+        self.name = name
+        self.filled = 0
+        self.max_length = 0
+        self.emails = 0
+        self.distinct = 0
+        self.distinct_capped = False
+        self.text = ''
+        self.offsets = array('Q', [0])
+        self._buffer = io.StringIO()
+        self._seen = set()
+
+    def append(self, value):
+        length = len(value)
+        if length:
+            self.filled += 1
+            if length > self.max_length:
+                self.max_length = length
+            if '@' in value and VALID_EMAIL.match(value):
+                self.emails += 1
+            seen = self._seen
+            if seen is not None:
+                seen.add(value)
+                if len(seen) > CONTACT_DISTINCT_LIMIT:
+                    self._seen = None
+                    self.distinct_capped = True
+            self._buffer.write(value)
+        self.offsets.append(self.offsets[-1] + length)
+
+    def finish(self):
+        self.text = self._buffer.getvalue()
+        self._buffer = None
+        self.distinct = CONTACT_DISTINCT_LIMIT if self._seen is None else len(self._seen)
+        self._seen = None
+
+    def value(self, index):
+        return self.text[self.offsets[index]:self.offsets[index + 1]]
+
+    def stats(self):
+        return {'name': self.name, 'filled': self.filled, 'distinct': self.distinct,
+                'distinctCapped': self.distinct_capped, 'maxLength': self.max_length, 'emails': self.emails}
+
+
+def detect_encoding(sample):
+    """Encoding of an uploaded contact list from its first bytes: UTF-8 (with or without BOM), UTF-16, else cp1252."""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1252'  # What Excel writes CSV files in on most Western Windows installs
+
+
+def sniff_dialect(sample):
+    """The CSV dialect of a sample cut at a line boundary; comma-separated if it cannot be told."""
+    import csv
+    if '\n' in sample:
+        sample = sample[:sample.rindex('\n') + 1]
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=CONTACT_DELIMITERS)
+    except csv.Error:
+        pass
+    # Ragged rows defeat the sniffer; fall back to the delimiter the header line uses most
+    header = sample.split('\n', 1)[0]
+    counts = {delimiter: header.count(delimiter) for delimiter in CONTACT_DELIMITERS}
+    delimiter = max(counts, key=counts.get)
+    if not counts[delimiter]:
+        return csv.excel  # A single column has no delimiter to find
+    return type('SniffedDialect', (csv.excel,), {'delimiter': delimiter})
+
+
+class ContactList:
+    """
+    A CSV/TSV contact list parsed on the server (RFC 4180 quoting, sniffed
+    delimiter) into interned headers and ContactColumns. The upload itself is
+    kept in the attachment store, so the dataset id is its SHA-256 and a list
+    dropped from memory (or lost to a restart) is parsed again on demand.
+    Blank rows and rows whose field count differs from the header are left
+    out, like iter_csv_rows, and reported as errors.
+    """
+    __slots__ = ('dataset_id', 'headers', 'columns', 'count', 'delimiter', 'encoding',
+                 'errors', 'error_count', 'seconds')
+
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+        self.headers = ()
+        self.columns = []
+        self.count = 0
+        self.delimiter = ','
+        self.encoding = 'utf-8'
+        self.errors = []
+        self.error_count = 0
+        self.seconds = 0.0
+
+    @classmethod
+    def load(cls, dataset_id, path):
+        """Parse the stored upload at `path`, streaming it row by row."""
+        import csv
+        started = time.perf_counter()
+        contacts = cls(dataset_id)
+        with open(path, 'rb') as raw:
+            contacts.encoding = detect_encoding(raw.read(CONTACT_SNIFF_BYTES))
+        with open(path, newline='', encoding=contacts.encoding, errors='replace') as f:
+            dialect = sniff_dialect(f.read(CONTACT_SNIFF_BYTES))
+            contacts.delimiter = dialect.delimiter
+            f.seek(0)
+            reader = csv.reader(f, dialect, strict=True)
+            contacts._read(reader)
+        for column in contacts.columns:
+            column.finish()
+        contacts.seconds = time.perf_counter() - started
+        return contacts
+
+    def _read(self, reader):
+        import csv
+        width = None
+        append = None
+        while True:
+            try:
+                values = next(reader)
+            except StopIteration:
+                break
+            except csv.Error as e:
+                self._error(reader.line_num, str(e))
+                continue
+            values = [value.strip() for value in values]
+            if not any(values):
+                continue
+            if width is None:
+                self._set_headers(reader.line_num, values)
+                width = len(values)
+                append = [column.append for column in self.columns]
+                continue
+            if len(values) != width:
+                self._error(reader.line_num, f'Row has {len(values)} fields; the header has {width}.')
+                continue
+            for add, value in zip(append, values):
+                add(value)
+            self.count += 1
+
+    def _set_headers(self, line, names):
+        self.headers = tuple(sys.intern(name) for name in names)
+        self.columns = [ContactColumn(name) for name in self.headers]
+        for name, count in Counter(self.headers).items():
+            if count > 1:
+                self._error(line, f'Column "{name}" appears {count} times; templates use the last one.')
+
+    def _error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < CONTACT_ERROR_LIMIT:
+            self.errors.append({'line': line, 'error': message})
+
+    def rows(self, start=0, stop=None):
+        """Yield each row from `start` to `stop` as a list of values in header order."""
+        stop = self.count if stop is None else min(stop, self.count)
+        columns = [(column.text, column.offsets) for column in self.columns]
+        for index in range(start, stop):
+            yield [text[offsets[index]:offsets[index + 1]] for text, offsets in columns]
+
+    def summary(self):
+        return {
+            'success': True,
+            'datasetId': self.dataset_id,
+            'headers': list(self.headers),
+            'rows': self.count,
+            'columns': [column.stats() for column in self.columns],
+            'delimiter': self.delimiter,
+            'encoding': self.encoding,
+            'errors': self.errors,
+            'errorCount': self.error_count,
+            'seconds': round(self.seconds, 3),
+        }
+
+
+class ContactLists:
+    """Parsed contact lists by dataset id, the most recently used `limit` of them kept in memory."""
+    def __init__(self, limit=CONTACT_LIST_CACHE):
+        self.limit = limit
+        self._lists = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, stream, length):
+        """Store an uploaded CSV/TSV body of `length` bytes (None: to its end) and parse it. Returns the ContactList."""
+        digest, _ = attachment_store.put(stream, length)
+        return self.get(digest)
+
+    def get(self, dataset_id):
+        """The ContactList for `dataset_id`, parsed from the store if needed. KeyError if it was never uploaded."""
+        with self._lock:
+            contacts = self._lists.get(dataset_id)
+            if contacts is not None:
+                self._lists.move_to_end(dataset_id)
+                return contacts
+        path = attachment_store.path(dataset_id)
+        if not os.path.exists(path):
+            raise KeyError(dataset_id)
+        with metrics.time('parse'):
+            contacts = ContactList.load(dataset_id, path)
+        with self._lock:
+            self._lists[dataset_id] = contacts
+            while len(self._lists) > self.limit:
+                self._lists.popitem(last=False)
+        return contacts
+
+contact_lists = ContactLists()
+
+
+# --- Server-side Mail Merge ---
+
+TEMPLATE_VARIABLE = re.compile(r'{{\s*(.*?)\s*}}')
+VALID_EMAIL = re.compile(r'^[^\s@]+@[^\s@]+\.[^\s@]+$')
+
+
+def is_valid_address(address):
+    """Whether `address` (bare or `Name <addr>`) holds a plausible email address."""
+    if '<' in address:
+        address = address[address.rindex('<') + 1:].rstrip().rstrip('>')
+    return VALID_EMAIL.match(address) is not None
+
+
+class CompiledTemplate:
+    """
+    A `{{variable}}` template split once into literal text and variable slots,
+    so rendering a row is a single join. Placeholders for variables the row
+    does not have are kept verbatim, like mergeTemplate in script.js.
+    """
+    __slots__ = ('variables', '_head', '_slots')
+
+    def __init__(self, text):
+        text = text or ''
+        literals, names, placeholders = [], [], []
+        position = 0
+        for match in TEMPLATE_VARIABLE.finditer(text):
+            literals.append(text[position:match.start()])
+            names.append(match.group(1))
+            placeholders.append(match.group(0))
+            position = match.end()
+        literals.append(text[position:])
+        self._head = literals[0]
+        self._slots = tuple(zip(names, placeholders, literals[1:]))
+        self.variables = frozenset(names)
+
+    def render(self, row):
+        if not self._slots:
+            return self._head
+        out = [self._head]
+        for name, placeholder, literal in self._slots:
+            value = row.get(name)
+            out.append(placeholder if value is None else value)
+            out.append(literal)
+        return ''.join(out)
+
+
+def iter_csv_rows(csv_text):
+    """
+    Yield (headers, values) for each data row of CSV text. Blank rows and rows
+    whose field count differs from the header are skipped, like parseCSV in script.js.
+    """
+    import csv
+    reader = csv.reader(io.StringIO((csv_text or '').strip()))
+    headers = [sys.intern(header.strip()) for header in next(reader, [])]
+    for values in reader:
+        values = [value.strip() for value in values]
+        if len(values) == len(headers) and any(values):
+            yield headers, values
+
+
+class MailMerge:
+    """
+    Renders the emails of a merge on the server from the templates and the raw
+    CSV posted by the client. Templates are compiled once and each row is
+    rendered only when the delivery engine asks for it.
+    """
+    def __init__(self, data):
+        self.from_name = CompiledTemplate(data.get('fromName'))
+        self.from_email = CompiledTemplate(data.get('fromEmail'))
+        self.to = CompiledTemplate(data.get('toEmail'))
+        self.cc = CompiledTemplate(data.get('ccEmail'))
+        self.bcc = CompiledTemplate(data.get('bccEmail'))
+        self.subject = CompiledTemplate(data.get('subject'))
+        self.body = CompiledTemplate(data.get('template'))
+        self.variable_attachments = CompiledTemplate(data.get('variableAttachments'))
+        self.delimiter = data.get('attachmentDelimiter') or ';'
+        self.csv_data = data.get('csvData') or ''
+        self.dataset_id = data.get('datasetId')  # An uploaded contact list, used instead of csvData
+
+        # Attachments are references ({filename, hash, size}) into the attachment store
+        self.common_attachments = list(data.get('commonAttachments') or [])
+        self.attachment_files = data.get('attachmentFiles') or {}
+        self.row_attachments = {int(row): refs for row, refs in (data.get('rowAttachments') or {}).items()}
+        self.excluded_rows = set(data.get('excludedRows') or [])
+
+        smtp_user = data.get('smtpUser') or ''
+        self.fallback_from = smtp_user if VALID_EMAIL.match(smtp_user) else ''
+        self.missing_attachments = set()
+        self.details = MergeDetails(self)
+        self.timings = None  # PhaseTimings of the job sending this merge
+
+    def source_rows(self):
+        """(headers, values) for every data row, from the uploaded contact list or the posted CSV."""
+        if not self.dataset_id:
+            return iter_csv_rows(self.csv_data)
+        try:
+            contacts = contact_lists.get(self.dataset_id)
+        except KeyError:
+            raise ValueError('Contact list not found; import the CSV file again.') from None
+        return ((contacts.headers, values) for values in contacts.rows())
+
+    def count(self):
+        """Number of emails the merge will produce."""
+        return sum(1 for index, _ in enumerate(self.source_rows()) if index not in self.excluded_rows)
+
+    def rows(self):
+        """(index, headers, values) for each CSV row that will be sent."""
+        for index, (headers, values) in enumerate(self.source_rows()):
+            if index not in self.excluded_rows:
+                yield index, headers, values
+
+    def window(self, start, stop):
+        """(headers, values) for the data rows from `start` to `stop`, excluded or not."""
+        if self.dataset_id:
+            contacts = contact_lists.get(self.dataset_id)
+            return ((contacts.headers, values) for values in contacts.rows(start, stop))
+        return itertools.islice(iter_csv_rows(self.csv_data), start, stop)
+
+    def __iter__(self):
+        self.details.rows.clear()
+        for index, headers, values in self.rows():
+            self.details.rows.append((index, headers, values))
+            with metrics.time('render', self.timings):
+                email_data = self.render(index, headers, values)
+            yield email_data
+
+    def sender(self, row):
+        """(name, address, From value) for a row; the SMTP user stands in for an empty address."""
+        from_name = self.from_name.render(row)
+        from_email = self.from_email.render(row) or self.fallback_from
+        sender = from_email
+        if from_name:
+            escaped_name = from_name.replace('"', '\\"')
+            sender = f'"{escaped_name}" <{from_email}>'
+        return from_name, from_email, sender
+
+    def templates(self):
+        return (self.from_name, self.from_email, self.to, self.cc, self.bcc, self.subject, self.body,
+                self.variable_attachments)
+
+    def render(self, index, headers, values):
+        """Render the email for data row `index`."""
+        row = dict(zip(headers, values))
+        return {
+            'from': self.sender(row)[2],
+            'to': self.to.render(row),
+            'cc': self.cc.render(row),
+            'bcc': self.bcc.render(row),
+            'subject': self.subject.render(row),
+            'body': self.body.render(row),
+            'attachments': self.attachments_for(index, row),
+        }
+
+    def attachments_for(self, index, row):
+        if index in self.row_attachments:
+            # Attachments edited in the preview replace the template's for that row
+            return self.row_attachments[index]
+        attachments = list(self.common_attachments)
+        names = {attachment.get('filename') for attachment in attachments}
+        for filename in self.variable_attachments.render(row).split(self.delimiter):
+            filename = filename.strip()
+            if not filename or filename in names:
+                continue
+            reference = self.resolve_attachment(filename)
+            if reference is None:
+                self.missing_attachments.add(filename)
+                continue
+            attachments.append(dict(reference, filename=filename))
+            names.add(filename)
+        return attachments
+
+    def resolve_attachment(self, filename):
+        """Find an uploaded file by exact name, then by partial match (as script.js does)."""
+        if filename in self.attachment_files:
+            return self.attachment_files[filename]
+        for name, reference in self.attachment_files.items():
+            if name in filename or filename in name:
+                return reference
+        return None
+
+    def warnings(self):
+        if not self.missing_attachments:
+            return ''
+        return 'Attachments not found: ' + ', '.join(sorted(self.missing_attachments)) + '.'
+
+
+# --- Merge Preview ---
+
+class MergePreview:
+    """
+    A merge rendered for the preview pane a window of rows at a time. Rendered
+    rows are kept in a small LRU, and the checks (variables missing from the
+    data, empty values, unresolved attachments, rows without a valid recipient
+    or sender, recipients repeated from an earlier row or suppressed) are
+    gathered in one pass over the rows without rendering bodies.
+    """
+    def __init__(self, preview_id, data):
+        self.id = preview_id
+        self.merge = MailMerge(data)
+        self.duplicates = duplicate_policy(data.get('duplicateRecipients'))  # What a send would do with them
+        self.total = 0
+        self.checks = None
+        self._rendered = OrderedDict()
+        self._lock = threading.Lock()
+        with metrics.time('render'):
+            self._check()
+
+    def _check(self):
+        merge = self.merge
+        variables = set()
+        for template in merge.templates():
+            variables |= template.variables
+        headers = None
+        used = ()
+        empty = Counter()
+        missing_attachments = Counter()
+        resolved = {}
+        no_recipient, no_sender, duplicates = [], [], []
+        count_without_recipient = count_without_sender = count_duplicates = 0
+        screen = RecipientScreen('flag', suppression_list)
+        for index, (headers, values) in enumerate(merge.source_rows()):
+            if index == 0:
+                used = [(position, name) for position, name in enumerate(headers) if name in variables]
+            for position, name in used:
+                if not values[position]:
+                    empty[name] += 1
+            row = dict(zip(headers, values))
+            to = merge.to.render(row)
+            if not any(is_valid_address(address) for address in split_addresses(to)):
+                count_without_recipient += 1
+                if len(no_recipient) < PREVIEW_CHECK_LIMIT:
+                    no_recipient.append(index)
+            _, notes = screen.check(index, {'to': to})
+            if any(note['reason'] == 'duplicate' for note in notes):
+                count_duplicates += 1
+                if len(duplicates) < PREVIEW_CHECK_LIMIT:
+                    duplicates.append(index)
+            if not merge.sender(row)[1]:
+                count_without_sender += 1
+                if len(no_sender) < PREVIEW_CHECK_LIMIT:
+                    no_sender.append(index)
+            if merge.variable_attachments.variables:
+                for filename in merge.variable_attachments.render(row).split(merge.delimiter):
+                    filename = filename.strip()
+                    if not filename:
+                        continue
+                    if filename not in resolved:
+                        resolved[filename] = merge.resolve_attachment(filename) is not None
+                    if not resolved[filename]:
+                        missing_attachments[filename] += 1
+            self.total = index + 1
+        self.checks = {
+            'missingVariables': sorted(variables - set(headers or ())),
+            'emptyValues': dict(empty),
+            'missingAttachments': dict(missing_attachments.most_common(PREVIEW_CHECK_LIMIT)),
+            'missingAttachmentCount': len(missing_attachments),
+            'rowsWithoutRecipient': no_recipient,
+            'rowsWithoutRecipientCount': count_without_recipient,
+            'rowsWithoutSender': no_sender,
+            'rowsWithoutSenderCount': count_without_sender,
+            'rowsWithDuplicateRecipient': duplicates,
+            'rowsWithDuplicateRecipientCount': count_duplicates,
+            'duplicatePolicy': self.duplicates,
+            'suppressedRecipientCount': screen.counts['suppressed'],
+        }
+
+    def render_row(self, index, headers, values):
+        merge = self.merge
+        row = dict(zip(headers, values))
+        from_name, from_email, sender = merge.sender(row)
+        return {
+            'index': index,
+            'fromName': from_name,
+            'fromEmail': from_email,
+            'from': sender,
+            'to': merge.to.render(row),
+            'cc': merge.cc.render(row),
+            'bcc': merge.bcc.render(row),
+            'subject': merge.subject.render(row),
+            'body': merge.body.render(row),
+            'attachments': merge.attachments_for(index, row),
+        }
+
+    def page(self, offset, limit):
+        """The rendered emails for rows `offset` to `offset + limit`."""
+        stop = min(self.total, offset + limit)
+        with self._lock:
+            cached = [self._rendered.get(index) for index in range(offset, stop)]
+        if all(email is not None for email in cached):
+            emails = cached
+        else:
+            with metrics.time('render'):
+                emails = [self.render_row(index, headers, values) for index, (headers, values)
+                          in enumerate(self.merge.window(offset, stop), offset)]
+        with self._lock:
+            for email in emails:
+                self._rendered[email['index']] = email
+                self._rendered.move_to_end(email['index'])
+            while len(self._rendered) > PREVIEW_CACHE_ROWS:
+                self._rendered.popitem(last=False)
+        return emails
+
+    def response(self, offset, limit):
+        return {'success': True, 'previewId': self.id, 'total': self.total, 'offset': offset,
+                'emails': self.page(offset, limit), 'checks': self.checks}
+
+
+class MergePreviews:
+    """Previews by id (a hash of the merge inputs), the most recently used `limit` kept."""
+    def __init__(self, limit=PREVIEW_CACHE):
+        self.limit = limit
+        self._previews = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, data):
+        """The MergePreview for these merge inputs, reusing one made from identical inputs."""
+        inputs = {key: value for key, value in data.items()
+                  if key not in ('smtpPassword', 'offset', 'limit', 'excludedRows')}
+        preview_id = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        preview = self.get(preview_id)
+        if preview is None:
+            preview = MergePreview(preview_id, inputs)
+            with self._lock:
+                self._previews[preview_id] = preview
+                while len(self._previews) > self.limit:
+                    self._previews.popitem(last=False)
+        return preview
+
+    def get(self, preview_id):
+        with self._lock:
+            preview = self._previews.get(preview_id)
+            if preview is not None:
+                self._previews.move_to_end(preview_id)
+            return preview
+
+merge_previews = MergePreviews()
+
+
+# --- Request Parsing ---
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/jsonl')
+
+
+_request_encodings = None  # Worked out by request_encodings() on first use
+
+
+def request_encodings():
+    """The Content-Encodings POST bodies may use; zstd only with a zstd module to decode it."""
+    global _request_encodings
+    if _request_encodings is None:
+        import importlib.util
+        encodings = ('identity', 'gzip', 'x-gzip')
+        if importlib.util.find_spec('compression.zstd' if sys.version_info >= (3, 14) else 'zstandard'):
+            encodings += ('zstd',)
+        _request_encodings = encodings
+    return _request_encodings
+
+
+class RequestBody(io.RawIOBase):
+    """The `length` bytes of a request body in `stream`; reads stop there rather than block on the socket."""
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining <= 0:
+            return 0
+        count = self._stream.readinto(memoryview(buffer)[:self.remaining])
+        if not count:
+            raise ValueError('Request body ended before Content-Length bytes were received.')
+        self.remaining -= count
+        return count
+
+
+class InflatedBody(io.RawIOBase):
+    """
+    A gzip or zstd request body, decompressed as it is read so a large upload
+    is parsed without ever being held whole, compressed or not. Any fault in
+    the body (cut short, corrupt, or expanding past HTTP_INFLATED_BODY_LIMIT)
+    is raised as a ValueError, like one in an uncompressed body.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, length, encoding):
+        body = RequestBody(stream, length)
+        self.encoding = encoding
+        self.size = 0
+        if encoding in ('gzip', 'x-gzip'):
+            self._reader = gzip.GzipFile(fileobj=body, mode='rb')
+        elif encoding == 'zstd' and sys.version_info >= (3, 14):
+            from compression import zstd
+            self._reader = zstd.ZstdFile(body)
+        elif encoding == 'zstd':
+            import zstandard
+            self._reader = zstandard.ZstdDecompressor().stream_reader(body, read_across_frames=True)
+        else:
+            raise ValueError(f'Unsupported Content-Encoding: {encoding}')
+
+    @classmethod
+    def open(cls, stream, length, encoding):
+        """The decompressed body as a buffered file object (with readline) for iter_ndjson and json."""
+        return io.BufferedReader(cls(stream, length, encoding), cls.CHUNK_SIZE)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            count = self._reader.readinto(buffer)
+        except ValueError:
+            raise
+        except Exception as e:  # EOFError, gzip.BadGzipFile, zlib.error, ZstdError
+            raise ValueError(f'Invalid {self.encoding} request body: {e}') from None
+        self.size += count
+        if self.size > HTTP_INFLATED_BODY_LIMIT:
+            raise ValueError(f'Request body expands past {HTTP_INFLATED_BODY_LIMIT} bytes.')
+        return count
+
+
+def iter_ndjson(stream, length):
+    """
+    Yield one parsed JSON value per line of an NDJSON body of `length` bytes
+    (None: up to the end of `stream`, as for a decompressed body).
+    """
+    remaining = length
+    while remaining is None or remaining > 0:
+        line = stream.readline() if remaining is None else stream.readline(remaining)
+        if not line and remaining is None:
+            return
+        if not line:
+            raise ValueError('Request body ended before Content-Length bytes were received.')
+        if remaining is not None:
+            remaining -= len(line)
+        line = line.strip()
+        if line:
+            with metrics.time('parse'):
+                value = json.loads(line)
+            yield value
+
+
+# --- HTTP Server Core ---
+
+class BoundedThreadingHTTPServer(socketserver.TCPServer):
+    """
+    Serves connections on a fixed pool of worker threads. Accepted connections
+    wait in a queue of at most `queue_depth`; beyond that they get an immediate
+    503 so a burst cannot pile up unbounded threads or memory.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers=None, queue_depth=None):
+        super().__init__(server_address, handler_class)
+        self.workers = workers or HTTP_WORKERS
+        self._requests = queue.Queue(maxsize=queue_depth or HTTP_QUEUE_DEPTH)
+        for number in range(self.workers):
+            threading.Thread(target=self._work, name=f'http-worker-{number}', daemon=True).start()
+
+    def process_request(self, request, client_address):
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self._reject(request)
+
+    def _reject(self, request):
+        metrics.inc('envialite_http_rejected_total')
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n'
+                            b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in range(self.workers):
+            self._requests.put(None)  # Let each worker finish its connection and exit
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+# --- Original Server Handler Class ---
+
+class EmailMergeHandler(http.server.SimpleHTTPRequestHandler):
+    def __init__(self, *args, **kwargs):
+        # The directory needs to be set to the location of the assets (index.html, etc.)
+        # This is correctly handled by resource_path in the do_GET method now, so we remove the directory kwarg
+        # and simply rely on the default behavior for SimpleHTTPRequestHandler setup.
+        super().__init__(*args, **kwargs)
+
+    def end_headers(self):
+        # Enable CORS for all responses
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Encoding')
+        super().end_headers()
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        # This endpoint is now handled by do_GET
+        if self.path == '/api/status':
+            self.send_error(405, "Method Not Allowed")
+            return
+        encoding = self.headers.get('Content-Encoding', 'identity').strip().lower() or 'identity'
+        if encoding not in request_encodings():
+            self.close_connection = True  # The body is not read
+            self.send_json_response({'success': False, 'error': f'Unsupported Content-Encoding: {encoding}',
+                                     'encodings': list(request_encodings())}, status=415)
+            return
+        if self.path == '/api/attachments':
+            # Raw file bytes; stored once and referenced by hash from /send-emails
+            try:
+                body, content_length = self.request_body()
+                digest, size = attachment_store.put(body, content_length)
+                self.send_json_response({'success': True, 'hash': digest, 'size': size})
+            except Exception as e:
+                self.close_connection = True  # The rest of the body was not read
+                self.send_json_response({'success': False, 'error': f'Upload failed: {str(e)}'}, status=400)
+            return
+        if self.path == '/api/jobs':
+            # Start the send in the background and return its id straight away
+            try:
+                job, stream = self.create_send_job()
+                if job is None:
+                    return
+                if stream is not None:
+                    # Streamed bodies are read here, feeding the running job
+                    job.start()
+                    if not job.emails.pump(stream):
+                        self.close_connection = True  # A job that stopped early leaves NDJSON lines unread
+                else:
+                    job.start()
+                self.send_json_response(job.snapshot())
+            except Exception as e:
+                self.close_connection = True
+                self.send_json_response({'success': False, 'error': f'Server error: {str(e)}'})
+            return
+        if self.path == '/api/preview':
+            # The merge inputs of /send-emails; replies with one window of rendered rows and the checks
+            try:
+                body, content_length = self.request_body()
+                data = json.loads(body.read(content_length))
+                offset, limit = self.preview_window(data.get('offset'), data.get('limit'))
+                self.send_json_response(merge_previews.create(data).response(offset, limit))
+            except Exception as e:
+                self.send_json_response({'success': False, 'error': f'Preview failed: {str(e)}'}, status=400)
+            return
+        if self.path == '/api/contacts':
+            # A CSV/TSV contact list, parsed here and referenced by datasetId from merges
+            try:
+                body, content_length = self.request_body()
+                contacts = contact_lists.put(body, content_length)
+                self.send_json_response(contacts.summary())
+            except Exception as e:
+                self.close_connection = True
+                self.send_json_response({'success': False, 'error': f'Import failed: {str(e)}'}, status=400)
+            return
+        if self.path == '/api/suppressions':
+            # {"add": [...], "remove": [...]}: addresses sends must skip (unsubscribes, bounces)
+            try:
+                body, content_length = self.request_body()
+                data = json.loads(body.read(content_length) or b'{}')
+            except (ValueError, json.JSONDecodeError):
+                self.send_json_response({'success': False, 'error': 'Invalid JSON format.'}, status=400)
+                return
+            lists = [data.get(key) or [] for key in ('add', 'remove')] if isinstance(data, dict) else None
+            if lists is None or not all(isinstance(addresses, list) and all(isinstance(address, str)
+                                                                        for address in addresses)
+                                        for addresses in lists):
+                self.send_json_response({'success': False, 'error': 'Expected {"add": [...], "remove": [...]} '
+                                                                    'with lists of addresses.'}, status=400)
+                return
+            if suppression_list is None:
+                self.send_json_response({'success': False, 'error': 'The suppression list is disabled.'},
+                                        status=409)
+                return
+            added = suppression_list.add(lists[0])
+            removed = suppression_list.remove(lists[1])
+            self.send_json_response({'success': True, 'added': added, 'removed': removed,
+                                     'count': len(suppression_list)})
+            return
+        resume_match = re.match(r'^/api/jobs/([0-9a-f]+)/resume$', self.path)
+        if resume_match:
+            self.resume_send_job(resume_match.group(1))
+            return
+        if self.path == '/send-emails':
+            try:
+                job, stream = self.create_send_job(background=False)
+                if job is None:
+                    return
+                job.run()
+                if job.status != 'completed' or job.batch.error:
+                    # A streamed body is only read as far as the job got; do not parse the rest as a request
+                    self.close_connection = True
+                if job.status == 'failed':
+                    self.send_json_response({'success': False, 'error': job.error})
+                else:
+                    self.send_json_response(job.snapshot(include_results=True))
+
+            except Exception as e:
+                self.close_connection = True
+                self.send_json_response({'success': False, 'error': f'Server error: {str(e)}'})
+
+        elif self.path == '/test-smtp':
+            self.send_json_response(self.test_smtp_connection())
+        else:
+            self.send_error(404)
+
+    def test_smtp_connection(self):
+        """
+        /test-smtp: log in once with the posted account (to the demo sink in
+        Demo Mode) and return the reply. The connection stays warm in
+        smtp_sessions, so the send that follows skips the login.
+        """
+        import smtplib
+        try:
+            body, content_length = self.request_body()
+            data = json.loads(body.read(content_length).decode('utf-8'))
+        except (TypeError, ValueError):
+            return {'success': False, 'error': 'Invalid JSON format.'}
+        account = {'smtpServer': data.get('smtpServer'), 'smtpPort': data.get('smtpPort'),
+                   'smtpUser': data.get('smtpUser'), 'smtpPassword': data.get('smtpPassword'),
+                   'smtpSecurity': data.get('smtpSecurity'), 'name': data.get('smtpServer') or 'demo'}
+        if DEMO_MODE:
+            account = demo_accounts([account])[0]
+        elif not all([account['smtpServer'], account['smtpPort'], account['smtpUser'], account['smtpPassword']]):
+            return {'success': False, 'error': 'Missing SMTP credentials.'}
+        try:
+            pool = SMTPConnectionPool(account['smtpServer'], account['smtpPort'], account['smtpUser'],
+                                      account['smtpPassword'], size=1, security=account['smtpSecurity'])
+            pool.release(pool.acquire())
+            pool.close()
+        except smtplib.SMTPAuthenticationError:
+            return {'success': False, 'error': 'Authentication failed. Check username/password.'}
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+        return {'success': True, 'warm': pool.connects == 0, 'demo': DEMO_MODE}
+
+    def create_send_job(self, background=True):
+        """
+        Parse a send request into a registered SendJob. Returns (job, stream):
+        `stream` is the NDJSON line iterator a background job must be fed from
+        (via its StreamFeed), else None. Replies and returns (None, None) if
+        the request is invalid.
+        """
+        started = time.perf_counter()
+        data, emails = self.read_send_request()
+        parse_seconds = time.perf_counter() - started
+        metrics.observe('parse', parse_seconds)
+        try:
+            accounts = smtp_accounts(data)
+            duplicate_policy(data.get('duplicateRecipients'))
+        except ValueError as e:
+            self.close_connection = True  # A streamed body is left unread
+            self.send_json_response({'success': False, 'error': str(e)})
+            return None, None
+        incomplete = [account for account in accounts if not all([account['smtpPort'], account['smtpUser'],
+                                                                  account['smtpPassword']])]
+        if not DEMO_MODE and (not accounts or incomplete):
+            self.close_connection = True
+            error = f"Missing SMTP credentials for {incomplete[0]['name']}." if incomplete else 'Missing SMTP credentials.'
+            self.send_json_response({'success': False, 'error': error})
+            return None, None
+
+        stream = None
+        if background and not isinstance(emails, (list, MailMerge)):
+            stream, emails = emails, StreamFeed()
+        job = SendJob(data, emails)
+        job.timings.add('parse', parse_seconds)
+        register_job(job)
+        return job, stream
+
+    def resume_send_job(self, job_id):
+        """Restart an interrupted job; the body carries the SMTP settings (the password is never journalled)."""
+        try:
+            body, content_length = self.request_body()
+            data = json.loads(body.read(content_length) or b'{}')
+        except (ValueError, json.JSONDecodeError):
+            self.send_json_response({'success': False, 'error': 'Invalid JSON format.'}, status=400)
+            return
+        job = get_job(job_id)
+        if job is None:
+            self.send_json_response({'success': False, 'error': 'Job not found.'}, status=404)
+        elif job.status != 'interrupted':
+            self.send_json_response({'success': False, 'error': f'Job is {job.status}, not interrupted.'}, status=409)
+        elif not job.demo and not data.get('smtpPassword'):
+            self.send_json_response({'success': False, 'error': 'Missing SMTP credentials.'})
+        else:
+            job.resume(data)
+            self.send_json_response(job.snapshot())
+
+    def request_body(self):
+        """
+        The POST body as (file object, length). A gzip or zstd Content-Encoding
+        is decompressed as the body is read; the length is then None and
+        readers go to the end of the file object.
+        """
+        content_length = int(self.headers.get('Content-Length') or 0)
+        encoding = self.headers.get('Content-Encoding', 'identity').strip().lower() or 'identity'
+        if encoding == 'identity':
+            return self.rfile, content_length
+        return InflatedBody.open(self.rfile, content_length, encoding), None
+
+    def read_send_request(self):
+        """
+        Parse a /send-emails body into (settings, emails).
+        A JSON object carries the emails in its 'emails' list. An NDJSON body
+        (Content-Type: application/x-ndjson) has the settings object on the
+        first line and one email per following line; those emails are parsed
+        lazily so delivery starts while the upload is still arriving.
+        Settings with a 'template' and no emails describe a server-side merge
+        of the template with 'csvData' (or the uploaded contact list 'datasetId').
+        """
+        body, content_length = self.request_body()
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type in NDJSON_CONTENT_TYPES:
+            lines = iter_ndjson(body, content_length)
+            settings = next(lines, None) or {}
+            if 'template' in settings:
+                self.close_connection = True  # Any lines after the settings are not read
+                return settings, MailMerge(settings)
+            return settings, lines
+        data = json.loads(body.read(content_length))
+        if 'template' in data and 'emails' not in data:
+            return data, MailMerge(data)
+        return data, data.get('emails', [])
+
+    def do_GET(self):
+        """Handle file requests (index.html, styles.css, script.js) with language support"""
+        if self.path == '/favicon.ico':
+            self.send_response(204)  # No Content
+            self.end_headers()
+            return
+
+        # Add a new endpoint to get the server status
+        if self.path == '/api/status':
+            self.send_json_response({'demoMode': DEMO_MODE})
+            return
+
+        # Lets the client skip re-uploading attachments the store already has
+        attachment_match = re.match(r'^/api/attachments/([0-9a-f]{64})$', self.path)
+        if attachment_match:
+            size = attachment_store.size(attachment_match.group(1))
+            if size is None:
+                self.send_json_response({'success': False, 'error': 'Attachment not found.'}, status=404)
+            else:
+                self.send_json_response({'success': True, 'hash': attachment_match.group(1), 'size': size})
+            return
+
+        # Send jobs: list, progress/results, and live progress as Server-Sent Events
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/api/metrics':
+            job_id = urllib.parse.parse_qs(url.query).get('job', [None])[0]
+            if job_id is None:
+                self.send_text_response(metrics.render(), PROMETHEUS_CONTENT_TYPE)
+                return
+            job = get_job(job_id)
+            if job is None:
+                self.send_json_response({'success': False, 'error': 'Job not found.'}, status=404)
+            else:
+                self.send_text_response(render_job_timings(job), PROMETHEUS_CONTENT_TYPE)
+            return
+        preview_match = re.match(r'^/api/preview/([0-9a-f]{16})$', url.path)
+        if preview_match:
+            preview = merge_previews.get(preview_match.group(1))
+            query = urllib.parse.parse_qs(url.query)
+            if preview is None:
+                self.send_json_response({'success': False, 'error': 'Preview expired; generate it again.'},
+                                        status=404)
+                return
+            try:
+                offset, limit = self.preview_window(query.get('offset', [0])[0], query.get('limit', [None])[0])
+                self.send_json_response(preview.response(offset, limit))
+            except ValueError:
+                self.send_json_response({'success': False, 'error': 'Invalid offset or limit.'}, status=400)
+            return
+        contacts_match = re.match(r'^/api/contacts/([0-9a-f]{64})$', url.path)
+        if contacts_match:
+            self.send_contact_rows(contacts_match.group(1), urllib.parse.parse_qs(url.query))
+            return
+        if url.path == '/api/jobs':
+            self.send_json_response({'success': True, 'jobs': [job.snapshot() for job in list_jobs()]})
+            return
+        if url.path == '/api/suppressions':
+            addresses = suppression_list.addresses() if suppression_list is not None else []
+            self.send_json_response({'success': True, 'count': len(addresses), 'addresses': addresses})
+            return
+        job_match = re.match(r'^/api/jobs/([0-9a-f]+)(/events)?$', url.path)
+        if job_match:
+            job = get_job(job_match.group(1))
+            if job is None:
+                self.send_json_response({'success': False, 'error': 'Job not found.'}, status=404)
+            elif job_match.group(2):
+                self.stream_job_events(job)
+            else:
+                query = urllib.parse.parse_qs(url.query)
+                include_results = job.finished or query.get('results') == ['1']
+                self.send_json_response(job.snapshot(include_results=include_results))
+            return
+
+        # Full details for one row of a finished send (results only carry an index)
+        message_match = re.match(r'^/api/(?:messages|jobs)/([0-9a-f]+)/(?:messages/)?(\d+)$', url.path)
+        if message_match:
+            message = lookup_message(message_match.group(1), int(message_match.group(2)))
+            if message is None:
+                self.send_json_response({'success': False, 'error': 'Message not found.'}, status=404)
+            else:
+                self.send_json_response({'success': True, 'message': message})
+            return
+
+        # Parse the URL path (without any query string); only the files in STATIC_ASSETS are served
+        requested_path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/')
+
+        # Determine language from path prefix (e.g., /es/index.html)
+        # This logic is used when the GUI launcher constructs a URL like http://localhost:8000/es/
+        current_lang = 'en' # Default language
+        lang_prefix_match = re.match(r'^(en|es)/', requested_path)
+        if lang_prefix_match:
+            current_lang = lang_prefix_match.group(1)
+            requested_path = requested_path[len(lang_prefix_match.group(0)):].lstrip('/') # Remove the language prefix
+
+
+        # Determine which file to serve based on the requested path and language
+        path_to_serve = 'index.html'  # Default fallback
+
+        if not requested_path or requested_path == '/':
+            # Serve language-specific index file
+            if current_lang == 'es':
+                path_to_serve = 'index-ES.html'  # Spanish file
+            elif current_lang == 'en':
+                path_to_serve = 'index.html'
+            else:
+                path_to_serve = 'index.html'     # English file (fallback)
+        elif requested_path == 'script.js':
+            # Serve language-specific script file
+            if current_lang == 'es':
+                path_to_serve = 'script-ES.js'  # Spanish script
+            elif current_lang == 'en':
+                path_to_serve = 'script.js'
+            else:
+                path_to_serve = 'script.js'    # English script (fallback)
+        else:
+            # For other resources (CSS, etc.), serve as-is
+            path_to_serve = requested_path
+
+        # If the request is for a specific language's index/script, ensure it's served
+        if requested_path == 'index.html' and current_lang == 'es':
+            path_to_serve = 'index-ES.html'
+
+        if requested_path == 'script.js' and current_lang == 'es':
+            path_to_serve = 'script-ES.js'
+
+        try:
+            asset = static_assets.get(path_to_serve)
+            if asset is None:
+                self.send_error(404, f'File Not Found: {path_to_serve}')
+                return
+            self.send_static_asset(asset)
+
+        except Exception as e:
+            print(f"Error serving file {path_to_serve}: {e}")
+            self.send_error(500, 'Internal Server Error')
+
+    @staticmethod
+    def preview_window(offset, limit):
+        """(offset, limit) of a preview request, clamped; ValueError if they are not integers."""
+        offset = max(0, int(offset or 0))
+        limit = PREVIEW_PAGE_LIMIT if limit is None else min(PREVIEW_PAGE_LIMIT, max(0, int(limit)))
+        return offset, limit
+
+    def send_contact_rows(self, dataset_id, query):
+        """A contact list's summary plus the rows from `offset`, at most `limit` of them."""
+        try:
+            offset = max(0, int(query.get('offset', ['0'])[0]))
+            limit = min(CONTACT_PAGE_LIMIT, max(0, int(query.get('limit', ['100'])[0])))
+        except ValueError:
+            self.send_json_response({'success': False, 'error': 'Invalid offset or limit.'}, status=400)
+            return
+        try:
+            contacts = contact_lists.get(dataset_id)
+        except KeyError:
+            self.send_json_response({'success': False, 'error': 'Contact list not found.'}, status=404)
+            return
+        response = contacts.summary()
+        response['offset'] = offset
+        response['data'] = list(contacts.rows(offset, offset + limit))
+        self.send_json_response(response)
+
+    def send_static_asset(self, asset):
+        """Serve a cached asset, negotiating its encoding and honouring conditional requests."""
+        coding, body = asset.negotiate(self.headers.get('Accept-Encoding'))
+        not_modified = asset.not_modified(self.headers.get('If-None-Match'),
+                                          self.headers.get('If-Modified-Since'))
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', asset.etag_for(coding))
+        self.send_header('Last-Modified', asset.last_modified)
+        self.send_header('Cache-Control', 'no-cache')  # Always revalidate; a match costs a 304
+        self.send_header('Vary', 'Accept-Encoding')
+        if not_modified:
+            self.end_headers()
+            return
+        self.send_header('Content-type', asset.content_type)
+        if coding != 'identity':
+            self.send_header('Content-Encoding', coding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_job_events(self, job):
+        """Send `progress` events as a job advances and a final `complete` event."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')  # Unbounded body: the stream ends with the connection
+        self.end_headers()
+        self.close_connection = True
+        version = None
+        try:
+            while True:
+                version = job.wait_for_update(version, timeout=15)
+                finished = job.finished
+                event = 'complete' if finished else 'progress'
+                payload = json.dumps(job.snapshot(include_results=finished))
+                self.wfile.write(f'event: {event}\ndata: {payload}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+                if finished:
+                    return
+                time.sleep(0.25)  # Coalesce bursts of results into one event
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The browser closed the stream
+
+    def get_language_preference(self):
+        """Get language preference from URL parameter or browser settings"""
+        # Check for ?lang= parameter first (overrides everything)
+        parsed_url = urllib.parse.urlparse(self.path)
+        query_params = urllib.parse.parse_qs(parsed_url.query)
+        if 'lang' in query_params:
+            lang = query_params['lang'][0].lower()
+            if lang in ['en', 'es']:
+                return lang
+
+        # Check Accept-Language header for auto-detection
+        accept_lang = self.headers.get('Accept-Language', '')
+        if accept_lang:
+            # Parse Accept-Language header (e.g., "es-ES,en-US;q=0.9")
+            # Simple approach: look for 'es' first
+            if accept_lang.lower().startswith('es'):
+                return 'es'
+
+        # Default to English
+        return 'en'
+
+    def send_json_response(self, data, status=200):
+        """Helper to send a JSON response"""
+        with metrics.time('respond'):
+            self.send_response(status)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            response_json = json.dumps(data).encode('utf-8')
+            self.send_header('Content-Length', str(len(response_json)))
+            self.end_headers()
+            self.wfile.write(response_json)
+
+    def send_text_response(self, text, content_type='text/plain; charset=utf-8', status=200):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        metrics.inc('envialite_http_requests_total', method=self.command, status=getattr(code, 'value', code))
+        super().log_request(code, size)
+
+    def log_message(self, format, *args):
+        # Override to reduce noise - only log errors
+        if "POST" in format or "error" in format.lower():
+            super().log_message(format, *args)
+
+
+class KeepAliveEmailMergeHandler(EmailMergeHandler):
+    """HTTP/1.1 variant: the browser reuses its connection for API calls and assets."""
+    protocol_version = 'HTTP/1.1'
+
+    def handle_one_request(self):
+        # Idle connections give their worker back quickly; active requests get longer
+        self.connection.settimeout(HTTP_KEEPALIVE_TIMEOUT)
+        super().handle_one_request()
+
+    def parse_request(self):
+        self.connection.settimeout(HTTP_REQUEST_TIMEOUT)
+        return super().parse_request()
+
+
+def create_http_server(port, mode=None, workers=None, queue_depth=None):
+    """Bind the Envialite HTTP server on `port` in 'threaded' or 'single' mode."""
+    mode = mode or HTTP_SERVER_MODE
+    if mode == 'single':
+        return socketserver.TCPServer(("", port), EmailMergeHandler)
+    httpd = BoundedThreadingHTTPServer(("", port), KeepAliveEmailMergeHandler, workers, queue_depth)
+    metrics.gauge('envialite_http_queue_depth', 'Connections waiting for an HTTP worker.',
+                  lambda: {(): httpd._requests.qsize()})
+    return httpd
+
+
+# --- Main Application Entry Point ---
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Envialite Email Merge Server and Launcher.')
+    parser.add_argument('-g', '--gui', action='store_true', help='Launch the graphical user interface.')
+    parser.add_argument('-d', '--demo', action='store_true',
+                        help='Enable demo mode: sends run in full against a local SMTP stand-in (safe testing).')
+    parser.add_argument('--demo-latency-ms', type=float, default=DEMO_SMTP_LATENCY_MS,
+                        help='Demo SMTP stand-in: delay before each reply.')
+    parser.add_argument('--demo-rate', type=float, default=DEMO_SMTP_RATE,
+                        help='Demo SMTP stand-in: messages/second accepted before it answers 451 (0 never throttles).')
+    parser.add_argument('--demo-failure-rate', type=float, default=DEMO_SMTP_FAILURE_RATE,
+                        help='Demo SMTP stand-in: fraction of recipients refused with 550.')
+    parser.add_argument('--demo-save-dir', default=DEMO_SAVE_DIR,
+                        help='Demo SMTP stand-in: directory each message is saved to as an .eml file.')
+    parser.add_argument('--smtp-connections', type=int, default=SMTP_POOL_SIZE,
+                        help='Parallel SMTP connections per merge (1 reproduces the old serial loop).')
+    parser.add_argument('--max-per-connection', type=int, default=SMTP_MAX_MESSAGES_PER_CONNECTION,
+                        help='Messages sent over one SMTP connection before it is recycled.')
+    parser.add_argument('--max-recipients', type=int, default=SMTP_MAX_RECIPIENTS,
+                        help='Bcc recipients of identical messages sent in one transaction (1 sends each row alone).')
+    parser.add_argument('--render-processes', type=int, default=RENDER_PROCESSES,
+                        help='Processes building messages in parallel (0 builds them on the SMTP threads).')
+    parser.add_argument('--attachment-dir', default=ATTACHMENT_DIR,
+                        help='Directory for the content-addressed attachment store.')
+    parser.add_argument('--server-mode', choices=['threaded', 'single'], default=HTTP_SERVER_MODE,
+                        help='threaded: worker pool with keep-alive; single: one request at a time.')
+    parser.add_argument('--http-workers', type=int, default=HTTP_WORKERS,
+                        help='Worker threads serving HTTP connections in threaded mode.')
+    parser.add_argument('--http-queue', type=int, default=HTTP_QUEUE_DEPTH,
+                        help='Connections allowed to wait for a worker before answering 503.')
+    parser.add_argument('--smtp-idle', type=float, default=SMTP_SESSION_IDLE,
+                        help='Seconds a logged-in SMTP connection stays open for the next request (0 disables).')
+    parser.add_argument('--journal', default=JOURNAL_PATH,
+                        help='SQLite file recording every send so interrupted sends can resume ("" disables).')
+    parser.add_argument('--suppression-list', default=SUPPRESSION_PATH,
+                        help='File of addresses sends never mail, one per line ("" disables).')
+    parser.add_argument('--duplicates', choices=DUPLICATE_POLICIES, default=DUPLICATE_RECIPIENTS,
+                        help='An address already mailed earlier in a send: skip it, flag it in the results '
+                             '(default), or send anyway.')
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='SERVER=RATE',
+                        help='Messages/second ceiling for an SMTP server (repeatable; * for all others). '
+                             'Below it the rate adapts to the server\'s throttling replies.')
+    parser.add_argument('port', type=int, nargs='?', default=8000, help='Port number to run the server on.')
+    return parser
+
+
+def configure_server(args):
+    """
+    Apply parsed command-line settings, load the web assets and open the send
+    journal and render pool, printing the startup summary. Raises ValueError
+    for an invalid setting. Safe to call again for a restart in the same process.
+    """
+    global DEMO_MODE, SMTP_POOL_SIZE, SMTP_MAX_MESSAGES_PER_CONNECTION, attachment_store
+    global HTTP_SERVER_MODE, HTTP_WORKERS, HTTP_QUEUE_DEPTH, send_journal, RENDER_PROCESSES, render_pool
+    global SMTP_MAX_RECIPIENTS, DUPLICATE_RECIPIENTS, suppression_list, demo_sink
+
+    # Set DEMO_MODE from arguments before it's used
+    DEMO_MODE = args.demo
+    SMTP_POOL_SIZE = max(1, args.smtp_connections)
+    SMTP_MAX_MESSAGES_PER_CONNECTION = max(1, args.max_per_connection)
+    smtp_sessions.idle = max(0, args.smtp_idle)
+    attachment_store = AttachmentStore(args.attachment_dir)
+    HTTP_SERVER_MODE = args.server_mode
+    HTTP_WORKERS = max(1, args.http_workers)
+    HTTP_QUEUE_DEPTH = max(1, args.http_queue)
+    RENDER_PROCESSES = max(0, args.render_processes)
+    SMTP_MAX_RECIPIENTS = max(1, args.max_recipients)
+    DUPLICATE_RECIPIENTS = args.duplicates
+    for rule in args.rate_limit:
+        host, _, rate = rule.partition('=')
+        try:
+            SMTP_RATE_LIMITS[host.strip().lower()] = max(SMTP_MIN_RATE, float(rate))
+        except ValueError:
+            raise ValueError(f'--rate-limit expects SERVER=RATE, got {rule!r}') from None
+
+    port = args.port
+
+    print(f"Starting Envialite server on http://localhost:{port}")
+    print(f"DEMO_MODE: {'ON' if DEMO_MODE else 'OFF'}")
+    if DEMO_MODE:
+        demo_settings = (args.demo_latency_ms / 1000, args.demo_rate, args.demo_failure_rate, args.demo_save_dir)
+        if demo_sink is None:
+            demo_sink = DemoSMTPServer(*demo_settings).start()
+        else:
+            demo_sink.configure(*demo_settings)
+        print("✅ Demo mode: No emails will actually be sent")
+        print(f"Demo SMTP stand-in on port {demo_sink.server_address[1]}: {args.demo_latency_ms:g} ms per reply"
+              + (f", throttles above {args.demo_rate:g}/s" if args.demo_rate else '')
+              + (f", refuses {args.demo_failure_rate:.0%} of recipients" if args.demo_failure_rate else '')
+              + (f", saving to {args.demo_save_dir}" if args.demo_save_dir else ''))
+    else:
+        print("⚠️  Live mode: Emails will be sent for real")
+    loaded = static_assets.preload()
+    request_encodings()  # Checked for zstd once here rather than on the first POST
+    print(f"Web assets cached: {loaded} file(s){' (gzip + brotli)' if brotli else ' (gzip)'}")
+    print(f"SMTP connections per merge: {SMTP_POOL_SIZE} (max {SMTP_MAX_MESSAGES_PER_CONNECTION} messages each, "
+          f"kept warm {smtp_sessions.idle:g}s between requests)")
+    if RENDER_PROCESSES and render_pool is None:
+        render_pool = RenderPool(RENDER_PROCESSES)
+        print(f"Message rendering: {RENDER_PROCESSES} process(es)")
+    # Demo sends are journalled like live ones (so a rehearsal pays the same writes), in a file of their own
+    journal_path = demo_journal_path(args.journal) if DEMO_MODE and args.journal else args.journal
+    if not journal_path:
+        send_journal = None
+    elif send_journal is None or send_journal.path != journal_path:
+        send_journal = SendJournal(journal_path)
+        interrupted = restore_interrupted_jobs()
+        relay_usage.load(send_journal.sent_by_relay(time.time() - RELAY_QUOTA_WINDOW))
+        print(f"Send journal: {journal_path}" + (f" ({interrupted} interrupted send(s) can be resumed)"
+                                                  if interrupted else ''))
+    if args.suppression_list and (suppression_list is None or suppression_list.path != args.suppression_list):
+        suppression_list = SuppressionList(args.suppression_list)
+        print(f"Suppression list: {args.suppression_list} ({len(suppression_list)} address(es))")
+    elif not args.suppression_list:
+        suppression_list = None
+    for host, rate in SMTP_RATE_LIMITS.items():
+        print(f"Rate limit for {host}: {rate:g} messages/second")
+    if HTTP_SERVER_MODE == 'threaded':
+        print(f"HTTP server: threaded ({HTTP_WORKERS} workers, queue of {HTTP_QUEUE_DEPTH})")
+    else:
+        print("HTTP server: single-threaded")
+
+
+class ServerThread:
+    """
+    The server running on a thread of this process, for the GUI launcher.
+    `argv` takes the same arguments as the command line. `ready` is set once
+    the socket is bound and the assets are cached, or when startup failed
+    (then `error` says why); `startup_seconds` is how long that took.
+    """
+    def __init__(self, argv):
+        self.argv = list(argv)
+        self.ready = threading.Event()
+        self.error = None
+        self.startup_seconds = None
+        self.httpd = None
+        self._thread = threading.Thread(target=self._run, name='envialite-server', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            args = build_arg_parser().parse_args(self.argv)
+            configure_server(args)
+            self.httpd = create_http_server(args.port)
+        except (Exception, SystemExit) as e:  # argparse exits on bad arguments
+            self.error = e
+            self.ready.set()
+            return
+        self.startup_seconds = time.perf_counter() - started
+        print(f"Server listening on port {args.port} (ready in {self.startup_seconds * 1000:.0f} ms)")
+        self.ready.set()
+        self.httpd.serve_forever()
+
+    def shutdown(self, timeout=5):
+        """Stop serving, close the socket and wait for the server thread to finish."""
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        self._thread.join(timeout)
+        smtp_sessions.clear()
+
+
+def main():
+    parser = build_arg_parser()
+    
+    # Check if running as a frozen PyInstaller executable AND if it's the main entry point (no arguments).
+    # This is the core logic for the hybrid approach.
+    is_frozen_main_entry = hasattr(sys, '_MEIPASS') and len(sys.argv) == 1
+
+    # 1. FROZEN MODE (PyInstaller Binary, primary launch) -> Always launch GUI
+    if is_frozen_main_entry:
+        print("Launching GUI from frozen binary...")
+        launch_gui()
+        return
+
+    # 2. DEVELOPMENT MODE (python server.py) OR SUB-PROCESS MODE (launched by GUI)
+    
+    # Parse arguments for either server (default) or explicit GUI launch
+    args = parser.parse_args()
+    if args.gui:
+        launch_gui()
+        return
+
+    try:
+        configure_server(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    port = args.port
     try:
-        Handler = EmailMergeHandler
-        with socketserver.TCPServer(("", port), Handler) as httpd:
+        with create_http_server(port) as httpd:
             print(f"Server listening on port {port}")
             httpd.serve_forever()
     except OSError as e:
@@ -646,7 +4473,11 @@ def main():
         sys.exit(1)
     except KeyboardInterrupt:
         print("\nServer shutting down.")
+        smtp_sessions.clear()
         sys.exit(0)
 
 if __name__ == "__main__":
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()  # Render processes re-run the frozen executable
     main()